@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+make_summary.py - Write a synthetic msitools STR summary.
+
+The output has the layout written by msitools.pl:
+    chr start end unit region flank1 flank2 sequence repArray strandArray mapQArray
+or, with --layout candidates, the older layout read by candidates/ (without
+the flank1, flank2 and sequence columns).  Loci are written in reference
+order on chr1..chrN followed by chrX and chrY.
+
+Each locus has a random unit and number of units.  Its true alleles differ
+from the reference by whole units: the X and Y loci have a single
+(hemizygous) allele and autosomal loci are heterozygous with probability
+--het-rate.  The number of reads is Poisson with mean --depth or, with
+--dispersion d > 0, negative binomial with variance mean + d * mean^2.  Each
+read comes from one of the alleles and, with probability --stutter-rate, is
+off by a geometrically distributed number of units (mostly contractions).
+
+Usage:
+    make_summary.py --loci 100000 --depth 20 --xy-fraction 0.1 > summary.txt
+"""
+
+import sys
+import numpy
+from argparse import ArgumentParser
+
+units = [ 'mono', 'di', 'tri', 'tetra' ]
+regions = [ 'intergenic', 'intronic', 'exonic' ]
+
+header = "chr\tstart\tend\tunit\tregion\tflank1\tflank2\tsequence\trepArray\tstrandArray\tmapQArray\n"
+candidates_header = "chr\tstart\tend\tunit\tregion\trepArray\tstrandArray\tmapQArray\n"
+
+
+def chrom_sizes(loci, autosomes, xy_fraction):
+    """Return a list of (chrom, number of loci) in reference order."""
+    nxy = int(round(loci * xy_fraction))
+    sizes = [ ('chr%d' % (i + 1), (loci - nxy) // autosomes +
+               (1 if i < (loci - nxy) % autosomes else 0))
+              for i in range(autosomes) ]
+    return sizes + [ ('chrX', nxy - nxy // 2), ('chrY', nxy // 2) ]
+
+
+def random_bases(rng, n, length):
+    """Return `n` random DNA strings of `length` bases."""
+    bases = numpy.array(list('ACGT'))[rng.randint(0, 4, (n, length))]
+    return [ ''.join(b) for b in bases ]
+
+
+def make_loci(rng, chrom, n, depth=20.0, dispersion=0.0, stutter_rate=0.1,
+              het_rate=0.3, max_units=20, chunk_size=10000):
+    """Yield the summary lines of `n` synthetic loci on `chrom` in chunks of
+    `chunk_size`.  Each line is a list of the msitools columns."""
+    hemizygous = chrom.endswith('X') or chrom.endswith('Y')
+    pos = 0
+    for first in range(0, n, chunk_size):
+        m = min(chunk_size, n - first)
+        ulen = rng.randint(1, 5, m)
+        nunits = rng.randint(1, max_units + 1, m)
+        reflen = ulen * nunits
+        start = pos + numpy.cumsum(rng.randint(50, 2000, m) +
+                                   numpy.concatenate(([0], reflen[:-1])))
+        pos = start[-1] + reflen[-1]
+        end = start + reflen - 1
+
+        # True alleles, in bp, differ from the reference by whole units
+        allele1 = numpy.maximum(
+            reflen + ulen * rng.choice([ -1, 0, 0, 0, 0, 1 ], m), ulen)
+        het = numpy.zeros(m, dtype=bool) if hemizygous \
+              else rng.rand(m) < het_rate
+        allele2 = numpy.where(het, numpy.maximum(
+            allele1 + ulen * rng.choice([ -2, -1, 1, 2 ], m), ulen), allele1)
+
+        if dispersion > 0:
+            r = 1.0 / dispersion
+            nreads = rng.negative_binomial(r, r / (r + depth), m)
+        else:
+            nreads = rng.poisson(depth, m)
+        locus = numpy.repeat(numpy.arange(m), nreads)
+        nr = len(locus)
+        obs = numpy.where(rng.rand(nr) < 0.5, allele1[locus], allele2[locus])
+        stutter = rng.rand(nr) < stutter_rate
+        step = rng.geometric(0.7, nr) * numpy.where(rng.rand(nr) < 0.8, -1, 1)
+        obs = numpy.maximum(obs + stutter * step * ulen[locus], 1)
+        strand = numpy.where(rng.rand(nr) < 0.5, '+', '-')
+        mapq = numpy.where(rng.rand(nr) < 0.9, 60, rng.randint(0, 60, nr))
+
+        offsets = numpy.concatenate(([0], numpy.cumsum(nreads)))
+        obs, strand, mapq = obs.tolist(), strand.tolist(), mapq.tolist()
+        motifs = [ bases[:u] for bases, u in zip(random_bases(rng, m, 4),
+                                                  ulen) ]
+        flank1s = random_bases(rng, m, 10)
+        flank2s = random_bases(rng, m, 10)
+        region = rng.randint(0, len(regions), m)
+        rows = []
+        for i in range(m):
+            a, b = offsets[i], offsets[i+1]
+            rows.append([ chrom, str(start[i]), str(end[i]),
+                          units[ulen[i] - 1], regions[region[i]],
+                          flank1s[i], flank2s[i], motifs[i] * nunits[i],
+                          ','.join(map(str, obs[a:b])),
+                          ','.join(strand[a:b]),
+                          ','.join(map(str, mapq[a:b])) ])
+        yield rows
+
+
+def write_summary(out, loci, depth=20.0, dispersion=0.0, stutter_rate=0.1,
+                  het_rate=0.3, xy_fraction=0.1, autosomes=22, seed=0,
+                  layout='msitools'):
+    """Write a synthetic summary of `loci` loci to `out`.  Returns the
+    (number of loci, number of reads) written."""
+    rng = numpy.random.RandomState(seed)
+    out.write(candidates_header if layout == 'candidates' else header)
+    nreads = 0
+    for chrom, n in chrom_sizes(loci, autosomes, xy_fraction):
+        for rows in make_loci(rng, chrom, n, depth=depth,
+                              dispersion=dispersion, stutter_rate=stutter_rate,
+                              het_rate=het_rate):
+            if layout == 'candidates':
+                rows = [ row[:5] + row[8:] for row in rows ]
+            nreads += sum(row[-1].count(',') + 1 for row in rows if row[-1])
+            out.write(''.join('\t'.join(row) + '\n' for row in rows))
+    return (loci, nreads)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Write a synthetic msitools STR '
+                                        'summary to stdout.')
+    parser.add_argument('--loci', metavar='N', type=int, default=100000,
+        help='Number of loci')
+    parser.add_argument('--depth', metavar='X', type=float, default=20.0,
+        help='Mean number of reads per locus')
+    parser.add_argument('--dispersion', metavar='D', type=float, default=0.0,
+        help='Draw depths from a negative binomial with variance '
+             'mean + D * mean^2 instead of a Poisson')
+    parser.add_argument('--stutter-rate', metavar='P', type=float, default=0.1,
+        help='Probability that a read is off by one or more units')
+    parser.add_argument('--het-rate', metavar='P', type=float, default=0.3,
+        help='Probability that an autosomal locus is heterozygous')
+    parser.add_argument('--xy-fraction', metavar='F', type=float, default=0.1,
+        help='Fraction of loci on chrX and chrY')
+    parser.add_argument('--autosomes', metavar='N', type=int, default=22,
+        help='Number of autosomes')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+        help='Random seed')
+    parser.add_argument('--layout', choices=[ 'msitools', 'candidates' ],
+        default='msitools',
+        help='Column layout: that of msitools.pl, or the older one without '
+             'flank and sequence columns read by candidates/')
+    args = parser.parse_args()
+
+    write_summary(sys.stdout, args.loci, depth=args.depth,
+                  dispersion=args.dispersion, stutter_rate=args.stutter_rate,
+                  het_rate=args.het_rate, xy_fraction=args.xy_fraction,
+                  autosomes=args.autosomes, seed=args.seed, layout=args.layout)
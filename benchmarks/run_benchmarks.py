@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+run_benchmarks.py - Time the STR summary tools on synthetic summaries.
+
+For each scale (a number of loci), a summary is written by make_summary.py
+and each benchmark is run in its own child process:
+    iterate  -- read the summary with genotyper/strlocusiterator.py
+    profile  -- genotyper.py profile
+    call     -- genotyper.py call with that profile
+    metrics  -- candidates/metrics_msitools.py on the same loci in the
+                candidates layout
+    stutter  -- stutter/stutter_distn.py on the calls
+Every result records the wall time and peak RSS of the child and its
+throughput in loci/sec and reads/sec.  The results are written as JSON along
+with the git revision, and --compare prints the change from the results of
+an earlier run, so regressions are visible between versions.
+
+Usage:
+    run_benchmarks.py --scales 10000,100000 [--compare old.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+from tempfile import mkdtemp
+from argparse import ArgumentParser
+from make_summary import write_summary
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+genotyper = os.path.join(root, 'genotyper', 'genotyper.py')
+metrics_msitools = os.path.join(root, 'candidates', 'metrics_msitools.py')
+stutter_distn = os.path.join(root, 'stutter', 'stutter_distn.py')
+
+# The read and locus filters used by the pipeline's genotyper task
+genotyper_filters = [ '--min-mapq', '30', '--min-depth', '10' ]
+
+iterate_code = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from strlocusiterator import STRLocusIterator
+with STRLocusIterator(sys.argv[2]) as locus_f:
+    for batch in locus_f.iter_batches(10000):
+        pass
+"""
+
+
+def revision():
+    """Return the git revision of the working tree, or 'unknown'."""
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(
+                [ 'git', 'rev-parse', '--short', 'HEAD' ], cwd=root,
+                stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(cmd):
+    """Run `cmd`, discarding its output, and return (wall seconds, peak RSS
+    of the child in KB)."""
+    with open(os.devnull, 'w') as out:
+        start = time.time()
+        p = subprocess.Popen(cmd, stdout=out)
+        # wait4 reports the resource usage of this child alone
+        pid, status, usage = os.wait4(p.pid, 0)
+        seconds = time.time() - start
+    p.returncode = status
+    if status != 0:
+        raise RuntimeError('benchmark failed: %s' % ' '.join(cmd))
+    return (seconds, usage.ru_maxrss)
+
+
+def benchmark_scale(workdir, loci, params, jobs=1):
+    """Run every benchmark on a summary of `loci` loci and return a list of
+    result dicts."""
+    summary = os.path.join(workdir, 'summary.%d.txt' % loci)
+    old_summary = os.path.join(workdir, 'summary.%d.candidates.txt' % loci)
+    profile = os.path.join(workdir, 'profile.%d.txt' % loci)
+    calls = os.path.join(workdir, 'calls.%d.txt' % loci)
+
+    with open(summary, 'w') as f:
+        loci, reads = write_summary(f, loci, **params)
+    with open(old_summary, 'w') as f:
+        write_summary(f, loci, layout='candidates', **params)
+
+    py = sys.executable
+    benchmarks = [
+        ('iterate', [ py, '-c', iterate_code, os.path.dirname(genotyper),
+                      summary ]),
+        ('profile', [ py, genotyper, 'profile', '--error-distn-file', profile,
+                      summary ] + genotyper_filters),
+        ('call', [ py, genotyper, 'call', '--error-profile', profile,
+                   '--jobs', str(jobs), '--output', calls, summary ] +
+                 genotyper_filters),
+        ('metrics', [ py, metrics_msitools, old_summary ]),
+        ('stutter', [ py, stutter_distn, calls ]),
+    ]
+
+    results = []
+    for name, cmd in benchmarks:
+        seconds, rss = run(cmd)
+        results.append({ 'benchmark': name, 'loci': loci, 'reads': reads,
+                         'seconds': seconds, 'max_rss_kb': rss,
+                         'loci_per_sec': loci / seconds,
+                         'reads_per_sec': reads / seconds })
+        sys.stderr.write('%-8s %9d loci  %8.2f s  %8d KB\n' %
+                         (name, loci, seconds, rss))
+    return results
+
+
+def compare(old, new):
+    """Print the change in time and peak RSS of each benchmark from the
+    results `old` to the results `new`."""
+    before = dict(((r['benchmark'], r['loci']), r) for r in old['results'])
+    print("benchmark\tloci\tseconds_%s\tseconds_%s\ttime_ratio\trss_ratio" %
+          (old['revision'], new['revision']))
+    for r in new['results']:
+        o = before.get((r['benchmark'], r['loci']))
+        if o is None:
+            continue
+        print("%s\t%d\t%.3f\t%.3f\t%.3f\t%.3f" %
+              (r['benchmark'], r['loci'], o['seconds'], r['seconds'],
+               r['seconds'] / o['seconds'],
+               float(r['max_rss_kb']) / o['max_rss_kb']))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the STR summary tools on '
+                                        'synthetic summaries.')
+    parser.add_argument('--scales', metavar='N,N,...', type=str,
+        default='10000,100000',
+        help='Numbers of loci to benchmark')
+    parser.add_argument('--depth', metavar='X', type=float, default=20.0,
+        help='Mean number of reads per locus')
+    parser.add_argument('--dispersion', metavar='D', type=float, default=0.0,
+        help='Negative binomial depth dispersion (see make_summary.py)')
+    parser.add_argument('--stutter-rate', metavar='P', type=float, default=0.1,
+        help='Probability that a read is off by one or more units')
+    parser.add_argument('--xy-fraction', metavar='F', type=float, default=0.1,
+        help='Fraction of loci on chrX and chrY')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+        help='Random seed')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+        help='Processes used by genotyper.py call')
+    parser.add_argument('--output', metavar='file', type=str,
+        help='Write the results to this file.  Default: '
+             'benchmarks-<revision>.json')
+    parser.add_argument('--compare', metavar='file', type=str,
+        help='Results of an earlier run to compare with')
+    parser.add_argument('--workdir', metavar='dir', type=str,
+        help='Keep the summaries and outputs in this directory instead of a '
+             'temporary one')
+    args = parser.parse_args()
+
+    params = dict(depth=args.depth, dispersion=args.dispersion,
+                  stutter_rate=args.stutter_rate,
+                  xy_fraction=args.xy_fraction, seed=args.seed)
+    workdir = args.workdir or mkdtemp(prefix='benchmarks.')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    rev = revision()
+    report = { 'revision': rev, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'host': platform.node(), 'python': platform.python_version(),
+               'params': dict(params, jobs=args.jobs), 'results': [] }
+    try:
+        for loci in [ int(x) for x in args.scales.split(',') ]:
+            report['results'] += benchmark_scale(workdir, loci, params,
+                                                 jobs=args.jobs)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    with open(args.output or 'benchmarks-%s.json' % rev, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
@@ -1,39 +1,28 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import numpy
+from argparse import ArgumentParser
 
-if len(sys.argv) != 2:
-    print('usage: %s tab_separated_table')
-    exit(1)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'candidates'))
+from candidatefilter import read_header, read_chunks
 
-tsv_f = open(sys.argv[1].strip(), 'r')
 
-
-
-# Return True or False if the supplied dict shows a difference in repeat
-# unit length that is consistent with a lineage
-# Tuples in this function are (repeat unit length, number of supporting reads)
-def is_candidate(info, n_single=2, min_supp_for_allele=5):
+# Return a boolean array: whether each locus of the chunk shows a difference
+# in repeat unit length that is consistent with a lineage.
+def is_candidate(chunk, n_single=2, min_supp_for_allele=5):
     # Some utility functions
-    def pair(sample):
-        return (info['zygosity.' + sample], info['support.freq.' + sample])
-    def is_hom(x): return x[0] == 'hom'
-    def is_het(x): return x[0] == 'het'
-    def is_supported_het(x, supp=min_supp_for_allele):
+    def is_hom(sample):
+        return chunk.column('zygosity.' + sample) == 'hom'
+    def is_supported_het(sample, supp=min_supp_for_allele):
         """Determine number of repeat unit lengths that are supported by at
         least `supp` reads.  If more than 2 repeat unit lengths are supported,
-        then consider `x` a supported heterozygous call."""
-        if x[0] is None:
-            return False
-
-        freqs = map(tuple, [ f.split(':') for f in x[1].split(' ') ])
-        supported_freqs = filter(lambda f: int(f[1]) >= supp, freqs)
-        return len(supported_freqs) >= 2
-
-    # Zip up zygosity and support calls into a tuple for easier processing
-    heart_bulk = pair('heart_bulk')
-    neurons = map(pair, samples[1:])
+        then consider `sample` a supported heterozygous call."""
+        reads = chunk.alleles('support.freq.' + sample)[1]
+        return (chunk.column('zygosity.' + sample) != 'NA') & \
+               ((reads >= supp).sum(axis=1) >= 2)
 
     # Look for sites that are homozygous in bulk heart DNA but heterozygous
     # in at least `n_single` single neuron samples.
@@ -46,9 +35,20 @@ def is_candidate(info, n_single=2, min_supp_for_allele=5):
     #      are likely false positives due to polymerase stutter
     #   2. alternate alleles that appear in multiple independent single
     #      cell neurons are less likely to be caused by stutter.
-    supp_het_neurons = filter(is_supported_het, neurons)
-    return is_hom(heart_bulk) and len(supp_het_neurons) >= n_single
+    supp_het_neurons = sum(is_supported_het(s).astype(int)
+                           for s in samples[1:])
+    return is_hom('heart_bulk') & (supp_het_neurons >= n_single)
+
+
+parser = ArgumentParser(description='Select loci homozygous in heart bulk '
+                                    'and heterozygous in single neurons.')
+parser.add_argument('table', metavar='tab_separated_table',
+    help='Candidate table with zygosity and support.freq columns per sample')
+parser.add_argument('--chunksize', metavar='N', type=int, default=10000,
+    help='Lines of the table to filter at a time')
+args = parser.parse_args()
 
+tsv_f = open(args.table.strip(), 'r')
 
 # headers should be in the table, but the format should be roughly:
 #   chr start end (zygosity, support)*N
@@ -57,31 +57,21 @@ def is_candidate(info, n_single=2, min_supp_for_allele=5):
 # x:y values, where x is the repeat unit length and y is the number
 # of reads supporting that repeat unit length.
 # We always want chr, start, end.
-relevant_col_idxs = numpy.array([0,1,2], dtype=numpy.int)
-colnames = numpy.array([])
+relevant_col_idxs = [0,1,2]
 samples = [ 'heart_bulk', 'cortex_bulk', 'neurons_100batch', 'neuron_2', 'neuron_3', 'neuron_51', 'neuron_6']
-for line in tsv_f:
-    fields = numpy.array(map(str.strip, line.split('\t')))
 
-    # Handle the header: determine which column indexes contain the data
-    # we care about.
-    if fields[0] == 'chr':
-        for idx in range(0, len(fields)):
-            for s in samples:
-                if fields[idx].find(s) != -1:
-                    relevant_col_idxs = numpy.append(relevant_col_idxs, [idx])
-                    
-        colnames = fields[relevant_col_idxs]
-        print('\t'.join(colnames))
-        continue
+# Handle the header: determine which column indexes contain the data
+# we care about.
+header_line, fields = read_header(tsv_f)
+for idx in range(0, len(fields)):
+    for s in samples:
+        if fields[idx].find(s) != -1:
+            relevant_col_idxs.append(idx)
 
-    
-    # If we get here, the header should've already been parsed and we should
-    # have a nonempty relevant_col_idxs.  Grab only the relevant fields and
-    # translate any NA values to None.
-    fields = map(lambda x: x if x != 'NA' else None, fields[relevant_col_idxs])
-    info = dict(zip(colnames, fields))
+colnames = [ fields[idx] for idx in relevant_col_idxs ]
+print('\t'.join(colnames))
 
-    if is_candidate(info):
-        # Translate None values back to 'NA'
-        print('\t'.join(map(lambda x: 'NA' if x is None else x, fields)))
+for chunk in read_chunks(tsv_f, fields, args.chunksize):
+    for i in numpy.flatnonzero(is_candidate(chunk)):
+        fields = chunk.fields(i)
+        print('\t'.join(fields[idx] for idx in relevant_col_idxs))
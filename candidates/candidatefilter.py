@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Chunked, column-wise filtering of joined candidate tables.
+
+candidates.py and candidates/candidates.py select loci from tables with a
+group of columns per sample: zygosity.S and support.freq.S from lobSTR, or
+genotype.S and allele_summaries.S from join_loci.py.  Instead of building a
+dict per row and splitting those strings again for every test, read_chunks()
+reads the table `chunksize` lines at a time and a Chunk parses each column
+it is asked for once, with one regex pass over the whole chunk, into numpy
+arrays:
+    column(name)     -- the stripped strings
+    alleles(name)    -- (alleles, reads): (n, K) int matrices of the
+                        allele:reads pairs of a support.freq or
+                        allele_summaries column, padded with `pad` alleles
+                        and 0 reads
+    genotypes(name)  -- (a, b): int arrays of an a/b genotype column, `pad`
+                        where there is no genotype (NA)
+so a selection rule is a boolean expression on arrays over the chunk, e.g.
+    contains(chunk.alleles('allele_summaries.S')[0], a)
+Memory use is bounded by the chunk size, not the size of the table.
+"""
+
+import re
+import numpy
+from itertools import islice
+
+# Marks the unused cells of an allele matrix and missing genotypes
+pad = numpy.iinfo(numpy.int64).min
+
+# An allele:reads or a/b pair starting a space-separated token; the reads
+# of an allele_summaries token are followed by ",fracforward,meanmapq"
+allele_pattern = re.compile(r'(?<![^ \n])[-0-9]+:[0-9]+')
+genotype_pattern = re.compile(r'(?<![^ \n])[-0-9]+/[-0-9]+')
+
+
+def parse_pairs(strings, pattern, sep):
+    """Return two (len(strings), K) int matrices of the x and y of every
+    x`sep`y matched by `pattern` in each string, in order, padded with
+    `pad`.  Each pair is assumed to hold the only `sep` of its token, so
+    the pairs of each row can be counted without matching row by row."""
+    counts = numpy.array([ s.count(sep) for s in strings ], dtype=numpy.int64)
+    pairs = pattern.findall('\n'.join(strings))
+    if len(pairs) != counts.sum():
+        counts = numpy.array([ len(pattern.findall(s)) for s in strings ],
+                             dtype=numpy.int64)
+    xy = numpy.fromstring(' '.join(pairs).replace(sep, ' '),
+                          dtype=numpy.int64, sep=' ').reshape(-1, 2)
+    row = numpy.repeat(numpy.arange(len(strings)), counts)
+    col = numpy.arange(len(row)) - numpy.repeat(numpy.cumsum(counts) - counts,
+                                                counts)
+
+    k = max(counts.max(), 1) if len(counts) > 0 else 1
+    xs = numpy.full((len(strings), k), pad, dtype=numpy.int64)
+    ys = numpy.full((len(strings), k), pad, dtype=numpy.int64)
+    xs[row, col] = xy[:,0]
+    ys[row, col] = xy[:,1]
+    return (xs, ys)
+
+
+def contains(alleles, x):
+    """For each row i, whether x[i] is one of the alleles in row i of the
+    allele matrix `alleles`.  Missing values are never contained."""
+    x = numpy.asarray(x)[:,None]
+    return ((alleles == x) & (alleles != pad)).any(axis=1)
+
+
+class Chunk():
+    """`lines` of a table with column names `headers`.  first_line is the
+    number of the first of the lines, counting the header as line 0."""
+
+    def __init__(self, headers, lines, first_line):
+        self.headers = headers
+        self.lines = lines
+        self.first_line = first_line
+        self.rows = [ line.split('\t') for line in lines ]
+        self.parsed = {}
+
+
+    def __len__(self):
+        return len(self.lines)
+
+
+    def fields(self, i):
+        """The stripped fields of row `i`."""
+        return [ x.strip() for x in self.rows[i] ]
+
+
+    def strings(self, name):
+        """The stripped fields of column `name` as a list."""
+        idx = self.headers.index(name)
+        return [ r[idx].strip() for r in self.rows ]
+
+
+    def column(self, name):
+        key = ('column', name)
+        if key not in self.parsed:
+            self.parsed[key] = numpy.array(self.strings(name))
+        return self.parsed[key]
+
+
+    def alleles(self, name):
+        key = ('alleles', name)
+        if key not in self.parsed:
+            alleles, reads = parse_pairs(self.strings(name), allele_pattern,
+                                         ':')
+            reads[reads == pad] = 0
+            self.parsed[key] = (alleles, reads)
+        return self.parsed[key]
+
+
+    def genotypes(self, name):
+        key = ('genotypes', name)
+        if key not in self.parsed:
+            a, b = parse_pairs(self.strings(name), genotype_pattern, '/')
+            self.parsed[key] = (a[:,0], b[:,0])
+        return self.parsed[key]
+
+
+def read_header(f):
+    """Read the header line of the table `f`; returns (line, column
+    names)."""
+    line = f.readline()
+    return (line, [ h.strip() for h in line.split('\t') ])
+
+
+def read_chunks(f, headers, chunksize=10000):
+    """Yield Chunks of `chunksize` lines of the table `f`, whose header has
+    been read by read_header()."""
+    first_line = 1
+    while True:
+        lines = list(islice(f, chunksize))
+        if not lines:
+            break
+        yield Chunk(headers, lines, first_line)
+        first_line += len(lines)
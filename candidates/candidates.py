@@ -22,7 +22,9 @@ We have 7 samples:
 """
 
 import sys
-from operator import itemgetter
+import numpy
+from argparse import ArgumentParser
+from candidatefilter import read_header, read_chunks, contains
 
 samples = [
     '1465-heartbulk',
@@ -35,10 +37,6 @@ samples = [
 ]
     
 
-if len(sys.argv) != 2:
-    print('usage: %s candidate_file' % sys.argv[0])
-    exit(1)
-
 # Format is: allele1:depth,fracforward,meanmapq ... alleleN:... ...
 # Return the set of alleles for which there is *any* evidence
 #def parse_alleles(summary):
@@ -56,14 +54,99 @@ def parse_alleles(summary):
 def parse_genotype(gt):
     return gt.split('/')
 
+
+def segregating(chunk):
+    """Return a boolean array: whether each locus in `chunk` meets the
+    criteria above."""
+    # To improve confidence in the alleles, ensure that they are witnessed
+    # in the bulk cortex PCR-amplified sample.  They do NOT have to be the
+    # called genotype in the bulk cortex sample--due to the fact that there
+    # are many cells considered, we should not be surprised to see more than
+    # 2 distinct alleles at any bulk locus.
+    cortex_alleles = chunk.alleles('allele_summaries.' + samples[1])[0]
+    heart_alleles = chunk.alleles('allele_summaries.' + samples[0])[0]
+
+    # For the single cell samples, only the alleles in the genotype should
+    # be considered.  Alleles not included in the final genotype are likely
+    # to be errors of sequence, amplification, etc.
+    neuron_gts = []
+    for s in samples[3:]:
+        a, b = chunk.genotypes('genotype.' + s)
+        # Only keep genotypes for which both alleles were seen in cortex
+        # bulk, and get rid of genotypes for which both alleles are seen in
+        # heart (not necessarily CALLED in heart).
+        kept = contains(cortex_alleles, a) & contains(cortex_alleles, b) & \
+               ~(contains(heart_alleles, a) & contains(heart_alleles, b))
+        neuron_gts.append((kept, a, b))
+
+    # A simple heuristic to handle allelic imbalance/dropout: for a gt to be
+    # supported, make sure at least two single cells have it.  Justification:
+    # If we see a segregating allele like: 0/0, 0/1, 0/1, 0/1, it's very
+    # likely that the 0/0 allele was caused either by complete allele D.O. or
+    # the call was influenced by heavy allele imbalance (e.g., 0:20, 1:3).
+    # This should really be addressed by a multisample genotyper, but let's
+    # see if this stop-gap solution can generate some interesting candidates.
+    # XXX: relax this for now
+
+    # Do the single cell alleles segregate the neurons?  Simple question:
+    # is there more than one distinct genotype among the kept ones?
+    seg = numpy.zeros(len(chunk), dtype=bool)
+    for i, (kept1, a1, b1) in enumerate(neuron_gts):
+        for kept2, a2, b2 in neuron_gts[i+1:]:
+            seg |= kept1 & kept2 & ((a1 != a2) | (b1 != b2))
+    return seg
+
+
+def print_candidate(fields, line):
+    """Print a selected locus along with the evidence for it."""
+    neuron_gts = [ parse_genotype(fields[idx]) for idx in neuron_gt_idxs ]
+    cortex_alleles = parse_alleles(fields[cortex_evidence_idx])
+    heart_alleles = parse_alleles(fields[heart_evidence_idx])
+    neuron_gts_in_cortex = \
+        [ gt for gt in neuron_gts
+          if gt[0] in cortex_alleles and gt[1] in cortex_alleles ]
+    neuron_gts_not_in_heart = \
+        [ gt for gt in neuron_gts_in_cortex
+          if not (gt[0] in heart_alleles and gt[1] in heart_alleles) ]
+    final_neuron_gts = [ '%s/%s' % tuple(gt) for gt in neuron_gts_not_in_heart
+                         if neuron_gts_not_in_heart.count(gt) > 0 ]
+
+    print('heart: %s\t%s' % (fields[heart_gt_idx], fields[heart_evidence_idx]))
+    print('cortex: %s\t%s' % (fields[cortex_gt_idx], fields[cortex_evidence_idx]))
+    print('caudate: %s\t%s' % (fields[caudate_gt_idx], fields[caudate_evidence_idx]))
+    for i in range(3, len(samples)):
+        print('%s: %s\t%s' % (samples[i], fields[neuron_gt_idxs[i-3]], fields[neuron_evidence_idxs[i-3]]))
+    print('neuron_gts: ' + str(neuron_gts))
+    print('cortex_alleles: ' + str(cortex_alleles))
+    print('heart_alleles: ' + str(heart_alleles))
+    print('neuron_gts_not_in_heart: ' + str(neuron_gts_not_in_heart))
+    print('final_neuron_gts: ' + str(final_neuron_gts))
+    print(line.strip())
+    print(''.join(['-'] * 80))
+
+
+def progress(nlines, line_number):
+    """Report every 10000th line up to `line_number`; returns it."""
+    for n in range((nlines // 10000 + 1) * 10000, line_number + 1, 10000):
+        print('processed %d lines..' % n)
+    return line_number
+
+
+parser = ArgumentParser(description='Select loci whose single neuron '
+                                    'genotypes are segregated.')
+parser.add_argument('candidate_file',
+    help='Calls of the samples joined by join_loci.py')
+parser.add_argument('--chunksize', metavar='N', type=int, default=10000,
+    help='Lines of the table to filter at a time')
+args = parser.parse_args()
+
 # Format is:
 #   chrom, start, end, ref_len, unit, region
 # followed by a variable number of 4-column groups:
 #   #raw_alleles, call, genotype, allele_summary
-f = open(sys.argv[1], 'r')
-header_line = f.readline()
+f = open(args.candidate_file, 'r')
+header_line, headers = read_header(f)
 sys.stdout.write(header_line)
-headers = [ h.strip() for h in header_line.split('\t') ]
 
 # Columns containing genotype strings (allele_len/allele_len)
 heart_gt_idx = headers.index('genotype.' + samples[0])
@@ -81,69 +164,8 @@ neuron_evidence_idxs = \
 
 # Parse the file
 nlines = 0
-for line in f:
-    nlines += 1
-    if nlines % 10000 == 0:
-        print('processed %d lines..' % nlines)
-
-    fields = [ x.strip() for x in line.split('\t') ]
-
-    # Skipping mono since they seem too unlikely
-    #if fields[4] == 'mono':
-        #continue
-
-    #heart_gt = parse_genotype(fields[heart_gt_idx])
-    #cortex_gt = parse_genotype(fields[cortex_gt_idx])
-    #neurons100_gt = parse_genotype(fields[neurons100_gt_idx])
-
-    # For the single cell samples, only the alleles in the genotype should
-    # be considered.  Alleles not included in the final genotype are likely
-    # to be errors of sequence, amplification, etc.
-    neuron_gts = [ parse_genotype(fields[idx]) for idx in neuron_gt_idxs ]
-
-    # To improve confidence in the alleles, ensure that they are witnessed
-    # in the bulk cortex PCR-amplified sample.  They do NOT have to be the
-    # called genotype in the bulk cortex sample--due to the fact that there
-    # are many cells considered, we should not be surprised to see more than
-    # 2 distinct alleles at any bulk locus.
-    cortex_alleles = parse_alleles(fields[cortex_evidence_idx])
-
-    # Only keep genotypes for which both alleles were seen in cortex bulk
-    neuron_gts_in_cortex = \
-        [ gt for gt in neuron_gts
-          if gt[0] in cortex_alleles and gt[1] in cortex_alleles ]
-
-    # Get rid of genotypes for which both alleles are seen in heart (not
-    # necessarily CALLED in heart).
-    heart_alleles = parse_alleles(fields[heart_evidence_idx])
-    neuron_gts_not_in_heart = \
-        [ gt for gt in neuron_gts_in_cortex
-          if not (gt[0] in heart_alleles and gt[1] in heart_alleles) ]
-        
-
-    # A simple heuristic to handle allelic imbalance/dropout: for a gt to be
-    # supported, make sure at least two single cells have it.  Justification:
-    # If we see a segregating allele like: 0/0, 0/1, 0/1, 0/1, it's very
-    # likely that the 0/0 allele was caused either by complete allele D.O. or
-    # the call was influenced by heavy allele imbalance (e.g., 0:20, 1:3).
-    # This should really be addressed by a multisample genotyper, but let's
-    # see if this stop-gap solution can generate some interesting candidates.
-    # XXX: relax this for now
-    final_neuron_gts = [ '%s/%s' % tuple(gt) for gt in neuron_gts_not_in_heart
-                         if neuron_gts_not_in_heart.count(gt) > 0 ]
-
-    # Do the single cell alleles segregate the neurons?  Simple question:
-    # is there more than one distinct genotype?
-    if len(set(final_neuron_gts)) > 1:
-        print('heart: %s\t%s' % (fields[heart_gt_idx], fields[heart_evidence_idx]))
-        print('cortex: %s\t%s' % (fields[cortex_gt_idx], fields[cortex_evidence_idx]))
-        print('caudate: %s\t%s' % (fields[caudate_gt_idx], fields[caudate_evidence_idx]))
-        for i in range(3, len(samples)):
-            print('%s: %s\t%s' % (samples[i], fields[neuron_gt_idxs[i-3]], fields[neuron_evidence_idxs[i-3]]))
-        print('neuron_gts: ' + str(neuron_gts))
-        print('cortex_alleles: ' + str(cortex_alleles))
-        print('heart_alleles: ' + str(heart_alleles))
-        print('neuron_gts_not_in_heart: ' + str(neuron_gts_not_in_heart))
-        print('final_neuron_gts: ' + str(final_neuron_gts))
-        print(line.strip())
-        print(''.join(['-'] * 80))
+for chunk in read_chunks(f, headers, args.chunksize):
+    for i in numpy.flatnonzero(segregating(chunk)):
+        nlines = progress(nlines, chunk.first_line + i)
+        print_candidate(chunk.fields(i), chunk.lines[i])
+    nlines = progress(nlines, chunk.first_line + len(chunk) - 1)
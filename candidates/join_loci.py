@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+join_loci.py - Join the genotyper calls of several samples into one table.
+
+Each input is a genotyper calls file (plain or gzipped).  The genotyper
+writes loci in reference order, so the files are joined by a streaming
+k-way merge on (chrom, start, end) and memory use does not depend on the
+number of loci.  The output has the locus columns of the calls files
+(chr ... sequence) followed by the remaining columns of every sample,
+suffixed with the sample name as join_loci.R did:
+    raw_alleles.S, call.S, genotype.S, pval.S, allele_summaries.S
+
+By default only loci called in every sample are written, like the R
+script's merge; with --all, loci called in any sample are written and the
+columns of the other samples are NA.
+
+Chromosomes are merged in the order given by --chroms or, by default, the
+order of the calls files.  The chromosomes of each file are found before
+any locus is joined (see genotyper/chromorder.py), without reading plain
+files through; gzipped files cannot seek and are read through once.  The
+orders of all files are merged, so a file may lack chromosomes the
+others have, but the files must agree on the order of the chromosomes
+they share; if they do not, give --chroms.  With --chroms and the default
+inner join, loci on chromosomes not listed are skipped.
+
+Usage:
+    join_loci.py [--all] [--sample name ...] calls1.txt calls2.txt ... > joined.txt
+"""
+
+import os
+import sys
+import gzip
+import heapq
+from argparse import ArgumentParser
+from itertools import groupby
+from operator import itemgetter
+# The chromosome order helpers are shared with the genotyper
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'genotyper'))
+from chromorder import scan_chroms, merge_chrom_orders
+
+# The first data column of a calls file; all columns before it describe
+# the locus and are shared by every sample.
+first_data_column = 'raw_alleles'
+
+
+def open_calls(filename):
+    return gzip.open(filename, 'rb') if filename.endswith('.gz') \
+           else open(filename, 'r')
+
+
+def read_calls(f, i, nkey, chrom_rank, skip_unknown=False):
+    """Yield (merge key, sample number, locus fields, data fields) for each
+    line of the open calls file `f`, whose header has been read.  The first
+    `nkey` columns are the locus fields.  Lines on chromosomes not in
+    `chrom_rank` raise an error unless `skip_unknown` is set."""
+    last = None
+    for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if fields[0] not in chrom_rank:
+            if skip_unknown:
+                continue
+            else:
+                raise ValueError('%s: chromosome %s is not in the '
+                                 'chromosome order; see --chroms' %
+                                 (f.name, fields[0]))
+        key = (chrom_rank[fields[0]], int(fields[1]), int(fields[2]))
+        if key <= last:
+            raise ValueError('%s is not in reference order at %s:%s' %
+                             (f.name, fields[0], fields[1]))
+        last = key
+        yield (key, i, fields[:nkey], fields[nkey:])
+
+
+def join_calls(filenames, samples, out, chroms=None, require_all=True):
+    """Join the calls files `filenames` of `samples` and write the table to
+    `out`."""
+    if not chroms:
+        chroms = merge_chrom_orders([ [ c for c, offset in scan_chroms(f) ]
+                                      for f in filenames ])
+    chrom_rank = dict((c, i) for i, c in enumerate(chroms))
+
+    files = [ open_calls(f) for f in filenames ]
+    headers = [ f.readline().rstrip('\n').split('\t') for f in files ]
+    nkey = headers[0].index(first_data_column)
+    for filename, header in zip(filenames, headers):
+        if header != headers[0]:
+            raise ValueError('%s: columns differ from those of %s' %
+                             (filename, filenames[0]))
+    na = [ 'NA' ] * (len(headers[0]) - nkey)
+
+    out.write('\t'.join(headers[0][:nkey] +
+                        [ '%s.%s' % (c, s) for s in samples
+                          for c in headers[0][nkey:] ]) + '\n')
+
+    streams = [ read_calls(f, i, nkey, chrom_rank, skip_unknown=require_all)
+                for i, f in enumerate(files) ]
+    for key, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        row = [ None ] * len(files)
+        for key, i, locus, data in group:
+            row[i] = data
+        if require_all and any(data is None for data in row):
+            continue
+        out.write('\t'.join(locus + [ x for data in row
+                                      for x in (data or na) ]) + '\n')
+
+    for f in files:
+        f.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Join per-sample genotyper calls '
+                                        'files into one table.')
+    parser.add_argument('calls', metavar='calls.txt', nargs='+',
+        help='genotyper calls files, one per sample')
+    parser.add_argument('--sample', dest='samples', metavar='name',
+        action='append',
+        help="Sample name used in the column names.  Give once per calls "
+             "file, in the same order.  Default: the file name up to the "
+             "first '.'.")
+    parser.add_argument('--chroms', metavar='chr1,chr2,...', type=str,
+        help="Chromosomes in reference order.  Default: the order of the "
+             "calls files, merged.")
+    parser.add_argument('--all', action='store_true', default=False,
+        help="Write loci called in any sample instead of only those called "
+             "in every sample.")
+    args = parser.parse_args()
+
+    samples = args.samples or \
+        [ os.path.basename(f).split('.')[0] for f in args.calls ]
+    if len(samples) != len(args.calls):
+        parser.error('give one --sample per calls file')
+
+    join_calls(args.calls, samples, sys.stdout,
+               chroms=args.chroms.split(',') if args.chroms else None,
+               require_all=not args.all)
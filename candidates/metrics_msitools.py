@@ -26,25 +26,38 @@ Options for filtering reads:
     consider loci where the repeat unit (end-start+1) / unit size is greater
     than the specified value.  This could be useful to remove questionable
     loci, like 2~3 repeat units of tri or tetranucleotide repeats.
+
+--jobs N splits the summary file into N newline-aligned byte ranges that
+are read by N processes; the metrics are merged into exact totals.
 """
 
 import sys
 from argparse import ArgumentParser
-from strlocusiterator import STRLocusIterator
+from strlocusiterator import STRLocusIterator, sharded_metrics
 
 parser = ArgumentParser()
 STRLocusIterator.add_parser_args(parser)
+parser.add_argument('--jobs', metavar='N', type=int, default=1,
+    help='Split the summary file into N pieces and read them in N ' \
+         'parallel processes')
 args = parser.parse_args()
+params = vars(args)
+jobs = params.pop('jobs')
 
-locus_f = STRLocusIterator(**vars(args))
-for (chrom, start, end, unit, region, reads) in locus_f:
-    # Don't do anything, just accumulate metrics
-    continue
+if jobs > 1:
+    filter_metrics, hist_metrics = sharded_metrics(params, jobs)
+else:
+    locus_f = STRLocusIterator(**params)
+    # Only the metrics are needed, so skip building the per-locus tuples
+    for batch in locus_f.iter_batches(10000):
+        continue
+    filter_metrics = locus_f.filter_metrics()
+    hist_metrics = locus_f.hist_metrics()
 
-for (description, value) in locus_f.filter_metrics():
+for (description, value) in filter_metrics:
     print("%s\t%d" % (description, value))
 
-for (description, hist) in locus_f.hist_metrics():
+for (description, hist) in hist_metrics:
     print(description)
     for k in sorted(hist.keys()):
         print("%s\t%d" % (k, hist[k]))
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
+import os
+import numpy
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool
 
 unit_to_int = { 'mono': 1, 'di': 2, 'tri': 3, 'tetra': 4 }
 
@@ -17,6 +21,152 @@ def build_reads(obslens, strands, mapqs, min_mapq):
     return [ read for read in zip(obs, strands, mapqs) if read[2] >= min_mapq ]
 
 
+def split_byte_ranges(filename, n):
+    """Split the loci of the summary file `filename` into at most `n` byte
+    ranges [start, end) of roughly equal size.  Every range begins at the
+    start of a line and ends just after a newline, so each one can be read
+    independently by STRLocusIterator(byte_range=...).  The header line is
+    not part of any range."""
+    size = os.path.getsize(filename)
+    with open(filename, 'r') as f:
+        first = len(f.readline())
+        bounds = [ first ]
+        for i in range(1, n):
+            # Move each split point forward to the start of the next line
+            f.seek(max(first + (size - first) * i // n - 1, first))
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def merge_metrics(metrics):
+    """Sum a list of (filter metrics, hist metrics) as returned by
+    shard_metrics into totals for the whole file."""
+    filter_metrics = [ (d, sum(m[0][i][1] for m in metrics))
+                       for i, (d, _) in enumerate(metrics[0][0]) ]
+    hist_metrics = []
+    for i, (d, _) in enumerate(metrics[0][1]):
+        hist = defaultdict(int)
+        for m in metrics:
+            for k, v in m[1][i][1].iteritems():
+                hist[k] += v
+        hist_metrics.append((d, hist))
+    return (filter_metrics, hist_metrics)
+
+
+def shard_metrics(job):
+    """Read one shard in a worker process.  `job` is a tuple of
+    (STRLocusIterator keyword args, byte range).  Returns the shard's
+    (filter metrics, hist metrics)."""
+    params, byte_range = job
+    with STRLocusIterator(byte_range=byte_range, **params) as locus_f:
+        for batch in locus_f.iter_batches():
+            pass
+        return (locus_f.filter_metrics(),
+                [ (d, dict(h)) for d, h in locus_f.hist_metrics() ])
+
+
+def sharded_metrics(params, jobs):
+    """Compute the filter and hist metrics of the summary file
+    params['filename'] with `jobs` worker processes, each reading one byte
+    range.  The merged metrics are exactly those of a single
+    STRLocusIterator(**params) read to the end."""
+    ranges = split_byte_ranges(params['filename'], jobs)
+    pool = Pool(jobs)
+    metrics = pool.map(shard_metrics, [ (params, r) for r in ranges ])
+    pool.close()
+    pool.join()
+    return merge_metrics(metrics)
+
+
+def tally(hist, keys, weights=None):
+    """Add the number of occurrences of each value in the array `keys` to
+    the dict `hist`.  If `weights` is given, add the sum of the weights for
+    each value instead.  Keys are converted back to plain python types so
+    the histograms match those built one locus at a time."""
+    if len(keys) == 0:
+        return
+    keys = numpy.asarray(keys)
+    if keys.dtype.kind in 'iu':
+        # Small integer ranges (mapq, depth, length differences) are
+        # counted directly with bincount instead of sorting.
+        lo, hi = int(keys.min()), int(keys.max())
+        if hi - lo <= 4 * len(keys) + 1024:
+            seen = numpy.bincount(keys - lo) > 0
+            counts = numpy.bincount(keys - lo, weights=weights)
+            uniq = numpy.flatnonzero(seen)
+            for k, n in zip((uniq + lo).tolist(), counts[uniq].tolist()):
+                hist[k] += int(n)
+            return
+
+    uniq, inverse = numpy.unique(keys, return_inverse=True)
+    counts = numpy.bincount(inverse, weights=weights, minlength=len(uniq))
+    for k, n in zip(uniq.tolist(), counts.tolist()):
+        hist[k] += int(n)
+
+
+def count_reads(reads):
+    """Return the number of reads at each locus from the unparsed read
+    columns ('obslens\tstrands\tmapqs...') of each summary line, by
+    counting the commas in the first column."""
+    return numpy.array([ r.count(',', 0, r.index('\t')) + 1
+                         if r[0] != '\t' else 0 for r in reads ], dtype=int)
+
+
+def split_reads(reads):
+    """Parse the unparsed read columns of a list of loci into flat arrays
+    of (obslen, strand, mapq)."""
+    obslens, strands, mapqs = zip(*[ r.split('\t', 2) for r in reads ])
+    obslen = numpy.fromstring(','.join(obslens), dtype=int, sep=',')
+    # Strands are single characters, so every other byte is one
+    strand = numpy.frombuffer(','.join(strands), dtype='S1')[::2] == '+'
+    mapq = numpy.fromstring(','.join(mapqs), dtype=int, sep=',')
+    return (obslen, strand, mapq)
+
+
+class LocusBatch():
+    """A block of loci stored column-wise as numpy arrays.
+
+    Locus metadata are arrays with one entry per locus.  The reads for all
+    loci are stored in three flat arrays (obslen, strand, mapq) with the reads
+    for locus i in the half-open range [offsets[i], offsets[i+1]).  strand is
+    1 for reads on the '+' strand and 0 otherwise."""
+
+    def __init__(self, chrom, start, end, unit, region,
+                 offsets, obslen, strand, mapq):
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.reflen = end - start + 1
+        self.unit = unit
+        self.region = region
+        self.offsets = offsets
+        self.obslen = obslen
+        self.strand = strand
+        self.mapq = mapq
+
+
+    def __len__(self):
+        return len(self.start)
+
+
+    def depth(self):
+        """Number of reads at each locus."""
+        return numpy.diff(self.offsets)
+
+
+    def locus(self, i):
+        """Return locus `i` as the tuple returned by STRLocusIterator.next."""
+        a, b = self.offsets[i], self.offsets[i+1]
+        reads = [ (obs, '+' if fwd else '-', mapq) for obs, fwd, mapq in
+                  zip(self.obslen[a:b].tolist(), self.strand[a:b].tolist(),
+                      self.mapq[a:b].tolist()) ]
+        return (self.chrom[i], int(self.start[i]), int(self.end[i]),
+                self.unit[i], self.region[i], reads)
+
+
 class STRLocusIterator():
     """Iterate over an STR locus file as produced by msitools.
     The line format is tab-delimited:
@@ -39,12 +189,15 @@ class STRLocusIterator():
 
     def __init__(self, filename, min_mapq=0, min_units=0,
                  max_ref_diff=float('+inf'),
-                 min_supp_reads=0, x_only=False, y_only=False):
+                 min_supp_reads=0, x_only=False, y_only=False,
+                 byte_range=None):
         """Filter options:
         min_mapq   -- only consider reads with mapq >= `min_mapq`
         min_units  -- only consider repeat loci with ref_units > `min_units`
         x_only     -- only consider repeat loci on the X chromosome
         y_only     -- only consider repeat loci on the Y chromosome
+        byte_range -- only read the lines in this (start, end) range of byte
+                      offsets, as returned by split_byte_ranges
         """
 
         if x_only and y_only:
@@ -52,6 +205,10 @@ class STRLocusIterator():
 
         self.f = open(filename, 'r')
         self.header = self.f.readline()
+        self.lines = self.f
+        if byte_range:
+            self.f.seek(byte_range[0])
+            self.lines = self.range_lines(byte_range[1])
 
         self.min_mapq = min_mapq
         self.x_only = x_only
@@ -120,9 +277,31 @@ class STRLocusIterator():
         return self
 
 
+    # Implement context guards
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.f.close()
+
+
+    def range_lines(self, end):
+        """Yield lines from the current position until byte offset `end`.
+        readline() is used instead of file iteration so that the position
+        is always known."""
+        pos = self.f.tell()
+        while pos < end:
+            line = self.f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
     def next(self):
         while True:
-            line = self.f.next()
+            line = self.lines.next()
             fields = [ x.strip() for x in line.split('\t') ]
 
             chrom = fields[0].replace('chr', '')
@@ -204,6 +383,140 @@ class STRLocusIterator():
             return (chrom, start, end, ref_unit, region, reads)
 
 
+    def iter_batches(self, n=100000):
+        """Iterate over the remaining loci in blocks, each built from `n`
+        lines of the summary file.  Filters are applied to whole blocks at
+        once, so a block holds at most `n` loci.  Yields LocusBatch objects;
+        the filter and histogram metrics are identical to those accumulated
+        by next()."""
+        while True:
+            lines = list(islice(self.lines, n))
+            if not lines:
+                break
+
+            batch = self.parse_batch(lines)
+            if len(batch) > 0:
+                yield batch
+
+
+    def parse_batch(self, lines):
+        """Parse and filter a list of summary lines into a LocusBatch."""
+        # Only the locus columns are split out.  The three read columns stay
+        # one unparsed string per locus until the locus passes the locus
+        # filters, which only need the number of reads.
+        rows = [ line.split('\t', 5) for line in lines ]
+        (chroms, starts, ends, units, regions, reads) = \
+            [ numpy.array(col, dtype=object) for col in zip(*rows) ]
+        chroms = numpy.array([ c.replace('chr', '') for c in chroms ],
+                             dtype=object)
+        start = numpy.array(starts, dtype=int)
+        end = numpy.array(ends, dtype=int)
+        reflen = end - start + 1
+        raw_reads = count_reads(reads)
+
+        # Need to tally unfiltered totals before any filtering occurs
+        self.total_loci += len(rows)
+        self.total_reads += int(raw_reads.sum())
+
+        keep = numpy.ones(len(rows), dtype=bool)
+        if self.x_only:
+            fail = numpy.array([ not c.endswith('X') for c in chroms ],
+                               dtype=bool)
+            self.loci_x_only_filter += int(fail.sum())
+            self.reads_x_only_filter += int(raw_reads[fail].sum())
+            keep &= ~fail
+
+        if self.y_only:
+            fail = numpy.array([ not c.endswith('Y') for c in chroms ],
+                               dtype=bool)
+            self.loci_y_only_filter += int(fail.sum())
+            self.reads_y_only_filter += int(raw_reads[fail].sum())
+            keep &= ~fail
+
+        n_units = reflen / numpy.array([ float(unit_to_int[u]) for u in units ])
+        fail = keep & (n_units < self.min_units)
+        self.loci_min_units_filter += int(fail.sum())
+        self.reads_min_units_filter += int(raw_reads[fail].sum())
+        keep &= ~fail
+
+        # No reads here
+        keep &= raw_reads > 0
+
+        # Only parse the read lists of loci that survived the locus filters.
+        # All reads are parsed into flat arrays; read_locus maps each read
+        # back to its locus.
+        idx = numpy.flatnonzero(keep)
+        nreads = raw_reads[idx]
+        if len(idx) > 0:
+            obslen, strand, mapq = split_reads(reads[idx])
+        else:
+            obslen = strand = mapq = numpy.array([], dtype=int)
+        if not len(obslen) == len(strand) == len(mapq) == nreads.sum():
+            raise ValueError('read lists differ in length in lines %d-%d' %
+                             (self.total_loci - len(rows) + 1, self.total_loci))
+        read_locus = numpy.repeat(numpy.arange(len(idx)), nreads)
+
+        # Filter by mapQ
+        pass_mq = mapq >= self.min_mapq
+        depth_mq = numpy.bincount(read_locus[pass_mq], minlength=len(idx))
+        self.reads_mapq_filter += int(len(mapq) - pass_mq.sum())
+        self.loci_mapq_filter += int((depth_mq == 0).sum())
+
+        # Filter by difference between ref and obs alleles.  See next().
+        pass_diff = pass_mq & \
+            (abs(obslen - reflen[idx][read_locus]) < self.max_ref_diff)
+        depth = numpy.bincount(read_locus[pass_diff], minlength=len(idx))
+        self.reads_max_ref_diff_filter += int(pass_mq.sum() - pass_diff.sum())
+        self.loci_max_ref_diff_filter += int(((depth_mq > 0) & (depth == 0)).sum())
+
+        # Filter by total supporting reads at the locus
+        fail = (depth > 0) & (depth < self.min_supp_reads)
+        self.loci_min_supp_filter += int(fail.sum())
+        self.reads_min_supp_filter += int(depth[fail].sum())
+
+        # No more filters beyond this point.
+        pf = (depth > 0) & ~fail
+        pf_reads = pass_diff & pf[read_locus]
+        idx = idx[pf]
+        depth = depth[pf]
+        read_locus = numpy.repeat(numpy.arange(len(idx)), depth)
+        obslen = obslen[pf_reads]
+        strand = strand[pf_reads].astype(int)
+        mapq = mapq[pf_reads]
+
+        # Track locus statistics
+        self.pf_loci += len(idx)
+        self.pf_reads += int(depth.sum())
+        tally(self.nsupp_hist, depth)
+        tally(self.chrom_hist, chroms[idx], weights=depth)
+        tally(self.unit_hist, units[idx])
+        tally(self.n_units_hist, n_units[idx])
+        tally(self.reflen_hist, reflen[idx], weights=depth)
+        tally(self.region_hist, regions[idx])
+
+        # Track read statistics
+        tally(self.reflen_diff_hist, obslen - reflen[idx][read_locus])
+        fwd = int(strand.sum())
+        if fwd:
+            self.strand_hist['+'] += fwd
+        if len(strand) - fwd:
+            self.strand_hist['-'] += len(strand) - fwd
+        tally(self.mapq_hist, mapq)
+
+        # Number of unique observed alleles: sort reads by (locus, obslen)
+        # and count the positions where either value changes.
+        order = numpy.lexsort((obslen, read_locus))
+        l, o = read_locus[order], obslen[order]
+        first = numpy.ones(len(l), dtype=bool)
+        first[1:] = (l[1:] != l[:-1]) | (o[1:] != o[:-1])
+        tally(self.nalleles_hist, numpy.bincount(l[first], minlength=len(idx)))
+
+        offsets = numpy.zeros(len(idx) + 1, dtype=int)
+        offsets[1:] = numpy.cumsum(depth)
+        return LocusBatch(chroms[idx], start[idx], end[idx], units[idx],
+                          regions[idx], offsets, obslen, strand, mapq)
+
+
     def filter_metrics(self):
         """Return a list of filter metrics.  (pf = passing filters)"""
         return [
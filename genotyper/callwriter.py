@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+Buffered writer for genotyper calls.
+
+The genotyper produces calls a chunk of loci at a time.  CallWriter formats
+or packs each chunk in one go and writes it with a single call to a file
+opened with a large buffer, so memory use is bounded by the chunk size.  The
+output format is chosen by the file name:
+    None or '-'  -- tab-delimited text on stdout
+    *.gz         -- tab-delimited text, one gzip member per chunk; readable
+                    by zcat and any gzip reader
+    *.callz      -- binary columnar blocks in the style of .strz files (see
+                    strz.py), with a sidecar <file>.callz.idx index
+    anything else -- tab-delimited text
+
+The pval column is the likelihood of the called genotype, the product of
+the per-read probabilities that genotype_locus has always reported.  As a
+double it underflows to 0 at deep loci (a few hundred reads), so calls
+carry its natural log instead (see likelihood.py) and format_pval() prints
+it in the same %.5g notation with as large an exponent as it needs, e.g.
+3.1416e-1234.  .callz files store the log likelihood.
+
+Convert a .callz file back to the text format with:
+    callwriter.py calls.callz > calls.txt
+"""
+
+import sys
+import math
+import shutil
+import numpy
+from argparse import ArgumentParser
+from stagetimer import stages
+from strz import compress, decompress, pack_columns, unpack_columns, \
+                 unit_to_int, int_to_unit
+
+calls_header = "chr\tstart\tend\tref_len\tunit\tregion\tflank1\tflank2\tsequence\traw_alleles\tcall\tgenotype\tpval\tallele_summaries"
+
+# Column order within a .callz block
+callz_columns = [ 'chrom', 'start', 'end', 'unit', 'region', 'flank1',
+                  'flank2', 'seq', 'call', 'gt_a', 'gt_b', 'loglik',
+                  'allele_offsets', 'allele', 'nreads', 'frac_forward',
+                  'mean_mapq' ]
+
+
+def format_alleles(summaries):
+    """Format a summarize_alleles dict for the allele_summaries column."""
+    return " ".join("%d:%d,%.2f,%.2f" % ((k,) + v)
+                    for k, v in summaries.items())
+
+
+def format_pval(loglik):
+    """Format the likelihood exp(`loglik`) as '%.5g' would, without
+    underflowing to 0 when it is too small for a double."""
+    if loglik > -700:
+        # Rounded first, so that likelihoods that are exact as raw products
+        # (e.g. 2**-8) print as they always have rather than one digit off
+        return '%.5g' % float('%.12g' % math.exp(loglik))
+    log10 = loglik / math.log(10)
+    exponent = int(math.floor(log10))
+    mantissa = '%.5g' % 10**(log10 - exponent)
+    if mantissa == '10':
+        mantissa, exponent = '1', exponent + 1
+    return '%se%+03d' % (mantissa, exponent)
+
+
+def format_lines(loci, summaries, calls, a, b, logliks):
+    """Return the text output lines for a chunk of genotyped loci, given the
+    log likelihood of each call."""
+    lines = []
+    for i, (chrom, start, end, reflen, unit, region, flank1, flank2, seq) \
+            in enumerate(loci):
+        alleles = format_alleles(summaries[i])
+        lines.append("%s\t%d\t%d\t%d\t%s\t%s\t%s\t%s\t%s\t%d\t%s\t%d/%d\t%s\t%s" %
+                     (chrom, start, end, reflen, unit, region, flank1, flank2,
+                      seq, len(summaries[i]), calls[i], a[i], b[i],
+                      format_pval(logliks[i]), alleles))
+    return lines
+
+
+def pack_calls(loci, summaries, calls, a, b, logliks):
+    """Return a .callz block payload for a chunk of genotyped loci."""
+    (chroms, starts, ends, reflens, units, regions, flank1s, flank2s,
+        seqs) = zip(*loci)
+    items = [ item for s in summaries for item in s.items() ]
+    offsets = numpy.zeros(len(loci) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([ len(s) for s in summaries ])
+    cols = dict(
+        chrom=numpy.array(chroms, dtype='S'),
+        start=numpy.array(starts, dtype=numpy.int64),
+        end=numpy.array(ends, dtype=numpy.int64),
+        unit=numpy.array([ unit_to_int[u] for u in units ], dtype=numpy.uint8),
+        region=numpy.array(regions, dtype='S'),
+        flank1=numpy.array(flank1s, dtype='S'),
+        flank2=numpy.array(flank2s, dtype='S'),
+        seq=numpy.array(seqs, dtype='S'),
+        call=numpy.array(list(calls), dtype='S3'),
+        gt_a=numpy.asarray(a, dtype=numpy.int32),
+        gt_b=numpy.asarray(b, dtype=numpy.int32),
+        loglik=numpy.asarray(logliks, dtype=float),
+        allele_offsets=offsets,
+        allele=numpy.array([ k for k, v in items ], dtype=numpy.int32),
+        nreads=numpy.array([ v[0] for k, v in items ], dtype=numpy.int32),
+        frac_forward=numpy.array([ v[1] for k, v in items ], dtype=float),
+        mean_mapq=numpy.array([ v[2] for k, v in items ], dtype=float))
+    return pack_columns(cols, callz_columns)
+
+
+def unpack_calls(payload):
+    """Inverse of pack_calls: return the block as a dict of arrays."""
+    return unpack_columns(payload, callz_columns)
+
+
+class ItemList(list):
+    """A list of (key, value) pairs that can stand in for a summaries dict
+    when formatting, preserving the original item order."""
+    def items(self):
+        return self
+
+
+def block_to_lines(block):
+    """Format a .callz block exactly as the text writer would have."""
+    loci = zip(block['chrom'].tolist(), block['start'].tolist(),
+               block['end'].tolist(),
+               (block['end'] - block['start'] + 1).tolist(),
+               [ int_to_unit[u] for u in block['unit'].tolist() ],
+               block['region'].tolist(), block['flank1'].tolist(),
+               block['flank2'].tolist(), block['seq'].tolist())
+    offsets = block['allele_offsets'].tolist()
+    allele, nreads, fwd, mapq = [ block[c].tolist() for c in
+        ('allele', 'nreads', 'frac_forward', 'mean_mapq') ]
+    summaries = [ ItemList((allele[j], (nreads[j], fwd[j], mapq[j]))
+                           for j in range(offsets[i], offsets[i+1]))
+                  for i in range(len(loci)) ]
+    return format_lines(loci, summaries, block['call'].tolist(),
+                        block['gt_a'].tolist(), block['gt_b'].tolist(),
+                        block['loglik'].tolist())
+
+
+def read_callz(filename):
+    """Iterate over the blocks of a .callz file."""
+    with open(filename, 'rb') as f, open(filename + '.idx', 'r') as idx:
+        idx.readline()  # skip header
+        for line in idx:
+            offset, length = [ int(x) for x in line.split('\t')[4:6] ]
+            f.seek(offset)
+            yield unpack_calls(decompress(f.read(length)))
+
+
+class CallWriter():
+    """Write chunks of calls to `filename` (see the module docstring for
+    formats).  The header is written first unless `header`=False.  If
+    `resume` is a pair of file sizes returned by flush(), the existing file
+    is cut back to that point and continued instead."""
+
+    def __init__(self, filename=None, header=True, buffer_size=1 << 22,
+                 resume=None):
+        if filename is None or filename == '-':
+            self.fmt = 'text'
+            self.f = sys.stdout
+        else:
+            if filename.endswith('.gz'):
+                self.fmt = 'gz'
+            elif filename.endswith('.callz'):
+                self.fmt = 'callz'
+            else:
+                self.fmt = 'text'
+            self.f = open(filename, 'r+b' if resume else 'wb', buffer_size)
+        self.filename = filename
+
+        self.idx = None
+        if resume:
+            self.f.seek(resume[0])
+            self.f.truncate()
+            if self.fmt == 'callz':
+                self.idx = open(filename + '.idx', 'r+')
+                self.idx.seek(resume[1])
+                self.idx.truncate()
+        elif self.fmt == 'callz':
+            self.idx = open(filename + '.idx', 'w')
+            self.idx.write(calls_header + "\n")
+        elif header:
+            self.write_text(calls_header + "\n")
+
+
+    def write_text(self, text):
+        self.f.write(compress(text) if self.fmt == 'gz' else text)
+
+
+    def write(self, loci, summaries, calls, a, b, logliks):
+        """Write one chunk of genotyped loci.  The arguments are parallel
+        lists/arrays as returned by genotyper.call_loci."""
+        if len(loci) == 0:
+            return
+
+        with stages.time('write'):
+            if self.fmt == 'callz':
+                data = compress(pack_calls(loci, summaries, calls, a, b,
+                                           logliks))
+                self.idx.write("%s\t%d\t%s\t%d\t%d\t%d\t%d\n" %
+                               (loci[0][0], loci[0][1], loci[-1][0],
+                                loci[-1][1], self.f.tell(), len(data),
+                                len(loci)))
+                self.f.write(data)
+            else:
+                lines = format_lines(loci, summaries, calls, a, b, logliks)
+                self.write_text("\n".join(lines) + "\n")
+
+
+    def append(self, filename):
+        """Append the calls in `filename`, written by a CallWriter of the
+        same format with header=False."""
+        if self.fmt == 'callz':
+            base = self.f.tell()
+            with open(filename + '.idx', 'r') as idx:
+                idx.readline()  # skip header
+                for line in idx:
+                    fields = line.split('\t')
+                    fields[4] = str(int(fields[4]) + base)
+                    self.idx.write('\t'.join(fields))
+
+        with open(filename, 'rb') as f:
+            shutil.copyfileobj(f, self.f, 1 << 20)
+
+
+    def flush(self):
+        """Write out all buffered calls and return the sizes of the calls
+        and index files, which can be given as `resume` to continue the
+        file from this point."""
+        self.f.flush()
+        if self.idx:
+            self.idx.flush()
+        return (self.f.tell(), self.idx.tell() if self.idx else 0)
+
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+        else:
+            self.f.flush()
+        if self.idx:
+            self.idx.close()
+
+
+    # Implement context guards
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Print a .callz file as text.')
+    parser.add_argument('callz', help='binary calls file')
+    args = parser.parse_args()
+
+    print(calls_header)
+    for block in read_callz(args.callz):
+        lines = block_to_lines(block)
+        if lines:
+            print("\n".join(lines))
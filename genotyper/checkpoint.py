@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Checkpoints for long genotyper runs.
+
+A run given --resume records its progress in <output>.ckpt after every chunk
+of loci: whether the error profile has been saved, how far it has read the
+STR summary (a byte offset, or the number of regions finished by call
+--jobs), the filter metrics so far and the size of the calls flushed to
+<output>.  If the run is killed, running the same command again continues
+from the last checkpoint: <output> is cut back to the checkpointed size,
+reading resumes where the checkpoint left off and the new calls are
+appended.  The result is identical to that of an uninterrupted run.  The
+checkpoint is removed when the run finishes.
+"""
+
+import os
+import cPickle
+from callwriter import CallWriter
+
+
+class Checkpoint():
+    """The checkpoint of a run writing calls to `output`, loaded from
+    <output>.ckpt if it exists.  `params` describes the run; resuming a
+    checkpoint saved by a run with other params raises ValueError."""
+
+    def __init__(self, output, params):
+        self.output = output
+        self.filename = output + '.ckpt'
+        self.state = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                self.state = cPickle.load(f)
+            if self.state['params'] != params:
+                raise ValueError('%s was saved by a run with different '
+                                 'parameters; remove it to start over' %
+                                 self.filename)
+        self.state['params'] = params
+
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+
+    def save(self, **state):
+        """Add `state` to the checkpoint and write it.  The old checkpoint
+        is replaced by a rename, so a run killed while saving still leaves
+        a usable checkpoint."""
+        self.state.update(state)
+        with open(self.filename + '.tmp', 'wb') as f:
+            cPickle.dump(self.state, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+    def writer(self):
+        """Return a CallWriter for the output that continues from the last
+        checkpointed calls, if any."""
+        return CallWriter(self.output, resume=self.get('calls'))
+
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
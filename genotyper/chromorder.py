@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Chromosome order of tab-delimited files sorted in reference order, such as
+msitools STR summaries and genotyper calls files, whose first column is the
+chromosome and whose first line is a header.
+
+Tools that merge several such files (multigenotyper.py, join_loci.py) and
+those that split one by chromosome (genotyper.py) need the order of the
+chromosomes before they read any loci.  scan_chroms() finds it without
+reading the file through when it can: .strz files and files with a
+summaryindex.py index list their chromosomes, and the loci of a chromosome
+are contiguous, so in a plain file the end of each chromosome is found by
+bisecting byte offsets.  Gzipped files cannot seek and are read through
+once.  merge_chrom_orders() combines the orders of several files.
+"""
+
+import os
+import gzip
+from strz import is_strz, StrzReader
+from summaryindex import SummaryIndex
+
+
+def line_at(f, offset):
+    """Return (offset, chrom) of the first line of the open file `f` that
+    starts at or after `offset` > 0, or (None, None) past the last line."""
+    f.seek(offset - 1)
+    f.readline()
+    start = f.tell()
+    line = f.readline()
+    if not line:
+        return (None, None)
+    return (start, line[:line.index('\t')])
+
+
+def scan_chroms(filename):
+    """Return a list of (chrom, byte offset of the first locus on chrom) for
+    each chromosome in `filename`, in file order.  The offsets of .strz and
+    gzipped files cannot be seeked to and are always 0."""
+    if is_strz(filename):
+        reader = StrzReader(filename)
+        reader.close()
+        return [ (chrom, 0) for chrom in reader.chroms() ]
+    if filename.endswith('.gz'):
+        chroms = []
+        with gzip.open(filename, 'rb') as f:
+            f.readline()
+            for line in f:
+                chrom = line[:line.index('\t')]
+                if not chroms or chroms[-1][0] != chrom:
+                    chroms.append((chrom, 0))
+        return chroms
+    if SummaryIndex.exists(filename):
+        return SummaryIndex(filename).chroms()
+
+    chroms = []
+    size = os.path.getsize(filename)
+    with open(filename, 'r') as f:
+        offset, chrom = line_at(f, len(f.readline()))
+        while chrom is not None:
+            chroms.append((chrom, offset))
+            # line_at(lo) is on chrom and line_at(hi) is not
+            lo, hi = offset, size
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if line_at(f, mid)[1] == chrom:
+                    lo = mid
+                else:
+                    hi = mid
+            offset, chrom = line_at(f, hi)
+    return chroms
+
+
+def merge_chrom_orders(orders):
+    """Merge lists of chromosomes, each in file order, into one order
+    consistent with all of them.  A chromosome missing from the earlier
+    lists goes right after the chromosome preceding it in its own list.
+    Raises ValueError if two lists order the same chromosomes differently."""
+    merged = []
+    for order in orders:
+        pos = 0
+        for chrom in order:
+            if chrom in merged:
+                i = merged.index(chrom)
+                if i < pos:
+                    raise ValueError('the files order chromosome %s '
+                                     'differently; give the order with '
+                                     '--chroms' % chrom)
+                pos = i + 1
+            else:
+                merged.insert(pos, chrom)
+                pos += 1
+    return merged
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Mergeable STR polymorphism error profiles.
+
+An error profile holds, for each (repeat unit, reference length), four
+counts: total reads, likely erroneous reads, total loci and likely
+erroneous loci (see genotyper.estimate_error).  Counts from different
+chromosomes, lanes or chunks of a summary file simply add, so profiles
+built in parallel can be merged into exactly the profile a single pass
+would have produced.
+
+A profile also keeps a stutter histogram: for each (unit, reflen), the
+number of reads at each step (allele - primary allele, in bp) from the
+primary allele of a hemizygous locus.  See errortable.StutterTable.
+
+The file format is the one genotyper.py has always written: one line per
+(unit, reflen) with the raw counts and the derived percentages.  Only the
+counts are read back, so a saved profile reloads exactly.  The stutter
+histogram, if the profile has one, is written beside it as <file>.stutter
+with one line per (unit, reflen, step).
+
+Merge saved profiles with:
+    errorprofile.py merged_profile.txt profile1.txt profile2.txt ...
+"""
+
+import os
+from tempfile import mkstemp
+from collections import defaultdict
+from argparse import ArgumentParser
+from numpy import array
+
+unit_to_int = { 'mono':1, 'di':2, 'tri':3, 'tetra':4 }
+
+
+def reflen_counts():
+    return defaultdict(lambda: array([0, 0, 0, 0]))
+
+
+def step_counts():
+    return defaultdict(lambda: defaultdict(int))
+
+
+def stutter_filename(filename):
+    return filename + '.stutter'
+
+
+def write_atomically(filename, write, mode='w'):
+    """Call write(f) on a new file and move it into place as `filename`, so
+    readers never see a partial file.  Each writer has its own temporary
+    file in the same directory, so processes writing the same file at once
+    do not clobber each other's output."""
+    fd, tmp = mkstemp(dir=os.path.dirname(filename) or '.',
+                      prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        # mkstemp creates the file readable only by its owner
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+
+class ErrorProfile(defaultdict):
+    """dict(unit -> dict(reflen -> array of (total reads, likely erroneous
+    reads, total loci, likely erroneous loci))).  Missing entries read as
+    zero counts, so counts can be added with profile[unit][reflen] += x.
+    The stutter histogram is self.stutter:
+        dict(unit -> dict(reflen -> dict(step -> reads)))."""
+
+    def __init__(self, *args):
+        defaultdict.__init__(self, reflen_counts, *args)
+        self.stutter = defaultdict(step_counts)
+
+
+    def add(self, unit, reflen, counts):
+        """Add the four counts `counts` at (unit, reflen)."""
+        self[unit][reflen] += counts
+
+
+    def add_stutter(self, unit, reflen, steps):
+        """Add a list of (step, reads) to the stutter histogram."""
+        hist = self.stutter[unit][reflen]
+        for step, n in steps:
+            hist[step] += n
+
+
+    def merge(self, other):
+        """Add all of the counts in `other` to this profile and return it."""
+        for unit, profiles in other.items():
+            for reflen, counts in profiles.items():
+                self.add(unit, reflen, counts)
+        for unit, hists in other.stutter.items():
+            for reflen, hist in hists.items():
+                self.add_stutter(unit, reflen, hist.items())
+        return self
+
+
+    def save(self, filename):
+        """Write the profile to `filename` and its stutter histogram, if it
+        has one, beside it.  Both files are moved into place once complete,
+        the profile last, so once `filename` exists the profile is
+        complete."""
+        def write_stutter(f):
+            f.write("unit\treflen\tstep\treads\n")
+            for unit in sorted(self.stutter.keys(), key=lambda x: unit_to_int[x]):
+                for reflen in sorted(self.stutter[unit].keys()):
+                    hist = self.stutter[unit][reflen]
+                    for step in sorted(hist.keys()):
+                        f.write("%s\t%d\t%d\t%d\n" %
+                                (unit, reflen, step, hist[step]))
+
+        if any(hist for hists in self.stutter.values()
+                    for hist in hists.values()):
+            write_atomically(stutter_filename(filename), write_stutter)
+        elif os.path.exists(stutter_filename(filename)):
+            # Left by an earlier profile; it does not belong to this one
+            os.remove(stutter_filename(filename))
+
+        def write_profile(f):
+            f.write("unit\treflen\terror_reads\ttotal_reads\tpercent_error_reads\terror_loci\ttotal_loci\tpercent_error_loci\n")
+            for unit in sorted(self.keys(), key=lambda x: unit_to_int[x]):
+                for reflen in sorted(self[unit].keys()):
+                    x = self[unit][reflen]
+                    f.write("%s\t%d\t%d\t%d\t%.3f\t%d\t%d\t%.3f\n" % \
+                            (unit, reflen, x[1], x[0], float(x[1])/x[0],
+                             x[3], x[2], float(x[3])/x[2]))
+        write_atomically(filename, write_profile)
+
+
+    @staticmethod
+    def load(filename):
+        """Read a profile written by save().  Profiles saved before the
+        stutter histogram was added load with an empty histogram."""
+        profile = ErrorProfile()
+        with open(filename, 'r') as f:
+            f.readline()  # skip header
+            for line in f:
+                fields = [ x.strip() for x in line.split('\t') ]
+                unit, reflen, err_reads, tot_reads = fields[0:4]
+                err_loci, tot_loci = fields[5:7]
+                profile.add(unit, int(reflen),
+                            array([ int(tot_reads), int(err_reads),
+                                    int(tot_loci), int(err_loci) ]))
+
+        if os.path.exists(stutter_filename(filename)):
+            with open(stutter_filename(filename), 'r') as f:
+                f.readline()  # skip header
+                for line in f:
+                    unit, reflen, step, n = line.split('\t')
+                    profile.add_stutter(unit, int(reflen),
+                                        [ (int(step), int(n)) ])
+        return profile
+
+
+def merge_files(filenames):
+    """Load and merge the saved profiles `filenames`."""
+    profile = ErrorProfile()
+    for filename in filenames:
+        profile.merge(ErrorProfile.load(filename))
+    return profile
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Merge saved error profiles.')
+    parser.add_argument('output', metavar='merged_profile',
+        help='File to which the merged profile is written')
+    parser.add_argument('profiles', metavar='profile', nargs='+',
+        help='Error profiles written by genotyper.py')
+    args = parser.parse_args()
+
+    merge_files(args.profiles).save(args.output)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+Dense lookup table of per-read STR polymorphism error rates.
+
+An error profile (see genotyper.profile_error_distn) only has entries for
+the reference lengths that were observed on the sex chromosomes.  ErrorTable
+compiles it once into one row per repeat unit, indexed by reference length,
+so that error rates for many loci can be looked up with a single numpy
+indexing operation.  StutterTable does the same for the distribution of
+stutter steps, giving a (unit, reference length, step) tensor.
+
+The compiled tables of a saved profile can be written beside it as .npy
+files (see ErrorTable.compile).  Processes that ErrorTable.attach() them
+memory-map the files read-only, so attaching takes constant time and all
+processes on a node share one copy of the tables through the page cache.
+"""
+
+import os
+import numpy
+from errorprofile import ErrorProfile, stutter_filename, write_atomically
+
+unit_to_int = { 'mono':1, 'di':2, 'tri':3, 'tetra':4 }
+
+
+def unit_codes(units):
+    """Convert an array of unit names (or unit_to_int codes) to codes."""
+    return numpy.array([ unit_to_int.get(u, 0) if isinstance(u, str) else u
+                         for u in units ], dtype=int)
+
+
+def table_filename(profile_filename, interpolate=False):
+    """Name of the compiled error rates of a saved profile."""
+    return profile_filename + ('.interp' if interpolate else '.nearest') + \
+           '.npy'
+
+
+def stutter_table_filename(profile_filename):
+    """Name of the compiled stutter table of a saved profile."""
+    return profile_filename + '.stutter.npy'
+
+
+def save_table(table, filename):
+    """Write `table` to the .npy file `filename`.  The file is moved into
+    place once complete, so processes attaching it never see a partial
+    table."""
+    write_atomically(filename, lambda f: numpy.save(f, table), 'wb')
+
+
+def up_to_date(filename, sources):
+    """True if `filename` exists and is newer than each existing file in
+    `sources`."""
+    return os.path.exists(filename) and \
+        all(os.path.getmtime(filename) >= os.path.getmtime(f)
+            for f in sources if os.path.exists(f))
+
+
+def nearest_reflen(reflens, reflen):
+    """Return the element of `reflens` closest to `reflen`.  Ties go to the
+    first in iteration order, as they did when the genotyper looked up
+    each locus in the profile."""
+    m = min(abs(reflen - l) for l in reflens)
+    return [ l for l in reflens if abs(reflen - l) == m ][0]
+
+
+class ErrorTable():
+    """Error rates for every (unit, reference length).  Gaps between the
+    observed reference lengths are filled with the rate of the nearest
+    observed length or, if `interpolate`=True, by linear interpolation
+    between its two neighbours.  Longer reference lengths than any observed
+    use the rate of the longest.  Rates are never lower than `default`,
+    which is also used for units that were never observed.
+
+    If `stutter`=True, a StutterTable is also built from the profile's
+    stutter histogram and kept in self.stutter (otherwise None).
+
+    `errors` and `stutter` may instead be tables already compiled by an
+    ErrorTable and a StutterTable, as done by attach()."""
+
+    def __init__(self, errors, default=0.01, interpolate=False, stutter=False):
+        self.default = default
+        if isinstance(stutter, numpy.ndarray):
+            self.stutter = StutterTable(stutter)
+        else:
+            self.stutter = StutterTable(errors.stutter) if stutter else None
+        if isinstance(errors, numpy.ndarray):
+            self.table = errors
+            return
+
+        maxlen = max([ max(v.keys()) for v in errors.values() if v ] + [0])
+        self.table = numpy.empty((max(unit_to_int.values()) + 1, maxlen + 1))
+        self.table.fill(default)
+
+        for unit, profiles in errors.items():
+            if not profiles:
+                continue
+
+            rate = dict((l, max(default, float(x[1])/x[0]))
+                        for l, x in profiles.items())
+            row = self.table[unit_to_int[unit]]
+            if interpolate:
+                observed = sorted(rate.keys())
+                row[:] = numpy.interp(numpy.arange(maxlen + 1), observed,
+                                      [ rate[l] for l in observed ])
+            else:
+                row[:] = [ rate[l] if l in rate else
+                           rate[nearest_reflen(profiles.keys(), l)]
+                           for l in range(maxlen + 1) ]
+
+
+    def lookup(self, units, reflens):
+        """Return an array of error rates for arrays of unit names (or
+        unit_to_int codes) and reference lengths."""
+        reflens = numpy.minimum(numpy.asarray(reflens, dtype=int),
+                                self.table.shape[1] - 1)
+        return self.table[unit_codes(units), reflens]
+
+
+    @staticmethod
+    def compile(profile_filename, interpolate=False, stutter=False):
+        """Compile the profile saved in `profile_filename` and write its
+        tables beside it for attach(), unless they are already newer than
+        the profile."""
+        errors_file = table_filename(profile_filename, interpolate)
+        stutter_file = stutter_table_filename(profile_filename)
+        sources = [ profile_filename, stutter_filename(profile_filename) ]
+        if up_to_date(errors_file, sources) and \
+                (not stutter or up_to_date(stutter_file, sources)):
+            return
+
+        table = ErrorTable(ErrorProfile.load(profile_filename),
+                           interpolate=interpolate, stutter=stutter)
+        save_table(table.table, errors_file)
+        if stutter:
+            save_table(table.stutter.table, stutter_file)
+
+
+    @staticmethod
+    def attach(profile_filename, interpolate=False, stutter=False):
+        """Return an ErrorTable whose tables are memory-mapped read-only
+        from the files written by compile()."""
+        return ErrorTable(
+            numpy.load(table_filename(profile_filename, interpolate),
+                       mmap_mode='r'),
+            stutter=numpy.load(stutter_table_filename(profile_filename),
+                               mmap_mode='r') if stutter else False)
+
+
+class StutterTable():
+    """Relative frequency of each stutter step (observed allele - true
+    allele, in bp) for every (unit, reference length), compiled from the
+    stutter histogram of an ErrorProfile into a dense tensor.  table[u, l]
+    holds the frequencies of steps -max_delta..max_delta; longer steps are
+    counted in the outermost bins.  Every step gets `pseudocount` extra
+    reads, so steps never seen on the sex chromosomes are unlikely rather
+    than impossible.  Reference lengths without data use the nearest
+    observed length, and units without data get a flat distribution, which
+    is the original uniform error model.  Step 0 is not an error and has
+    frequency 0.  `stutter` may instead be an already compiled table."""
+
+    def __init__(self, stutter, max_delta=40, pseudocount=1.0):
+        if isinstance(stutter, numpy.ndarray):
+            self.table = stutter
+            self.max_delta = (stutter.shape[2] - 1) // 2
+            return
+
+        self.max_delta = max_delta
+        maxlen = max([ max(v.keys()) for v in stutter.values() if v ] + [0])
+        self.table = numpy.ones((max(unit_to_int.values()) + 1, maxlen + 1,
+                                 2 * max_delta + 1))
+
+        for unit, hists in stutter.items():
+            if not hists:
+                continue
+
+            rows = {}
+            for reflen, hist in hists.items():
+                rows[reflen] = numpy.zeros(2 * max_delta + 1) + pseudocount
+                for step, n in hist.items():
+                    rows[reflen][min(max(step, -max_delta), max_delta) +
+                                 max_delta] += n
+            self.table[unit_to_int[unit]] = [
+                rows[l] if l in rows else rows[nearest_reflen(hists.keys(), l)]
+                for l in range(maxlen + 1) ]
+
+        self.table[:, :, max_delta] = 0
+        self.table /= self.table.sum(axis=2)[:, :, None]
+
+
+    def lookup(self, units, reflens):
+        """Return an (L, 2 * max_delta + 1) array of step frequencies for
+        arrays of L unit names (or codes) and reference lengths."""
+        reflens = numpy.minimum(numpy.asarray(reflens, dtype=int),
+                                self.table.shape[1] - 1)
+        return self.table[unit_codes(units), reflens]
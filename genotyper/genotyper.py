@@ -9,25 +9,60 @@ chromosomes, so the genotyper will only have an empirical error distribution
 when:
     1. the sample is male and
     2. data exists for the X and Y chromosomes
-This means that one CANNOT parallelize genotyping by chromosome.  That could
-be enabled by separating the error profile logic into a separate program, but
-it has not yet been necessary for me.
+This means that genotyping cannot be parallelized by chromosome unless the
+error profile is built first.  There are three subcommands:
+    run     -- profile and genotype the whole summary file in one job.  By
+               default the file is read twice: once to profile the X and Y
+               loci and once more to genotype every locus.  --single-pass
+               reads it only once, buffering the allele summaries of every
+               locus until the error profile is complete (in memory, or in a
+               temporary file with --spill).
+    profile -- build the error profile and save it.  Profiles of separate
+               regions or files can be built in parallel and merged (see
+               errorprofile.py) or accumulated with --update.
+    call    -- load a saved error profile and genotype one or more regions.
+               With --jobs N, regions (by default, every chromosome) are
+               genotyped by N worker processes and the calls are merged in
+               reference order.
+With --stutter-model, run and call weigh erroneous reads by the size of
+their step from the true allele, using the stutter histogram collected from
+the same hemizygous loci (see errortable.StutterTable).
+Calls go to stdout unless --output is given; see callwriter.py for the
+gzipped (.gz) and binary (.callz) output formats.  The pval column is the
+likelihood of the call, computed in log space so that it does not underflow
+to 0 at deep loci.  With --resume, run and call checkpoint their progress
+beside --output and a rerun of a killed job continues where it stopped (see
+checkpoint.py); profile --resume keeps an existing profile and so cannot be
+combined with --update.  --profile-stages records the time spent reading,
+parsing and filtering loci and reads, summarizing alleles, looking up error
+rates, genotyping and writing calls, along with loci/sec and reads/sec (see
+stagetimer.py).
 """
 
 import sys
+import resource
+import os
+import cPickle
+from multiprocessing import Pool
+from tempfile import TemporaryFile, NamedTemporaryFile
 from argparse import ArgumentParser
-from strlocusiterator import STRLocusIterator
-from collections import defaultdict
-from itertools import product
-from numpy import array, prod
-from scipy.stats import binom_test
-from operator import itemgetter
-
-
-unit_to_int = { 'mono':1, 'di':2, 'tri':3, 'tetra':4 }
-
-
-def profile_error_distn(lw_params, is_single_cell=False):
+from strlocusiterator import STRLocusIterator, parse_region
+from collections import defaultdict, OrderedDict
+from itertools import islice
+import numpy
+from numpy import array
+from likelihood import genotype_loci, allele_matrices
+from errortable import ErrorTable
+from errorprofile import ErrorProfile
+from chromorder import scan_chroms
+from callwriter import CallWriter
+from checkpoint import Checkpoint
+from stagetimer import stages, stages_filename
+from stuttertest import binom_test_half
+
+
+def profile_error_distn(lw_params, is_single_cell=False, regions=None,
+                        errors=None):
     """Create a profile of likely erroneous read -> STR allele mappings.
     The method works by examining STR polymorphisms on hemizygous sex
     chromosomes (e.g., depends on the subject being male). At each locus:
@@ -42,136 +77,382 @@ def profile_error_distn(lw_params, is_single_cell=False):
     This process produces 4 counts: the number of non-error-mode reads and
     loci and the number of error-mode reads and loci.  These counts are
     further subdivided by STR unit type (mono, di, ...) and length of the
-    reference allele.  (They could even further be divided by length of the
-    alternate allele, since +1/-1 polymorphisms should be more likely to
-    occur by random error than +2/-2 polymorphisms and so on.)
+    reference allele.  The reads of every allele are also counted by their
+    step from the nearest primary allele (see estimate_stutter), since +1/-1
+    polymorphisms should be more likely to occur by random error than +2/-2
+    polymorphisms and so on.
 
     If my understanding is correct, this should mostly explain variability
     due to polymerase slippage, but other effects will be captured.
 
     Allow only a single primary allele by disabling the binomial model in
-    estimate_error if `is_single_cell`=True."""
-    errors = defaultdict(lambda: defaultdict(lambda: array([0, 0, 0, 0])))
-
-    with STRLocusIterator(hemizygous_only=True, **lw_params) as locus_f:
-        for (chrom, start, end, reflen, unit, region, flank1, flank2, seq, reads) in locus_f:
-            summaries = summarize_alleles(reads, reflen)
-            errors[unit][reflen] += \
-                estimate_error(summaries, use_binom=not is_single_cell)
+    estimate_error if `is_single_cell`=True.
+
+    Only loci in `regions` (default: the whole file) are profiled.  The
+    counts are added to `errors`, an ErrorProfile, if given, so that a
+    profile can be extended as new data arrives."""
+    if errors is None:
+        errors = ErrorProfile()
+
+    for region in regions or [ None ]:
+        with STRLocusIterator(hemizygous_only=True, region=region,
+                              **lw_params) as locus_f:
+            for batch in locus_f.iter_batches(10000):
+                summaries = summarize_batch(batch)
+                with stages.time('estimate_error'):
+                    for (chrom, start, end, reflen, unit, region, flank1,
+                            flank2, seq), s in zip(batch.info(), summaries):
+                        errors.add(unit, reflen, estimate_error(s,
+                                       use_binom=not is_single_cell))
+                        errors.add_stutter(unit, reflen, estimate_stutter(
+                            s, use_binom=not is_single_cell))
 
     # dict(unit -> dict(reflen ->
     # (total reads, likely erroneous reads, total loci, likely erroneous loci)))
     return errors
 
 
-def get_error_estimate(errors, unit, reflen, default=0.01):
-    # This should rarely happen, but handle it when it does
-    if not unit in errors.keys():
-        return default
-
-    if reflen in errors[unit].keys():
-        profile = errors[unit][reflen]
-    else:
-        # We may not have seen any instances of a particular reference length
-        # when profiling the sex chromosomes.  Use the nearest reference length.
-        diffs = [ abs(reflen - l) for l in errors[unit].keys() ]
-        m = min(diffs)
-        nearest = [ l for l in errors[unit].keys() if abs(reflen - l) == m ][0]
-        profile = errors[unit][nearest]
-
-    tot_reads, err_reads = profile[0:2]
-    return max(default, float(err_reads)/tot_reads)
-
-
-def save_error_distn(error_distn_file, errors):
-    with open(error_distn_file, 'w') as f:
-        f.write("unit\treflen\terror_reads\ttotal_reads\tpercent_error_reads\terror_loci\ttotal_loci\tpercent_error_loci\n")
-        for unit in sorted(errors.keys(), key=lambda x: unit_to_int[x]):
-            for reflen in sorted(errors[unit].keys()):
-                x = errors[unit][reflen]
-                f.write("%s\t%d\t%d\t%d\t%.3f\t%d\t%d\t%.3f\n" % \
-                        (unit, reflen, x[1], x[0], float(x[1])/x[0],
-                         x[3], x[2], float(x[3])/x[2]))
-
-
-# The function from itertools in python 2.7+
-def combinations_with_replacement(iterable, r):
-    pool = tuple(iterable)
-    n = len(pool)
-    for indices in product(range(n), repeat=r):
-        if sorted(indices) == list(indices):
-            yield tuple(pool[i] for i in indices)
-
-
-def summarize_alleles(reads, reflen):
-    """`reads` is a list of (obs len, strand, mapq) tuples each describing
-    a single read.
-    `reflen` is the length of the STR in the reference genome."""
-    # Map: observed len -> (num reads, num forward strand, sum mapq)
-    metrics = defaultdict(lambda: array([0, 0, 0]))
-    for obs, strand, mapq in reads:
-        metrics[obs - reflen] += array([ 1, 1 if strand == '+' else 0, mapq ])
-
-    return dict((k, (n, float(nforward) / n, float(summapq) / n))
-                for k, (n, nforward, summapq) in metrics.iteritems())
+def summarize_alleles(obslen, strand, mapq, reflen):
+    """`obslen`, `strand` and `mapq` are parallel arrays describing the
+    reads at a locus: observed STR length, 1 for '+' strand reads (else 0)
+    and mapping quality.
+    `reflen` is the length of the STR in the reference genome.
+    Returns a dict: (obs len - reflen) -> (num reads, fraction of reads on
+    the forward strand, mean mapq)."""
+    return summarize_loci([0, len(obslen)], obslen, strand, mapq, [reflen])[0]
+
+
+def summarize_batch(batch):
+    """summarize_alleles for every locus in a LocusBatch."""
+    with stages.time('summarize_alleles'):
+        return summarize_loci(batch.offsets, batch.obslen, batch.strand,
+                              batch.mapq, batch.reflen)
+
+
+def summarize_loci(offsets, obslen, strand, mapq, reflen):
+    """summarize_alleles for many loci at once.  The reads of locus i are
+    [offsets[i], offsets[i+1]) of the flat read arrays and `reflen` has one
+    entry per locus.  Returns a list of dicts.
+
+    Reads are grouped by (locus, allele) with one sort and summed with
+    bincount.  Each dict's keys are inserted in order of their first read,
+    exactly as when reads were added to a dict one at a time, because
+    genotype_loci breaks ties by dict iteration order."""
+    offsets = numpy.asarray(offsets, dtype=int)
+    depth = numpy.diff(offsets)
+    read_locus = numpy.repeat(numpy.arange(len(depth)), depth)
+    diff = numpy.asarray(obslen) - numpy.repeat(reflen, depth)
+
+    # lexsort is stable, so the first read of each group is its earliest
+    order = numpy.lexsort((diff, read_locus))
+    l, d = read_locus[order], diff[order]
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = (l[1:] != l[:-1]) | (d[1:] != d[:-1])
+    group = numpy.cumsum(first) - 1
+    n = numpy.bincount(group).tolist()
+    nforward = numpy.bincount(group, weights=numpy.asarray(strand)[order])
+    summapq = numpy.bincount(group, weights=numpy.asarray(mapq)[order])
+
+    # Visit groups in order of first appearance; reads of a locus are
+    # contiguous, so this also visits loci in order.
+    by_appearance = numpy.argsort(order[first], kind='mergesort')
+    group_locus = l[first][by_appearance].tolist()
+    group_diff = d[first][by_appearance].tolist()
+    by_appearance = by_appearance.tolist()
+    nforward = nforward.tolist()
+    summapq = summapq.tolist()
+
+    summaries = [ {} for i in range(len(depth)) ]
+    for i, k, g in zip(group_locus, group_diff, by_appearance):
+        summaries[i][k] = (n[g], nforward[g] / n[g], summapq[g] / n[g])
+    # Rebuild each dict the way the per-read version built its result from
+    # an accumulating dict, so iteration orders match.
+    return [ dict(s.iteritems()) for s in summaries ]
 
 
 def genotype_locus(alleles, err=0.01):
     """`err` is probability of an STR polymorphism error in a single read,
     conditioned on the repeat unit length (mono, di, ...) and the reference
     length of the STR.  Shorter repeat units and longer reference lengths
-    should correspond to increased error rates."""
-    # Try every possible selection of 2 alleles from the set
-    gts = list(combinations_with_replacement(alleles.keys(), 2))
-
-    def hap_prob(x, Nalleles, haptype, err):
-        return 1 - err if x == haptype else err/(Nalleles - 1)
-
-    def dip_prob(alleles, hapA, hapB, err):
-        return prod([ (hap_prob(k, len(alleles), hapA, err)/2 + \
-                       hap_prob(k, len(alleles), hapB, err)/2)**n
-                      for k, (n, _1, _2) in alleles.iteritems() ])
+    should correspond to increased error rates.
+
+    Genotype a single locus; see likelihood.genotype_loci for the model."""
+    allele_mat, counts = allele_matrices([alleles])
+    calls, a, b, loglik, lik = genotype_loci(allele_mat, counts, [err])
+    return (calls[0], lik[0], "%d/%d" % (a[0], b[0]))
+
+
+def call_loci(loci, summaries, error_table):
+    """Genotype a chunk of loci.  Each locus is the (chrom, start, end,
+    reflen, unit, region, flank1, flank2, seq) prefix of an STRLocusIterator
+    tuple and `summaries` holds the summarize_alleles result for each locus.
+    Error rates are looked up in `error_table`, an ErrorTable, along with
+    stutter step frequencies if it has a StutterTable.  Returns the
+    arguments expected by CallWriter.write, with the log likelihood of each
+    call for its pval."""
+    allele_mat, counts = allele_matrices(summaries)
+    stages.count('loci', len(loci))
+    stages.count('reads', counts.sum())
+    with stages.time('get_error_estimate'):
+        units, reflens = [ l[4] for l in loci ], [ l[3] for l in loci ]
+        err = error_table.lookup(units, reflens)
+        weights = None
+        if error_table.stutter is not None:
+            weights = error_table.stutter.lookup(units, reflens)
+    with stages.time('genotype_locus'):
+        calls, a, b, loglik, lik = genotype_loci(allele_mat, counts, err,
+                                                 weights)
+    return (loci, summaries, calls, a, b, loglik)
+
+
+def chunks(iterable, n):
+    """Yield lists of up to `n` consecutive items from `iterable`."""
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def save_filter_metrics(filter_metrics_file, filter_metrics, hist_metrics):
+    with open(filter_metrics_file, 'w') as f:
+        for (description, value) in filter_metrics:
+            f.write("%s\t%d\n" % (description, value))
+
+        for (description, hist) in hist_metrics:
+            f.write(description + "\n")
+            for k in sorted(hist.keys()):
+                f.write("%s\t%d\n" % (k, hist[k]))
+
+
+def iterator_metrics(locus_f):
+    """Return the (filter metrics, hist metrics) of an STRLocusIterator."""
+    return (locus_f.filter_metrics(),
+            [ (d, dict(h)) for d, h in locus_f.hist_metrics() ])
+
+
+def genotype(lw_params, filter_metrics_file, error_table, writer,
+             chunk_size=10000, checkpoint=None):
+    """Genotype all loci in the STR locus file specified by lw_params using
+    the error rates in `error_table`, an ErrorTable.  Write the results to
+    `writer`, a CallWriter, and optionally write the filter metrics to
+    `filter_metrics_file`.  Loci are read and genotyped in blocks of
+    `chunk_size` summary lines.  If `checkpoint`, a Checkpoint, is given,
+    genotyping continues from its saved offset and progress is saved to it
+    after every block.
+    Returns the (filter metrics, hist metrics) of the STRLocusIterator."""
+
+    done = []
+    if checkpoint is not None and checkpoint.get('offset') is not None:
+        lw_params = dict(lw_params, offset=checkpoint.get('offset'))
+        done = [ checkpoint.get('metrics') ]
 
-    probs = [ dip_prob(alleles, a, b, err) for a, b in gts ]
-
-    best = gts[probs.index(max(probs))]
-    if best[0] == best[1]:
-        if best[0] == 0:
-            call = 'ref'
+    with STRLocusIterator(**lw_params) as locus_f:
+        if checkpoint is not None and locus_f.offset is None:
+            raise ValueError('checkpoints require a text STR summary')
+
+        for batch in locus_f.iter_batches(chunk_size):
+            writer.write(*call_loci(batch.info(), summarize_batch(batch),
+                                    error_table))
+            if checkpoint is not None:
+                with stages.time('checkpoint'):
+                    checkpoint.save(offset=locus_f.offset, calls=writer.flush(),
+                        metrics=merge_metrics(done +
+                                              [ iterator_metrics(locus_f) ]))
+
+        metrics = iterator_metrics(locus_f)
+        if done:
+            metrics = merge_metrics(done + [ metrics ])
+        if filter_metrics_file:
+            save_filter_metrics(filter_metrics_file, *metrics)
+
+    return metrics
+
+
+def merge_metrics(metrics):
+    """Sum a list of (filter metrics, hist metrics) returned by genotype()."""
+    filter_metrics = [ (d, sum(m[0][i][1] for m in metrics))
+                       for i, (d, _) in enumerate(metrics[0][0]) ]
+    hist_metrics = []
+    for i, (d, _) in enumerate(metrics[0][1]):
+        hist = defaultdict(int)
+        for m in metrics:
+            for k, v in m[1][i][1].iteritems():
+                hist[k] += v
+        hist_metrics.append((d, hist))
+    return (filter_metrics, hist_metrics)
+
+
+def sort_regions(regions, chroms):
+    """Return `regions` (chrN[:a-b] strings) in reference order: by the
+    rank of their chromosome in `chroms`, as returned by scan_chroms(), and
+    then by start.  Overlapping regions on a chromosome are merged into
+    one, so no locus is genotyped twice.  Regions on chromosomes not in
+    `chroms` are dropped."""
+    rank = dict((chrom.replace('chr', ''), i)
+                for i, (chrom, offset) in enumerate(chroms))
+    names = dict((chrom.replace('chr', ''), chrom) for chrom, offset in chroms)
+    parsed = sorted((rank[c], start, end, c)
+                    for c, start, end in map(parse_region, regions)
+                    if c in rank)
+    merged = []
+    for r, start, end, c in parsed:
+        if merged and merged[-1][0] == r and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
         else:
-            call = 'hom'
-    else:
-        call = 'het'
-
-    return (call, max(probs), str(best[0]) + "/" + str(best[1]))
-
-
-def genotype(lw_params, filter_metrics_file, errors):
-    """Genotype all loci in the STR locus file specified by lw_params.  Write
-    the results to standard output and optionally write the filter metrics to
-    `filter_metrics_file`."""
+            merged.append([ r, start, end, c ])
+    return [ names[c] if end == float('+inf') else
+             '%s:%d-%d' % (names[c], start, end)
+             for r, start, end, c in merged ]
+
+
+# Error rates shared by all workers in a genotype_regions() pool.  The parent
+# compiles the tables once beside the profile; each worker memory-maps them,
+# so there is one copy of the tables however many workers there are.
+worker_error_table = None
+
+worker_output_suffix = None
+
+def init_worker(error_distn_file, interpolate, stutter, output_suffix):
+    global worker_error_table, worker_output_suffix
+    worker_output_suffix = output_suffix
+    worker_error_table = ErrorTable.attach(error_distn_file,
+                                           interpolate=interpolate,
+                                           stutter=stutter)
+
+
+def genotype_region(job):
+    """Genotype one region in a worker process.  Calls are written to a
+    temporary file whose name is returned along with the metrics and the
+    stage timings."""
+    lw_params, region, offset = job
+    with NamedTemporaryFile(prefix='genotyper.',
+                            suffix=worker_output_suffix) as tmp:
+        filename = tmp.name
+    with CallWriter(filename, header=False) as writer:
+        metrics = genotype(dict(lw_params, region=region, offset=offset),
+                           None, worker_error_table, writer)
+    return (filename, metrics, stages.snapshot())
+
+
+def genotype_regions(lw_params, filter_metrics_file, error_distn_file,
+                     regions=None, jobs=1, interpolate=False, output=None,
+                     stutter=False, checkpoint=None):
+    """Genotype `regions` (default: every chromosome in the summary file)
+    in a pool of `jobs` processes.  Calls are written to `output` (see
+    CallWriter) in reference order, overlapping regions merged (see
+    sort_regions), and the filter metrics of all regions are summed.  If `checkpoint`, a Checkpoint for `output`, is
+    given, regions finished by an earlier run are skipped and progress is
+    saved to it as each region is written."""
+    chroms = scan_chroms(lw_params['filename'])
+    offsets = dict((chrom.replace('chr', ''), offset) for chrom, offset in chroms)
+    if not regions:
+        regions = [ chrom for chrom, offset in chroms ]
+    work = [ (lw_params, r, offsets[parse_region(r)[0]])
+             for r in sort_regions(regions, chroms) ]
+
+    # Workers write the same format as the final output so that their
+    # files can simply be appended.
+    suffix = os.path.splitext(output)[1] if output and output != '-' else ''
+    ErrorTable.compile(error_distn_file, interpolate=interpolate,
+                       stutter=stutter)
+    metrics = []
+    if checkpoint is not None:
+        metrics = checkpoint.get('region_metrics', [])
+        work = work[len(metrics):]
+    pool = Pool(jobs, initializer=init_worker,
+                initargs=(error_distn_file, interpolate, stutter, suffix))
+    with checkpoint.writer() if checkpoint else CallWriter(output) as writer:
+        for calls_file, m, timings in pool.imap(genotype_region, work):
+            stages.merge(timings)
+            writer.append(calls_file)
+            os.remove(calls_file)
+            if os.path.exists(calls_file + '.idx'):
+                os.remove(calls_file + '.idx')
+            metrics.append(m)
+            if checkpoint is not None:
+                checkpoint.save(calls=writer.flush(), region_metrics=metrics)
+    pool.close()
+    pool.join()
+
+    if filter_metrics_file and metrics:
+        save_filter_metrics(filter_metrics_file, *merge_metrics(metrics))
+
+
+class SummaryBuffer():
+    """Hold (locus, allele summaries) records until they can be genotyped.
+    Records are kept in a list or, if `spill`=True, pickled to an anonymous
+    temporary file.  The allele summaries are stored as a list of items and
+    returned as an OrderedDict so that they iterate in exactly the order of
+    the dict they came from; genotype_loci breaks ties by that order."""
+
+    def __init__(self, spill=False):
+        self.f = TemporaryFile() if spill else None
+        self.records = []
+
+
+    def append(self, locus, summaries):
+        record = (locus, summaries.items())
+        if self.f:
+            cPickle.dump(record, self.f, cPickle.HIGHEST_PROTOCOL)
+        else:
+            self.records.append(record)
+
+
+    def __iter__(self):
+        if not self.f:
+            for locus, items in self.records:
+                yield (locus, OrderedDict(items))
+            return
+
+        self.f.seek(0)
+        while True:
+            try:
+                locus, items = cPickle.load(self.f)
+            except EOFError:
+                return
+            yield (locus, OrderedDict(items))
+
+
+def genotype_single_pass(lw_params, filter_metrics_file, error_distn_file,
+                         is_single_cell=False, spill=False, interpolate=False,
+                         output=None, stutter=False):
+    """Profile errors and genotype all loci while reading the STR locus file
+    only once.  Output is identical to profile_error_distn() followed by
+    genotype().  Every locus is summarized and buffered; X and Y loci are
+    also added to the error profile as they stream past.  Once the file is
+    exhausted the profile is complete and the buffered loci are genotyped.
+    Returns the error profile."""
+    errors = ErrorProfile()
+    buf = SummaryBuffer(spill=spill)
 
     with STRLocusIterator(**lw_params) as locus_f:
-        print("chr\tstart\tend\tref_len\tunit\tregion\tflank1\tflank2\tsequence\traw_alleles\tcall\tgenotype\tpval\tallele_summaries")
-        for (chrom, start, end, reflen, unit, region, flank1, flank2, seq, reads) in locus_f:
-            summaries = summarize_alleles(reads, reflen)
-            alleles = " ".join("%d:%d,%.2f,%.2f" % ((k,) + v)
-                               for k, v in summaries.items())
-            err = get_error_estimate(errors, unit, reflen)
-            call, pval, gt = genotype_locus(summaries, err=err)
-            print("%s\t%d\t%d\t%d\t%s\t%s\t%s\t%s\t%s\t%d\t%s\t%s\t%.5g\t%s" %
-                  (chrom, start, end, reflen, unit, region, flank1, flank2,
-                   seq, len(summaries), call, gt, pval, alleles))
+        for batch in locus_f.iter_batches(10000):
+            for locus, summaries in zip(batch.info(), summarize_batch(batch)):
+                chrom, reflen, unit = locus[0], locus[3], locus[4]
+                if chrom.endswith('X') or chrom.endswith('Y'):
+                    errors.add(unit, reflen, estimate_error(summaries,
+                                   use_binom=not is_single_cell))
+                    errors.add_stutter(unit, reflen, estimate_stutter(
+                        summaries, use_binom=not is_single_cell))
+                buf.append(locus, summaries)
 
         if filter_metrics_file:
-            with open(filter_metrics_file, 'w') as f:
-                for (description, value) in locus_f.filter_metrics():
-                    f.write("%s\t%d\n" % (description, value))
+            save_filter_metrics(filter_metrics_file, locus_f.filter_metrics(),
+                                locus_f.hist_metrics())
+
+    errors.save(error_distn_file)
+    error_table = ErrorTable(errors, interpolate=interpolate, stutter=stutter)
 
-                for (description, hist) in locus_f.hist_metrics():
-                    f.write(description + "\n")
-                    for k in sorted(hist.keys()):
-                        f.write("%s\t%d\n" % (k, hist[k]))
+    with CallWriter(output) as writer:
+        for chunk in chunks(buf, 10000):
+            loci, summaries = zip(*chunk)
+            writer.write(*call_loci(loci, summaries, error_table))
+
+    sys.stderr.write("peak memory: %d KB\n" %
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return errors
 
 
 def estimate_error(summaries, use_binom=False, binom_threshold=0.05):
@@ -189,7 +470,7 @@ def estimate_error(summaries, use_binom=False, binom_threshold=0.05):
         if len(nreads) > 1:
             # Get the "best" two allele lens
             obs1, obs2 = nreads[0:2]
-            if binom_test(obs1, n=obs1 + obs2, p=0.5) <= binom_threshold:
+            if binom_test_half(obs1, obs1 + obs2) <= binom_threshold:
                 # Reject hypothesis that each allele is equally likely: stutter
                 likely_stutter += obs2    # obs1 is never considered stutter
                 #print("stutter: " + summaries)
@@ -200,29 +481,234 @@ def estimate_error(summaries, use_binom=False, binom_threshold=0.05):
     return array([ sum(nreads), likely_stutter, 1, 1 if likely_stutter else 0 ])
 
 
+def estimate_stutter(summaries, use_binom=False, binom_threshold=0.05):
+    """Return a list of (step, reads) for the alleles of a hemizygous locus,
+    where step is the distance in bp from the allele to the nearest primary
+    allele.  Primary alleles are chosen as in estimate_error, so the reads
+    at nonzero steps are the likely erroneous reads."""
+    alleles = sorted(summaries.items(), key=lambda x: x[1][0], reverse=True)
+    primary = [ alleles[0][0] ]
+    if use_binom and len(alleles) > 1:
+        obs1, obs2 = alleles[0][1][0], alleles[1][1][0]
+        if binom_test_half(obs1, obs1 + obs2) > binom_threshold:
+            primary.append(alleles[1][0])
+
+    return [ (allele - min(primary, key=lambda p: abs(allele - p)), info[0])
+             for allele, info in alleles ]
+
+
+def lw_params_from(args):
+    """Extract the STRLocusIterator parameters from parsed arguments."""
+    return dict(filename=args.filename, min_mapq=args.min_mapq,
+                min_units=args.min_units, min_depth=args.min_depth,
+                max_ref_diff=args.max_ref_diff)
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
-    parser.add_argument('--error-distn-file', metavar='file', type=str,
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run',
+        help='Profile errors and genotype all loci.')
+    run_parser.add_argument('--error-distn-file', metavar='file', type=str,
         required=True,
         help="File to which STR polymorphism error rates will be written.")
-    parser.add_argument('--filter-metrics-file', metavar='file', type=str,
+    run_parser.add_argument('--filter-metrics-file', metavar='file', type=str,
         help='File to store metrics related to locus and read filtering.')
-    parser.add_argument('--single-cell', action='store_true', default=False,
+    run_parser.add_argument('--output', metavar='file', type=str,
+        help="Write calls to this file instead of stdout.  Files ending in "
+             ".gz are gzipped; files ending in .callz are binary.")
+    run_parser.add_argument('--single-cell', action='store_true', default=False,
+        help="Library was generated from a single cell.  Disables the " \
+             "binomial model for >1 primary alleles.")
+    run_parser.add_argument('--single-pass', action='store_true', default=False,
+        help="Read the STR summary file once instead of twice by buffering "
+             "allele summaries for all loci until the error profile is built.")
+    run_parser.add_argument('--spill', action='store_true', default=False,
+        help="With --single-pass, buffer allele summaries in a temporary "
+             "file instead of in memory.")
+    run_parser.add_argument('--interpolate-errors', action='store_true',
+        default=False,
+        help="Linearly interpolate error rates for reference lengths not "
+             "seen on the sex chromosomes instead of using the nearest one.")
+    run_parser.add_argument('--stutter-model', action='store_true',
+        default=False,
+        help="Spread the error rate over the other alleles by the frequency "
+             "of their step from the true allele on the sex chromosomes "
+             "instead of evenly.")
+    run_parser.add_argument('--resume', action='store_true', default=False,
+        help="Checkpoint progress in <output>.ckpt and, if a checkpoint "
+             "exists, continue the killed run that saved it.  Requires "
+             "--output; not supported with --single-pass.")
+    run_parser.add_argument('--profile-stages', action='store_true',
+        default=False,
+        help="Time each stage of the run and write the timings and "
+             "throughput as JSON to <filter metrics file>.stages.json, or "
+             "stderr without --filter-metrics-file.")
+    STRLocusIterator.add_parser_args(run_parser)
+
+    profile_parser = subparsers.add_parser('profile',
+        help='Profile errors on the X and Y chromosomes and save them.')
+    profile_parser.add_argument('--error-distn-file', metavar='file', type=str,
+        required=True,
+        help="File to which STR polymorphism error rates will be written.")
+    profile_parser.add_argument('--single-cell', action='store_true',
+        default=False,
         help="Library was generated from a single cell.  Disables the " \
              "binomial model for >1 primary alleles.")
-    STRLocusIterator.add_parser_args(parser)
+    profile_parser.add_argument('--region', dest='regions',
+        metavar='chrN[:a-b]', action='append', default=[],
+        help="Only profile loci starting in this region, e.g. chrX.  May be "
+             "given more than once.  Default: all loci.")
+    profile_parser.add_argument('--update', action='store_true',
+        default=False,
+        help="Add the counts to the existing profile in --error-distn-file "
+             "instead of replacing it.  If the file does not exist, a new "
+             "profile is written.  Profiles of separate runs can also be "
+             "combined with errorprofile.py.")
+    profile_parser.add_argument('--resume', action='store_true',
+        default=False,
+        help="Do nothing if --error-distn-file already exists, e.g. when "
+             "rerunning a killed job.  Cannot be used with --update.")
+    profile_parser.add_argument('--profile-stages', action='store_true',
+        default=False,
+        help="Time each stage of the run and write the timings and "
+             "throughput as JSON to <filter metrics file>.stages.json, or "
+             "stderr without --filter-metrics-file.")
+    STRLocusIterator.add_parser_args(profile_parser)
+
+    call_parser = subparsers.add_parser('call',
+        help='Genotype loci using a saved error profile.')
+    call_parser.add_argument('--error-profile', metavar='file', type=str,
+        required=True,
+        help="STR polymorphism error rates written by the profile command.")
+    call_parser.add_argument('--filter-metrics-file', metavar='file', type=str,
+        help='File to store metrics related to locus and read filtering.')
+    call_parser.add_argument('--output', metavar='file', type=str,
+        help="Write calls to this file instead of stdout.  Files ending in "
+             ".gz are gzipped; files ending in .callz are binary.")
+    call_parser.add_argument('--region', dest='regions', metavar='chrN[:a-b]',
+        action='append', default=[],
+        help="Only genotype loci starting in this region.  May be given "
+             "more than once; calls are written in reference order and "
+             "overlapping regions are merged.  Default: all loci.")
+    call_parser.add_argument('--jobs', metavar='N', type=int, default=1,
+        help="Genotype regions (default: each chromosome) in N processes.")
+    call_parser.add_argument('--interpolate-errors', action='store_true',
+        default=False,
+        help="Linearly interpolate error rates for reference lengths not "
+             "seen on the sex chromosomes instead of using the nearest one.")
+    call_parser.add_argument('--stutter-model', action='store_true',
+        default=False,
+        help="Spread the error rate over the other alleles by the frequency "
+             "of their step from the true allele on the sex chromosomes "
+             "instead of evenly.")
+    call_parser.add_argument('--resume', action='store_true', default=False,
+        help="Checkpoint progress in <output>.ckpt and, if a checkpoint "
+             "exists, continue the killed run that saved it.  Requires "
+             "--output.")
+    call_parser.add_argument('--profile-stages', action='store_true',
+        default=False,
+        help="Time each stage of the run and write the timings and "
+             "throughput as JSON to <filter metrics file>.stages.json, or "
+             "stderr without --filter-metrics-file.")
+    STRLocusIterator.add_parser_args(call_parser)
+
     args = parser.parse_args()
 
     # Many of the command line args are STRLocusWalker parameters
-    lw_params = dict(vars(args))
-    del(lw_params['error_distn_file'])
-    del(lw_params['single_cell'])
-    del(lw_params['filter_metrics_file'])
-
-    # Step 1. Generate an STR length polymorphism error profile and save it.
-    errors = profile_error_distn(lw_params, is_single_cell=args.single_cell)
-    save_error_distn(args.error_distn_file, errors)
-
-    # Step 2. Now that we have an empirical distribution of STR polymorphism
-    # error rates, genotype the loci.  The results are printed to stdout.
-    genotype(lw_params, args.filter_metrics_file, errors)
+    lw_params = lw_params_from(args)
+    if args.profile_stages:
+        stages.enable()
+
+    if args.command != 'profile' and args.resume:
+        if not args.output or args.output == '-':
+            parser.error('--resume requires --output')
+        if args.command == 'run' and args.single_pass:
+            parser.error('--resume is not supported with --single-pass')
+
+    if args.command == 'profile':
+        # With --update the file exists before the run, so it cannot tell
+        # whether the new counts were added
+        if args.resume and args.update:
+            parser.error('--resume cannot be used with --update')
+        if args.resume and os.path.exists(args.error_distn_file):
+            sys.exit(0)
+        # --update of a profile that does not exist yet starts a new one
+        errors = ErrorProfile.load(args.error_distn_file) \
+                 if args.update and os.path.exists(args.error_distn_file) \
+                 else ErrorProfile()
+        profile_error_distn(lw_params, is_single_cell=args.single_cell,
+                            regions=args.regions, errors=errors)
+        errors.save(args.error_distn_file)
+    elif args.command == 'call':
+        parallel = args.jobs > 1 or len(args.regions) > 1
+        checkpoint = None
+        if args.resume:
+            checkpoint = Checkpoint(args.output,
+                dict(lw_params, command='call', regions=args.regions,
+                     parallel=parallel, error_profile=args.error_profile,
+                     interpolate=args.interpolate_errors,
+                     stutter=args.stutter_model))
+
+        if parallel:
+            genotype_regions(lw_params, args.filter_metrics_file,
+                             args.error_profile, regions=args.regions,
+                             jobs=args.jobs,
+                             interpolate=args.interpolate_errors,
+                             output=args.output,
+                             stutter=args.stutter_model,
+                             checkpoint=checkpoint)
+        else:
+            if args.regions:
+                lw_params['region'] = args.regions[0]
+            errors = ErrorProfile.load(args.error_profile)
+            with checkpoint.writer() if checkpoint else \
+                    CallWriter(args.output) as writer:
+                genotype(lw_params, args.filter_metrics_file,
+                         ErrorTable(errors, interpolate=args.interpolate_errors,
+                                    stutter=args.stutter_model),
+                         writer, checkpoint=checkpoint)
+        if checkpoint:
+            checkpoint.remove()
+    elif args.single_pass:
+        genotype_single_pass(lw_params, args.filter_metrics_file,
+                             args.error_distn_file,
+                             is_single_cell=args.single_cell, spill=args.spill,
+                             interpolate=args.interpolate_errors,
+                             output=args.output, stutter=args.stutter_model)
+    else:
+        checkpoint = None
+        if args.resume:
+            checkpoint = Checkpoint(args.output,
+                dict(lw_params, command='run',
+                     error_distn_file=args.error_distn_file,
+                     single_cell=args.single_cell,
+                     interpolate=args.interpolate_errors,
+                     stutter=args.stutter_model))
+
+        # Step 1. Generate an STR length polymorphism error profile and save it.
+        if checkpoint and checkpoint.get('profiled'):
+            errors = ErrorProfile.load(args.error_distn_file)
+        else:
+            errors = profile_error_distn(lw_params,
+                                         is_single_cell=args.single_cell)
+            errors.save(args.error_distn_file)
+            if checkpoint:
+                checkpoint.save(profiled=True)
+
+        # Step 2. Now that we have an empirical distribution of STR
+        # polymorphism error rates, genotype the loci.  The results are
+        # written to --output (default stdout).
+        with checkpoint.writer() if checkpoint else \
+                CallWriter(args.output) as writer:
+            genotype(lw_params, args.filter_metrics_file,
+                     ErrorTable(errors, interpolate=args.interpolate_errors,
+                                stutter=args.stutter_model),
+                     writer, checkpoint=checkpoint)
+        if checkpoint:
+            checkpoint.remove()
+
+    if args.profile_stages:
+        metrics_file = getattr(args, 'filter_metrics_file', None)
+        stages.save(stages_filename(metrics_file) if metrics_file else None)
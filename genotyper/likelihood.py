@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Diploid genotype likelihoods for many STR loci at once.
+
+A batch of L loci is described by two (L, K) matrices: the allele labels
+(observed length - reference length) and the number of reads supporting each
+allele.  Loci with fewer than K alleles are padded on the right with 0
+counts; every real allele has at least one supporting read.
+
+The model is the one originally used by genotype_locus: each read is drawn
+from one of the two haplotypes with equal probability, and a read from
+haplotype h reports allele h with probability 1 - err and any one of the
+other N - 1 observed alleles with probability err / (N - 1).  Likelihoods
+are computed in log space, so deep loci no longer underflow to 0.
+
+genotype_loci can also use a stutter-aware model (see read_probs), in which
+the error mass of a haplotype is split among the other observed alleles in
+proportion to the frequency of their step from it, as looked up in an
+errortable.StutterTable.
+"""
+
+import numpy
+
+
+def genotype_pairs(k):
+    """Return (ia, ib), the allele column indexes of every diploid genotype
+    of `k` alleles in the order produced by combinations_with_replacement."""
+    return numpy.triu_indices(k)
+
+
+def genotype_loglik(counts, err):
+    """Return an (L, G) matrix of genotype log likelihoods for the loci in
+    `counts`, with the G genotypes ordered as in genotype_pairs(K).
+    Genotypes containing a padding column get -inf.  `err` is an array of
+    L per-read error probabilities."""
+    counts = numpy.asarray(counts)
+    err = numpy.asarray(err, dtype=float)
+    nalleles = (counts > 0).sum(axis=1)
+    total = counts.sum(axis=1)
+    ia, ib = genotype_pairs(counts.shape[1])
+
+    # log P(read | genotype) for a read supporting: the allele of a
+    # homozygote, one of the alleles of a heterozygote, or any other allele.
+    other = err / numpy.maximum(nalleles - 1, 1)
+    log_hom = numpy.log1p(-err)[:, None]
+    log_het = numpy.log((1 - err + other) / 2)[:, None]
+    log_other = numpy.log(other)[:, None]
+
+    hom = ia == ib
+    in_gt = numpy.where(hom, counts[:, ia], counts[:, ia] + counts[:, ib])
+    loglik = numpy.where(hom, log_hom, log_het) * in_gt + \
+             log_other * (total[:, None] - in_gt)
+    loglik[ib[None, :] >= nalleles[:, None]] = float('-inf')
+    return loglik
+
+
+def raw_likelihood(counts, err, i, j):
+    """Likelihood of genotype (column i, column j) at a single locus,
+    computed exactly as the original genotype_locus did: a raw product over
+    the alleles in column order."""
+    n = (counts > 0).sum()
+    hap_prob = lambda k, h: 1 - err if k == h else err/(n - 1)
+    return numpy.prod([ (hap_prob(k, i)/2 + hap_prob(k, j)/2)**c
+                        for k, c in enumerate(counts[:n]) ])
+
+
+def break_ties(loglik, counts, err, best, tolerance=1e-9):
+    """Genotypes that are equally likely in exact arithmetic differ only by
+    rounding error, so the old raw-product genotype_locus effectively chose
+    between them by the order of its floating point operations.  Re-score
+    near-ties the same way so calls stay identical.  Loci whose raw products
+    all underflow keep the log space choice."""
+    ia, ib = genotype_pairs(counts.shape[1])
+    best_ll = loglik[numpy.arange(len(best)), best]
+    near = loglik >= (best_ll - tolerance)[:, None]
+    for row in numpy.flatnonzero(near.sum(axis=1) > 1):
+        candidates = numpy.flatnonzero(near[row])
+        probs = [ raw_likelihood(counts[row], err[row], ia[g], ib[g])
+                  for g in candidates ]
+        if max(probs) > 0:
+            best[row] = candidates[probs.index(max(probs))]
+    return best
+
+
+def read_probs(alleles, counts, err, weights):
+    """Return an (L, K, K) array P where P[l, k, h] is the probability that
+    a read from a haplotype carrying allele column h of locus l reports
+    allele column k.  A read reports h with probability 1 - err; the rest is
+    split among the other observed alleles in proportion to the frequency of
+    their step from h in `weights`, an (L, 2D + 1) array of step frequencies
+    for steps of -D..D bp.  With flat weights this is the genotype_loglik
+    model."""
+    L, K = alleles.shape
+    D = (weights.shape[1] - 1) // 2
+    observed = counts > 0
+    step = numpy.clip(alleles[:, :, None] - alleles[:, None, :], -D, D) + D
+    w = weights[numpy.arange(L)[:, None, None], step] * observed[:, :, None]
+    w[:, numpy.arange(K), numpy.arange(K)] = 0
+    total = w.sum(axis=1)
+    other = err[:, None, None] * w / numpy.where(total > 0, total, 1)[:, None, :]
+    return numpy.where(numpy.eye(K, dtype=bool)[None, :, :],
+                       (1 - err)[:, None, None], other)
+
+
+def genotype_loglik_stutter(alleles, counts, err, weights):
+    """genotype_loglik under the stutter-aware model of read_probs."""
+    P = read_probs(alleles, counts, err, weights)
+    nalleles = (counts > 0).sum(axis=1)
+    ia, ib = genotype_pairs(counts.shape[1])
+
+    # One genotype at a time keeps memory at O(L K^2) rather than O(L K^3).
+    loglik = numpy.empty((len(counts), len(ia)))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for g in range(len(ia)):
+            mix = numpy.log((P[:, :, ia[g]] + P[:, :, ib[g]]) / 2)
+            loglik[:, g] = numpy.where(counts > 0, counts * mix, 0).sum(axis=1)
+    loglik[ib[None, :] >= nalleles[:, None]] = float('-inf')
+    return loglik
+
+
+def genotype_loci(alleles, counts, err, weights=None):
+    """Call the most likely genotype at each locus.  Ties are broken as in
+    the original genotype_locus (see break_ties).  Returns arrays of
+    (call, allele a, allele b, log likelihood, likelihood); call is one of
+    'ref', 'hom' or 'het'.  The likelihood is exp(log likelihood), which
+    underflows to 0 at deep loci; the calls output reports the log
+    likelihood instead (see callwriter.format_pval).
+
+    If stutter step frequencies `weights` are given (see read_probs), the
+    stutter-aware model is used instead; ties go to the first genotype."""
+    alleles = numpy.asarray(alleles)
+    if len(alleles) == 0:
+        empty = numpy.array([], dtype=int)
+        return (numpy.array([], dtype=object), empty, empty,
+                numpy.array([], dtype=float), numpy.array([], dtype=float))
+
+    counts = numpy.asarray(counts)
+    err = numpy.asarray(err, dtype=float)
+    if weights is None:
+        loglik = genotype_loglik(counts, err)
+        best = break_ties(loglik, counts, err, loglik.argmax(axis=1))
+    else:
+        loglik = genotype_loglik_stutter(alleles, counts, err,
+                                         numpy.asarray(weights, dtype=float))
+        best = loglik.argmax(axis=1)
+    rows = numpy.arange(len(best))
+    ia, ib = genotype_pairs(alleles.shape[1])
+    a = alleles[rows, ia[best]]
+    b = alleles[rows, ib[best]]
+    calls = numpy.where(a != b, 'het', numpy.where(a == 0, 'ref', 'hom'))
+    loglik = loglik[rows, best]
+    return (calls.astype(object), a, b, loglik, numpy.exp(loglik))
+
+
+def allele_matrices(summaries):
+    """Build the (alleles, counts) matrices for a list of allele summary
+    dicts as returned by summarize_alleles.  Columns follow each dict's
+    iteration order."""
+    k = max([ len(s) for s in summaries ] + [1])
+    alleles = numpy.zeros((len(summaries), k), dtype=int)
+    counts = numpy.zeros((len(summaries), k), dtype=int)
+    for i, s in enumerate(summaries):
+        for j, (allele, info) in enumerate(s.items()):
+            alleles[i, j] = allele
+            counts[i, j] = info[0]
+    return (alleles, counts)
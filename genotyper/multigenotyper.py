@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Genotype several samples in one pass over their STR summaries.
+
+msitools writes every summary in reference order, so the summaries of N
+samples can be read in lockstep and k-way merged on (chrom, start, end)
+instead of running the genotyper N times and joining the calls afterwards
+(join_loci.R).  Each sample is genotyped with its own error profile, as
+written by `genotyper.py profile`, and each locus becomes one row of a wide
+table:
+    chr, start, end, ref_len, unit, region, flank1, flank2, sequence
+followed by one group of columns per sample S, named as join_loci.R named
+them:
+    raw_alleles.S, call.S, genotype.S, pval.S, allele_summaries.S
+
+By default only loci passing the filters in every sample are written, like
+the inner join in join_loci.R.  With --all, loci passing in any sample are
+written and the columns of the other samples are NA.  Since every sample's
+reads are at hand for each locus, this is also the place for a joint model
+(e.g. of allelic dropout in single cells) when one is needed.
+
+Chromosomes are merged in the order given by --chroms or, by default, the
+order of the first summary file, with the chromosomes it lacks placed where
+the other summaries have them (see chromorder.merge_chrom_orders).
+"""
+
+import os
+import sys
+import heapq
+from argparse import ArgumentParser
+from itertools import groupby, izip
+from operator import itemgetter
+from strlocusiterator import STRLocusIterator
+from errortable import ErrorTable
+from callwriter import format_alleles, format_pval
+from errorprofile import ErrorProfile
+from chromorder import scan_chroms, merge_chrom_orders
+from genotyper import summarize_batch, call_loci, chunks
+
+locus_columns = [ 'chr', 'start', 'end', 'ref_len', 'unit', 'region',
+                  'flank1', 'flank2', 'sequence' ]
+sample_columns = [ 'raw_alleles', 'call', 'genotype', 'pval',
+                   'allele_summaries' ]
+
+
+def sample_loci(lw_params, chrom_rank, sample):
+    """Yield (merge key, locus info, allele summaries) for each locus in one
+    sample's summary file that passes the filters.  The merge key is
+    (chromosome rank, start, end)."""
+    last = None
+    with STRLocusIterator(**lw_params) as locus_f:
+        for batch in locus_f.iter_batches(10000):
+            for info, summaries in izip(batch.info(), summarize_batch(batch)):
+                if info[0] not in chrom_rank:
+                    raise ValueError('%s: chromosome %s is not in the '
+                                     'chromosome order' % (sample, info[0]))
+                key = (chrom_rank[info[0]], info[1], info[2])
+                if key <= last:
+                    raise ValueError('%s is not in reference order at %s:%d'
+                                     % (sample, info[0], info[1]))
+                last = key
+                yield (key, info, summaries)
+
+
+def tag_sample(loci, i):
+    """Insert the sample number into each record of a sample_loci stream so
+    that heapq.merge never compares the summaries themselves."""
+    for key, info, summaries in loci:
+        yield (key, i, info, summaries)
+
+
+def merge_samples(streams, require_all=True):
+    """k-way merge sample_loci streams.  Yields (locus info, list of allele
+    summaries with one entry per sample, None where the sample does not
+    have the locus).  If `require_all`, only loci present in every sample
+    are yielded."""
+    tagged = [ tag_sample(s, i) for i, s in enumerate(streams) ]
+    for key, group in groupby(heapq.merge(*tagged), key=itemgetter(0)):
+        row = [ None ] * len(streams)
+        for key, i, info, summaries in group:
+            row[i] = summaries
+        if require_all and any(s is None for s in row):
+            continue
+        yield (info, row)
+
+
+def call_rows(rows, error_tables):
+    """Genotype a chunk of merged rows in each sample.  Returns a list with
+    one entry per row of the formatted sample columns."""
+    fields = [ [] for row in rows ]
+    for j, error_table in enumerate(error_tables):
+        idx = [ i for i, (info, row) in enumerate(rows) if row[j] is not None ]
+        loci, summaries, calls, a, b, logliks = \
+            call_loci([ rows[i][0] for i in idx ],
+                      [ rows[i][1][j] for i in idx ], error_table)
+        for i in range(len(rows)):
+            fields[i].append("NA\tNA\tNA\tNA\tNA")
+        for n, i in enumerate(idx):
+            fields[i][j] = "%d\t%s\t%d/%d\t%s\t%s" % \
+                (len(summaries[n]), calls[n], a[n], b[n],
+                 format_pval(logliks[n]), format_alleles(summaries[n]))
+    return fields
+
+
+def genotype_samples(lw_params, filenames, samples, error_profiles, out,
+                     chroms=None, require_all=True, interpolate=False,
+                     chunk_size=10000):
+    """Genotype the summary files `filenames` of `samples` jointly and write
+    the wide table to `out`.  `lw_params` holds the STRLocusIterator filter
+    options shared by all samples."""
+    if not chroms:
+        chroms = merge_chrom_orders([ [ c for c, offset in scan_chroms(f) ]
+                                      for f in filenames ])
+    # STRLocusIterator strips 'chr' from chromosome names
+    chrom_rank = dict((c.replace('chr', ''), i) for i, c in enumerate(chroms))
+
+    error_tables = [ ErrorTable(ErrorProfile.load(f), interpolate=interpolate)
+                     for f in error_profiles ]
+    streams = [ sample_loci(dict(lw_params, filename=f), chrom_rank, s)
+                for f, s in zip(filenames, samples) ]
+
+    out.write("\t".join(locus_columns + [ '%s.%s' % (c, s) for s in samples
+                                          for c in sample_columns ]) + "\n")
+    for rows in chunks(merge_samples(streams, require_all=require_all),
+                       chunk_size):
+        fields = call_rows(rows, error_tables)
+        out.write("".join("%s\t%d\t%d\t%d\t%s\t%s\t%s\t%s\t%s\t%s\n" %
+                          (info + ("\t".join(f),))
+                          for (info, row), f in zip(rows, fields)))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Jointly genotype the STR summary '
+                                        'files of several samples.')
+    parser.add_argument('summaries', metavar='str_summary', nargs='+',
+        help='STR summary files from msitools, one per sample')
+    parser.add_argument('--error-profile', dest='error_profiles',
+        metavar='file', action='append', required=True,
+        help="STR polymorphism error rates written by genotyper.py profile. "
+             "Give once per summary file, in the same order.")
+    parser.add_argument('--sample', dest='samples', metavar='name',
+        action='append',
+        help="Sample name used in the column names.  Give once per summary "
+             "file, in the same order.  Default: the summary file name up "
+             "to the first '.'.")
+    parser.add_argument('--chroms', metavar='chr1,chr2,...', type=str,
+        help="Chromosomes in reference order.  Default: the order of the "
+             "summary files, merged.")
+    parser.add_argument('--all', action='store_true', default=False,
+        help="Write loci that pass the filters in any sample instead of "
+             "only those that pass in every sample.")
+    parser.add_argument('--output', metavar='file', type=str,
+        help="Write the table to this file instead of stdout.")
+    parser.add_argument('--interpolate-errors', action='store_true',
+        default=False,
+        help="Linearly interpolate error rates for reference lengths not "
+             "seen on the sex chromosomes instead of using the nearest one.")
+    STRLocusIterator.add_parser_args(parser, filename=False)
+    args = parser.parse_args()
+
+    samples = args.samples or \
+        [ os.path.basename(f).split('.')[0] for f in args.summaries ]
+    if not len(args.summaries) == len(args.error_profiles) == len(samples):
+        parser.error('give one --error-profile (and --sample, if any) per '
+                     'summary file')
+
+    lw_params = dict(min_mapq=args.min_mapq, min_units=args.min_units,
+                     min_depth=args.min_depth, max_ref_diff=args.max_ref_diff)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    genotype_samples(lw_params, args.summaries, samples, args.error_profiles,
+                     out, chroms=args.chroms.split(',') if args.chroms else None,
+                     require_all=not args.all,
+                     interpolate=args.interpolate_errors)
+    if args.output:
+        out.close()
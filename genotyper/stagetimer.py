@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Per-stage wall time and call counts for the genotyper.
+
+Code to be timed is wrapped in
+    with stages.time('name'):
+        ...
+and throughput counters are added with stages.count('name', n).  Both do
+nothing until enable() is called, and the genotyper only times whole
+chunks of loci, so the cost when disabled is a method call per chunk.
+
+report() returns a dict suitable for JSON:
+    wall_seconds   -- time since enable()
+    stages         -- name -> { seconds, calls }
+    counters       -- name -> total, e.g. loci and reads
+    <counter>_per_sec for each counter
+Worker processes can send their stages home with snapshot() and the parent
+adds them with merge(); the seconds of stages run in parallel then add up
+to more than the wall time.
+"""
+
+import sys
+import json
+import time
+from collections import defaultdict
+
+
+class NullStage():
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class Stage():
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.timer.seconds[self.name] += time.time() - self.start
+        self.timer.calls[self.name] += 1
+
+
+class StageTimer():
+    """Accumulates the time and calls of named stages once enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.null_stage = NullStage()
+        self.reset()
+
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.start = time.time()
+
+
+    def enable(self):
+        self.enabled = True
+        self.reset()
+
+
+    def time(self, name):
+        return Stage(self, name) if self.enabled else self.null_stage
+
+
+    def count(self, name, n):
+        if self.enabled:
+            self.counters[name] += int(n)
+
+
+    def snapshot(self):
+        """Return the stages and counters so far and start over."""
+        s = (dict(self.seconds), dict(self.calls), dict(self.counters))
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        return s
+
+
+    def merge(self, snapshot):
+        """Add the stages and counters of a snapshot() from elsewhere."""
+        seconds, calls, counters = snapshot
+        for name, x in seconds.items():
+            self.seconds[name] += x
+        for name, n in calls.items():
+            self.calls[name] += n
+        for name, n in counters.items():
+            self.counters[name] += n
+
+
+    def report(self):
+        wall = time.time() - self.start
+        report = {
+            'wall_seconds': wall,
+            'stages': dict((name, { 'seconds': self.seconds[name],
+                                    'calls': self.calls[name] })
+                           for name in self.seconds),
+            'counters': dict(self.counters)
+        }
+        for name, n in self.counters.items():
+            report[name + '_per_sec'] = n / wall if wall > 0 else 0.0
+        return report
+
+
+    def save(self, filename=None):
+        """Write report() as JSON to `filename`, or stderr if None."""
+        text = json.dumps(self.report(), indent=2, sort_keys=True) + "\n"
+        if filename is None:
+            sys.stderr.write(text)
+        else:
+            with open(filename, 'w') as f:
+                f.write(text)
+
+
+def stages_filename(filter_metrics_file):
+    """Name of the stage timings written beside a filter metrics file."""
+    return filter_metrics_file + '.stages.json'
+
+
+# The timer used throughout the genotyper
+stages = StageTimer()
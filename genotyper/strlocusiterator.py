@@ -1,20 +1,178 @@
 #!/usr/bin/env python
 
+import numpy
+import strz
+from summaryindex import SummaryIndex
+from stagetimer import stages
 from collections import defaultdict
+from itertools import islice
 
 unit_to_int = { 'mono': 1, 'di': 2, 'tri': 3, 'tetra': 4 }
 
-def build_reads(obslens, strands, mapqs, min_mapq):
-    """Return a list of tuples describing each read a this locus:
-            (observed repeat length, strand, mapq),
-    Only include reads with mapq >= `min_mapq`
-    """
-    # "if x": don't try to int() cast an empty string, just drop it
-    obs = ( int(x.strip()) for x in obslens.split(',') if x )
-    strands = ( x.strip() for x in strands.split(',') if x )
-    mapqs = ( int(x.strip()) for x in mapqs.split(',') if x )
+def parse_region(region):
+    """Parse a region string of the form chrN[:start-end] into a tuple of
+    (chrom, start, end).  The 'chr' prefix is removed from chrom to match
+    the chromosome names returned by STRLocusIterator.  If no coordinates
+    are given, the region spans the whole chromosome."""
+    if ':' not in region:
+        return (region.replace('chr', ''), 0, float('+inf'))
+
+    chrom, coords = region.split(':')
+    start, end = coords.replace(',', '').split('-')
+    return (chrom.replace('chr', ''), int(start), int(end))
+
+
+def tally(hist, keys, weights=None):
+    """Add the number of occurrences of each value in the array `keys` to
+    the dict `hist`.  If `weights` is given, add the sum of the weights for
+    each value instead.  Keys are converted back to plain python types so
+    the histograms match those built one locus at a time."""
+    if len(keys) == 0:
+        return
+    keys = numpy.asarray(keys)
+    if keys.dtype.kind in 'iu':
+        # Small integer ranges (mapq, depth, length differences) are
+        # counted directly with bincount instead of sorting.
+        lo, hi = int(keys.min()), int(keys.max())
+        if hi - lo <= 4 * len(keys) + 1024:
+            seen = numpy.bincount(keys - lo) > 0
+            counts = numpy.bincount(keys - lo, weights=weights)
+            uniq = numpy.flatnonzero(seen)
+            for k, n in zip((uniq + lo).tolist(), counts[uniq].tolist()):
+                hist[k] += int(n)
+            return
+
+    uniq, inverse = numpy.unique(keys, return_inverse=True)
+    counts = numpy.bincount(inverse, weights=weights, minlength=len(uniq))
+    for k, n in zip(uniq.tolist(), counts.tolist()):
+        hist[k] += int(n)
+
+
+def count_reads(reads):
+    """Return the number of reads at each locus from the unparsed read
+    columns ('obslens\tstrands\tmapqs...') of each summary line, by
+    counting the commas in the first column."""
+    return numpy.array([ r.count(',', 0, r.index('\t')) + 1
+                         if r[0] != '\t' else 0 for r in reads ], dtype=int)
+
+
+def split_reads(reads):
+    """Parse the unparsed read columns of a list of loci into flat arrays
+    of (obslen, strand, mapq)."""
+    obslens, strands, mapqs = zip(*[ r.split('\t', 2) for r in reads ])
+    obslen = numpy.fromstring(','.join(obslens), dtype=int, sep=',')
+    # Strands are single characters, so every other byte is one
+    strand = numpy.frombuffer(','.join(strands), dtype='S1')[::2] == '+'
+    mapq = numpy.fromstring(','.join(mapqs), dtype=int, sep=',')
+    return (obslen, strand, mapq)
+
+
+class Locus(object):
+    """A single STR locus.  Its reads are held as three parallel buffers
+    rather than a tuple per read: obslen (observed STR length), strand (1
+    for reads on the '+' strand and 0 otherwise) and mapq.  __slots__ keeps
+    the record itself small.
+
+    For code written against the old tuple interface, a Locus also iterates
+    like (chrom, start, end, reflen, unit, region, flank1, flank2, seq,
+    reads), building the reads list of (obs len, strand, mapq) tuples on
+    demand."""
+
+    __slots__ = ('chrom', 'start', 'end', 'reflen', 'unit', 'region',
+                 'flank1', 'flank2', 'seq', 'obslen', 'strand', 'mapq')
+
+    def __init__(self, chrom, start, end, reflen, unit, region, flank1,
+                 flank2, seq, obslen, strand, mapq):
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.reflen = reflen
+        self.unit = unit
+        self.region = region
+        self.flank1 = flank1
+        self.flank2 = flank2
+        self.seq = seq
+        self.obslen = obslen
+        self.strand = strand
+        self.mapq = mapq
+
+
+    def info(self):
+        """The locus without its reads: (chrom, start, end, reflen, unit,
+        region, flank1, flank2, seq)."""
+        return (self.chrom, self.start, self.end, self.reflen, self.unit,
+                self.region, self.flank1, self.flank2, self.seq)
+
+
+    def reads(self):
+        """Return the reads as a list of (obs len, strand, mapq) tuples."""
+        return [ (obs, '+' if fwd else '-', mapq) for obs, fwd, mapq in
+                 zip(self.obslen.tolist(), self.strand.tolist(),
+                     self.mapq.tolist()) ]
+
+
+    def __len__(self):
+        return 10
+
+
+    def __iter__(self):
+        return iter(self.info() + (self.reads(),))
+
+
+    def __getitem__(self, i):
+        return (self.info() + (self.reads(),))[i]
+
+
+class LocusBatch():
+    """A block of loci stored column-wise as numpy arrays.
+
+    Locus metadata are arrays with one entry per locus.  The reads for all
+    loci are stored in three flat arrays (obslen, strand, mapq) with the reads
+    for locus i in the half-open range [offsets[i], offsets[i+1]).  strand is
+    1 for reads on the '+' strand and 0 otherwise."""
+
+    def __init__(self, chrom, start, end, unit, region, flank1, flank2, seq,
+                 offsets, obslen, strand, mapq):
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.reflen = end - start + 1
+        self.unit = unit
+        self.region = region
+        self.flank1 = flank1
+        self.flank2 = flank2
+        self.seq = seq
+        self.offsets = offsets
+        self.obslen = obslen
+        self.strand = strand
+        self.mapq = mapq
+
+
+    def __len__(self):
+        return len(self.start)
+
+
+    def depth(self):
+        """Number of reads at each locus."""
+        return numpy.diff(self.offsets)
+
+
+    def info(self):
+        """Return the Locus.info() tuple of every locus in the batch."""
+        return zip(self.chrom.tolist(), self.start.tolist(),
+                   self.end.tolist(), self.reflen.tolist(), self.unit.tolist(),
+                   self.region.tolist(), self.flank1.tolist(),
+                   self.flank2.tolist(), self.seq.tolist())
 
-    return [ read for read in zip(obs, strands, mapqs) if read[2] >= min_mapq ]
+
+    def locus(self, i):
+        """Return locus `i` as a Locus.  Its read buffers are views of the
+        batch's arrays, so no per-read objects are created."""
+        a, b = self.offsets[i], self.offsets[i+1]
+        return Locus(self.chrom[i], int(self.start[i]), int(self.end[i]),
+                     int(self.reflen[i]), self.unit[i], self.region[i],
+                     self.flank1[i], self.flank2[i], self.seq[i],
+                     self.obslen[a:b], self.strand[a:b], self.mapq[a:b])
 
 
 class STRLocusIterator():
@@ -30,8 +188,8 @@ class STRLocusIterator():
     the same read.  So if strlens=7,7,8, strands=+,-,- and mapqs=60,20,40; then
     the first read has an STR len of 7bp, is on the '+' strand and has mapq=60.
 
-    For each locus, return a tuple describing the locus as well as a list of
-    tuples describing each read at the locus.  Loci and reads are subject to
+    For each locus, return a Locus holding the locus description and the
+    reads at the locus.  Loci and reads are subject to
     optional filtering criteria; any reads or loci failing the filter criteria
     will be quietly dropped or passed over by this iterator.  Counts for reads
     and loci dropped by the filtering criteria are tracked internally and can
@@ -40,14 +198,54 @@ class STRLocusIterator():
 
     def __init__(self, filename, min_mapq=0, min_units=0,
                  max_ref_diff=float('+inf'),
-                 min_depth=0, hemizygous_only=False):
+                 min_depth=0, hemizygous_only=False, region=None, offset=0):
         """Filter options:
         min_mapq   -- only consider reads with mapq >= `min_mapq`
         min_units  -- only consider repeat loci with ref_units > `min_units`
+        region     -- only consider loci starting in `region`, a string
+                      like chrN[:start-end].  Loci outside the region are
+                      not counted in any metrics.  Since msitools writes
+                      loci in reference order, iteration stops at the first
+                      locus past the end of the region.  If the file has an
+                      index (see summaryindex.py), reading starts near the
+                      region instead of at the top of the file.
+        offset     -- start reading at this byte offset, which must be the
+                      start of a line, instead of just after the header
+
+        For text files, self.offset is the byte offset of the first line not
+        yet read by iter_batches(), from which a later iterator can continue.
         """
 
-        self.f = open(filename, 'r')
-        self.header = self.f.readline()
+        self.region = parse_region(region) if region else None
+        if strz.is_strz(filename):
+            # Binary summary: only the blocks overlapping the region are read
+            if offset:
+                raise ValueError('offset is not supported for .strz files')
+            self.f = strz.StrzReader(filename, region=self.region)
+            self.header = self.f.header
+            self.batches = (self.parse_block(b) for b in self.f)
+            self.offset = None
+        else:
+            self.f = open(filename, 'r')
+            self.header = self.f.readline()
+            if self.region and SummaryIndex.exists(filename):
+                near = SummaryIndex(filename).seek_offset(*self.region[:2])
+                if near is None:
+                    # The chromosome isn't in the file
+                    self.f.seek(0, 2)
+                else:
+                    self.f.seek(max(offset, near))
+            elif offset:
+                self.f.seek(offset)
+            self.offset = self.f.tell()
+            self.lines = self.region_lines() if region else self.f
+            self.batches = None
+
+        # next() returns loci one at a time from blocks of this many lines
+        self.block_size = 10000
+        self.block_iter = None
+        self.batch = None
+        self.batch_i = 0
 
         self.min_mapq = min_mapq
         self.hemizygous_only = hemizygous_only
@@ -82,10 +280,12 @@ class STRLocusIterator():
 
 
     @staticmethod
-    def add_parser_args(parser):
-        """Add options understood by __init__ to `parser`."""
-        parser.add_argument('filename', metavar='str_summary', type=str,
-            help='STR summary file from msitools')
+    def add_parser_args(parser, filename=True):
+        """Add options understood by __init__ to `parser`.  If `filename`
+        is False, the caller adds its own positional arguments."""
+        if filename:
+            parser.add_argument('filename', metavar='str_summary', type=str,
+                help='STR summary file from msitools')
         parser.add_argument('--min-mapq', dest='min_mapq', metavar='N',
             default=0, type=int,
             help='Discard reads with mapping quality < N')
@@ -106,89 +306,235 @@ class STRLocusIterator():
         return self
 
 
-    def next(self):
-        while True:
-            line = self.f.next()
-            fields = [ x.strip() for x in line.split('\t') ]
-
-            chrom = fields[0].replace('chr', '')
-            start = int(fields[1])
-            end = int(fields[2])
-            reflen = end - start + 1
-            ref_unit = fields[3]
-            region = fields[4]
-            flank1 = fields[5]
-            flank2 = fields[6]
-            seq = fields[7]
-
-            # Need to tally unfiltered totals before any filtering occurs
-            self.total_loci += 1
-            raw_reads = fields[8].count(',') + 1 if fields[8] else 0
-            self.total_reads += raw_reads
-
-            if self.hemizygous_only and \
-               not chrom.endswith('X') and not chrom.endswith('Y'):
-                self.loci_hemizygous_only_filter += 1
-                self.reads_hemizygous_only_filter += raw_reads
-                continue
-
-            # reference STR length in bp
-            reflen = end - start + 1  
-            units = float(reflen) / unit_to_int[ref_unit]
-            if units < self.min_units:
-                self.loci_min_units_filter += 1
-                self.reads_min_units_filter += raw_reads
+    def region_lines(self):
+        """Yield only the lines of self.f that fall in self.region."""
+        chrom, start, end = self.region
+        seen_chrom = False
+        for line in self.f:
+            fields = line.split('\t', 2)
+            if fields[0].replace('chr', '') != chrom:
+                if seen_chrom:
+                    return
+                self.offset += len(line)
                 continue
 
-            # No reads here
-            if not raw_reads:
-                continue
+            seen_chrom = True
+            pos = int(fields[1])
+            if pos > end:
+                return
+            self.offset += len(line)
+            if pos >= start:
+                yield line
 
-            # Build read tuples and filter by mapQ
-            reads_mq = build_reads(fields[8], fields[9], fields[10], self.min_mapq)
-            self.reads_mapq_filter += raw_reads - len(reads_mq)
-            if not reads_mq:
-                self.loci_mapq_filter += 1
-                continue
 
-            # Filter by difference between ref and obs alleles.  Some very
-            # large differences cannot be supported by our method; other very
-            # large differences are very low confidence.  In some cases, this
-            # will throw away real differences (e.g., big deletions).
-            reads = [ read for read in reads_mq
-                               if abs(read[0] - reflen) < self.max_ref_diff ]
-            self.reads_max_ref_diff_filter += len(reads_mq) - len(reads)
-            if not reads:
-                self.loci_max_ref_diff_filter += 1
-                continue
-
-            # Filter by total supporting reads at the locus
-            if len(reads) < self.min_depth:
-                self.loci_min_depth_filter += 1
-                self.reads_min_depth_filter += len(reads)
-                continue
-
-            # No more filters beyond this point.  Track locus statistics.
-            self.pf_loci += 1
-            self.pf_reads += len(reads)
-            self.nsupp_hist[len(reads)] += 1
-            self.chrom_hist[chrom] += len(reads)
-            self.unit_hist[ref_unit] += 1
-            self.n_units_hist[units] += 1
-            self.reflen_hist[reflen] += len(reads)
-            self.region_hist[region] += 1
-
-            # Track read statistics
-            for (obslen, strand, mapq) in reads:
-                self.reflen_diff_hist[obslen - reflen] += 1
-                self.strand_hist[strand] += 1
-                self.mapq_hist[mapq] += 1
-
-            # Number of unique observed alleles
-            self.nalleles_hist[len(set(obslen for obslen, x, y in reads))] += 1
+    def next(self):
+        """Return the next locus passing all filters as a Locus.  Loci are
+        parsed and filtered a block at a time by iter_batches(), so the
+        filter and histogram metrics may run up to one block ahead of the
+        loci returned so far; they are complete once iteration ends."""
+        while self.batch is None or self.batch_i == len(self.batch):
+            if self.block_iter is None:
+                self.block_iter = self.iter_batches(n=self.block_size)
+            self.batch = self.block_iter.next()
+            self.batch_i = 0
+        self.batch_i += 1
+        return self.batch.locus(self.batch_i - 1)
+
+
+    def iter_batches(self, n=100000):
+        """Iterate over the remaining loci in blocks, each built from `n`
+        lines of the summary file.  Filters are applied to whole blocks at
+        once, so a block holds at most `n` loci.  Yields LocusBatch objects.
+        For .strz files, blocks are those of the file and `n` is ignored."""
+        if self.batches is not None:
+            while True:
+                with stages.time('read'):
+                    batch = next(self.batches, None)
+                if batch is None:
+                    return
+                if len(batch) > 0:
+                    yield batch
 
-            return (chrom, start, end, reflen, ref_unit, region,
-                    flank1, flank2, seq, reads)
+        while True:
+            with stages.time('read'):
+                lines = list(islice(self.lines, n))
+            if not lines:
+                break
+            if not self.region:
+                self.offset += sum(map(len, lines))
+
+            batch = self.parse_batch(lines)
+            if len(batch) > 0:
+                yield batch
+
+
+    def parse_batch(self, lines):
+        """Parse and filter a list of summary lines into a LocusBatch."""
+        with stages.time('parse_loci'):
+            # Only the locus columns are split out.  The three read columns
+            # stay one unparsed string per locus; the locus filters only
+            # need the number of reads, which is counted in place.
+            rows = [ line.split('\t', 8) for line in lines ]
+            (chroms, starts, ends, units, regions, flank1s, flank2s, seqs,
+                reads) = [ numpy.array(col, dtype=object)
+                           for col in zip(*rows) ]
+            chroms = numpy.array([ c.replace('chr', '')
+                                   for c in chroms ], dtype=object)
+            start = numpy.array(starts, dtype=int)
+            end = numpy.array(ends, dtype=int)
+            raw_reads = count_reads(reads)
+            keep = self.filter_loci(chroms, end - start + 1, units, raw_reads)
+
+        # Only parse the read lists of loci that survived the locus filters.
+        with stages.time('parse_reads'):
+            idx = numpy.flatnonzero(keep)
+            if len(idx) > 0:
+                obslen, strand, mapq = split_reads(reads[idx])
+            else:
+                obslen = strand = mapq = numpy.array([], dtype=int)
+        if not len(obslen) == len(strand) == len(mapq) == raw_reads[idx].sum():
+            raise ValueError('read lists differ in length in lines %d-%d' %
+                             (self.total_loci - len(rows) + 1, self.total_loci))
+
+        with stages.time('filter_reads'):
+            return self.filter_reads(
+                chroms[idx], start[idx], end[idx], units[idx], regions[idx],
+                flank1s[idx], flank2s[idx], seqs[idx], raw_reads[idx],
+                obslen, strand, mapq)
+
+
+    def parse_block(self, block):
+        """Filter a block of an .strz file (see strz.StrzReader) into a
+        LocusBatch."""
+        start = block['start'].astype(int)
+        nreads = numpy.diff(block['offsets']).astype(int)
+
+        # Loci outside the region are dropped before any metrics are tallied
+        idx = numpy.arange(len(start))
+        if self.region:
+            idx = idx[(start >= self.region[1]) & (start <= self.region[2])]
+
+        chroms = numpy.array([ block['chrom'].replace('chr', '') ] * len(idx),
+                             dtype=object)
+        end = block['end'][idx].astype(int)
+        units = numpy.array([ strz.int_to_unit[u] for u in block['unit'][idx] ],
+                            dtype=object)
+        keep = self.filter_loci(chroms, end - start[idx] + 1, units, nreads[idx])
+
+        idx = idx[keep]
+        in_batch = numpy.zeros(len(start), dtype=bool)
+        in_batch[idx] = True
+        read_keep = numpy.repeat(in_batch, nreads)
+        column = lambda name: numpy.array(block[name][idx].tolist(), dtype=object)
+        return self.filter_reads(
+            chroms[keep], start[idx], end[keep], units[keep], column('region'),
+            column('flank1'), column('flank2'), column('seq'), nreads[idx],
+            block['obslen'][read_keep].astype(int),
+            block['strand'][read_keep] == '+',
+            block['mapq'][read_keep].astype(int))
+
+
+    def filter_loci(self, chroms, reflen, units, raw_reads):
+        """Apply the locus level filters to arrays describing a block of
+        loci, tallying totals and filter counts.  Returns a mask of the loci
+        passing all locus filters and having at least one read."""
+        # Need to tally unfiltered totals before any filtering occurs
+        self.total_loci += len(chroms)
+        self.total_reads += int(raw_reads.sum())
+
+        keep = numpy.ones(len(chroms), dtype=bool)
+        if self.hemizygous_only:
+            fail = numpy.array([ not c.endswith('X') and not c.endswith('Y')
+                                 for c in chroms ], dtype=bool)
+            self.loci_hemizygous_only_filter += int(fail.sum())
+            self.reads_hemizygous_only_filter += int(raw_reads[fail].sum())
+            keep &= ~fail
+
+        n_units = reflen / numpy.array([ float(unit_to_int[u]) for u in units ])
+        fail = keep & (n_units < self.min_units)
+        self.loci_min_units_filter += int(fail.sum())
+        self.reads_min_units_filter += int(raw_reads[fail].sum())
+        keep &= ~fail
+
+        # No reads here
+        return keep & (raw_reads > 0)
+
+
+    def filter_reads(self, chroms, start, end, units, regions, flank1s,
+                     flank2s, seqs, nreads, obslen, strand, mapq):
+        """Apply the read level filters to loci that passed filter_loci.
+        The reads of all loci are given as flat arrays, `nreads` per locus.
+        Tallies filter counts and histograms and returns a LocusBatch of the
+        loci and reads passing all filters."""
+        nloci = len(start)
+        reflen = end - start + 1
+        read_locus = numpy.repeat(numpy.arange(nloci), nreads)
+
+        # Filter by mapQ
+        pass_mq = mapq >= self.min_mapq
+        depth_mq = numpy.bincount(read_locus[pass_mq], minlength=nloci)
+        self.reads_mapq_filter += int(len(mapq) - pass_mq.sum())
+        self.loci_mapq_filter += int((depth_mq == 0).sum())
+
+        # Filter by difference between ref and obs alleles.  Some very
+        # large differences cannot be supported by our method; other very
+        # large differences are very low confidence.  In some cases, this
+        # will throw away real differences (e.g., big deletions).
+        pass_diff = pass_mq & \
+            (abs(obslen - reflen[read_locus]) < self.max_ref_diff)
+        depth = numpy.bincount(read_locus[pass_diff], minlength=nloci)
+        self.reads_max_ref_diff_filter += int(pass_mq.sum() - pass_diff.sum())
+        self.loci_max_ref_diff_filter += int(((depth_mq > 0) & (depth == 0)).sum())
+
+        # Filter by total supporting reads at the locus
+        fail = (depth > 0) & (depth < self.min_depth)
+        self.loci_min_depth_filter += int(fail.sum())
+        self.reads_min_depth_filter += int(depth[fail].sum())
+
+        # No more filters beyond this point.
+        pf = (depth > 0) & ~fail
+        pf_reads = pass_diff & pf[read_locus]
+        idx = numpy.flatnonzero(pf)
+        depth = depth[pf]
+        read_locus = numpy.repeat(numpy.arange(len(idx)), depth)
+        obslen = obslen[pf_reads]
+        strand = strand[pf_reads].astype(int)
+        mapq = mapq[pf_reads]
+        n_units = reflen[idx] / numpy.array([ float(unit_to_int[u])
+                                              for u in units[idx] ])
+
+        # Track locus statistics
+        self.pf_loci += len(idx)
+        self.pf_reads += int(depth.sum())
+        tally(self.nsupp_hist, depth)
+        tally(self.chrom_hist, chroms[idx], weights=depth)
+        tally(self.unit_hist, units[idx])
+        tally(self.n_units_hist, n_units)
+        tally(self.reflen_hist, reflen[idx], weights=depth)
+        tally(self.region_hist, regions[idx])
+
+        # Track read statistics
+        tally(self.reflen_diff_hist, obslen - reflen[idx][read_locus])
+        fwd = int(strand.sum())
+        if fwd:
+            self.strand_hist['+'] += fwd
+        if len(strand) - fwd:
+            self.strand_hist['-'] += len(strand) - fwd
+        tally(self.mapq_hist, mapq)
+
+        # Number of unique observed alleles: sort reads by (locus, obslen)
+        # and count the positions where either value changes.
+        order = numpy.lexsort((obslen, read_locus))
+        l, o = read_locus[order], obslen[order]
+        first = numpy.ones(len(l), dtype=bool)
+        first[1:] = (l[1:] != l[:-1]) | (o[1:] != o[:-1])
+        tally(self.nalleles_hist, numpy.bincount(l[first], minlength=len(idx)))
+
+        offsets = numpy.zeros(len(idx) + 1, dtype=int)
+        offsets[1:] = numpy.cumsum(depth)
+        return LocusBatch(chroms[idx], start[idx], end[idx], units[idx],
+                          regions[idx], flank1s[idx], flank2s[idx], seqs[idx],
+                          offsets, obslen, strand, mapq)
 
 
     def filter_metrics(self):
@@ -233,4 +579,4 @@ class STRLocusIterator():
 
 
     def __exit__(self, type, value, traceback):
-        self.f.__exit__(type, value, traceback)
+        self.f.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+Binary, block compressed STR summary files (.strz).
+
+An .strz file holds the same data as an msitools str_summary.txt file, but
+loci are grouped into blocks of (by default) 10000 loci and stored as
+columns: fixed-width numpy arrays for the locus metadata and flat packed
+arrays of obslen, strand and mapq for the reads, with CSR-style offsets
+giving the reads of each locus.  A block never spans two chromosomes.
+
+Each block is compressed as a separate gzip member, so the file can be
+decompressed by zcat and any block can be read by seeking to its offset
+(the same idea as BGZF, but without BGZF's 64KB block size limit, since
+blocks are sized by loci rather than bytes).  The index is written beside
+the file as <file>.strz.idx: a copy of the original summary header line
+followed by one tab-delimited line per block:
+    chrom, first locus start, last locus start, byte offset,
+    compressed length, number of loci
+
+Convert a summary with:
+    strz.py str_summary.txt str_summary.strz
+
+STRLocusIterator reads .strz files transparently and, given a region, only
+reads the blocks that overlap it.
+"""
+
+import sys
+import zlib
+import numpy
+from io import BytesIO
+from argparse import ArgumentParser
+
+unit_to_int = { 'mono':1, 'di':2, 'tri':3, 'tetra':4 }
+int_to_unit = dict((v, k) for k, v in unit_to_int.items())
+
+# Column order within a block.  chrom is stored once per block in the index.
+columns = [ 'start', 'end', 'unit', 'region', 'flank1', 'flank2', 'seq',
+            'offsets', 'obslen', 'strand', 'mapq' ]
+
+
+def index_filename(filename):
+    return filename + '.idx'
+
+
+def is_strz(filename):
+    return filename.endswith('.strz')
+
+
+def encode_block(rows):
+    """Pack a list of split summary lines into a block payload."""
+    (chroms, starts, ends, units, regions, flank1s, flank2s, seqs,
+        obslens, strands, mapqs) = zip(*rows)
+    nreads = [ x.count(',') + 1 if x else 0 for x in obslens ]
+    offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(nreads)
+
+    def flat(lists, dtype):
+        s = ','.join(x for x in lists if x)
+        return numpy.fromstring(s, dtype=dtype, sep=',') if s else \
+               numpy.array([], dtype=dtype)
+
+    cols = dict(
+        start=numpy.array(starts, dtype=numpy.int64),
+        end=numpy.array(ends, dtype=numpy.int64),
+        unit=numpy.array([ unit_to_int[u] for u in units ], dtype=numpy.uint8),
+        region=numpy.array(regions, dtype='S'),
+        flank1=numpy.array(flank1s, dtype='S'),
+        flank2=numpy.array(flank2s, dtype='S'),
+        seq=numpy.array(seqs, dtype='S'),
+        offsets=offsets,
+        obslen=flat(obslens, numpy.int32),
+        strand=numpy.frombuffer(''.join(strands).replace(',', ''), dtype='S1'),
+        mapq=flat(mapqs, numpy.uint8))
+    if not len(cols['obslen']) == len(cols['strand']) == len(cols['mapq']) \
+            == offsets[-1]:
+        raise ValueError('read lists differ in length near %s:%s' %
+                         (chroms[0], starts[0]))
+
+    return pack_columns(cols, columns)
+
+
+def decode_block(payload, chrom):
+    """Unpack a block payload into a dict of column arrays."""
+    block = unpack_columns(payload, columns)
+    block['chrom'] = chrom
+    return block
+
+
+def pack_columns(cols, names):
+    """Serialize the arrays cols[name] for each of `names`, in order."""
+    payload = BytesIO()
+    for name in names:
+        numpy.save(payload, cols[name], allow_pickle=False)
+    return payload.getvalue()
+
+
+def unpack_columns(payload, names):
+    """Inverse of pack_columns: return a dict of arrays."""
+    f = BytesIO(payload)
+    return dict((name, numpy.load(f, allow_pickle=False)) for name in names)
+
+
+def compress(payload):
+    """Compress `payload` as a single gzip member."""
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return z.compress(payload) + z.flush()
+
+
+def decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def write_strz(summary_file, strz_file, loci_per_block=10000):
+    """Convert an msitools summary file to .strz."""
+    with open(summary_file, 'r') as f, open(strz_file, 'wb') as out, \
+         open(index_filename(strz_file), 'w') as idx:
+        idx.write(f.readline())
+
+        def flush(rows):
+            data = compress(encode_block(rows))
+            idx.write("%s\t%s\t%s\t%d\t%d\t%d\n" %
+                      (rows[0][0], rows[0][1], rows[-1][1], out.tell(),
+                       len(data), len(rows)))
+            out.write(data)
+
+        rows = []
+        for line in f:
+            fields = [ x.strip() for x in line.split('\t') ]
+            if rows and (len(rows) == loci_per_block or fields[0] != rows[0][0]):
+                flush(rows)
+                rows = []
+            rows.append(fields)
+        if rows:
+            flush(rows)
+
+
+class StrzReader():
+    """Iterate over the blocks of an .strz file, optionally only those that
+    overlap `region`, a (chrom, start, end) tuple as returned by
+    strlocusiterator.parse_region.  Blocks are returned as dicts of column
+    arrays plus the block's chrom."""
+
+    def __init__(self, filename, region=None):
+        self.f = open(filename, 'rb')
+        with open(index_filename(filename), 'r') as idx:
+            self.header = idx.readline()
+            self.blocks = []
+            for line in idx:
+                chrom, first, last, offset, length, nloci = line.split('\t')
+                self.blocks.append((chrom, int(first), int(last), int(offset),
+                                    int(length), int(nloci)))
+
+        if region:
+            chrom, start, end = region
+            self.blocks = [ b for b in self.blocks
+                            if b[0].replace('chr', '') == chrom and
+                               b[2] >= start and b[1] <= end ]
+
+
+    def chroms(self):
+        """Chromosomes in file order."""
+        chroms = []
+        for b in self.blocks:
+            if not chroms or chroms[-1] != b[0]:
+                chroms.append(b[0])
+        return chroms
+
+
+    def __iter__(self):
+        for (chrom, first, last, offset, length, nloci) in self.blocks:
+            self.f.seek(offset)
+            yield decode_block(decompress(self.f.read(length)), chrom)
+
+
+    def close(self):
+        self.f.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Convert an msitools STR summary '
+                                        'file to the binary .strz format.')
+    parser.add_argument('summary', metavar='str_summary',
+        help='STR summary file from msitools')
+    parser.add_argument('strz', metavar='out.strz',
+        help='Output file; the index is written to out.strz.idx')
+    parser.add_argument('--loci-per-block', metavar='N', type=int,
+        default=10000,
+        help='Maximum number of loci in each compressed block')
+    args = parser.parse_args()
+
+    if not is_strz(args.strz):
+        sys.stderr.write('output file name must end in .strz\n')
+        sys.exit(1)
+    write_strz(args.summary, args.strz, loci_per_block=args.loci_per_block)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Memoized binomial tests for telling stutter from heterozygous loci.
+
+The genotyper and the stutter scripts decide whether the two best supported
+alleles at a locus are equally likely (a heterozygote) with a two-sided
+binomial test of (reads for allele 1, reads for alleles 1 + 2) against
+p=0.5.  Read depths are small integers, so the same (k, n) pairs come up
+over and over across millions of loci.  BinomTestCache remembers the most
+recently used p-values in a bounded LRU table.
+
+Run as a script on an STR summary file to compare the cached and uncached
+tests on the X and Y loci:
+    stuttertest.py [--min-mapq N ...] str_summary.txt
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from scipy.stats import binom_test
+
+
+class BinomTestCache():
+    """Two-sided binomial test p-values for p=0.5, keyed by (k, n).  At most
+    `maxsize` p-values are kept; the least recently used is evicted first."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __call__(self, k, n):
+        key = (k, n)
+        try:
+            pval = self.table.pop(key)
+            self.hits += 1
+        except KeyError:
+            pval = binom_test(k, n=n, p=0.5)
+            self.misses += 1
+            if len(self.table) >= self.maxsize:
+                self.table.popitem(last=False)
+        self.table[key] = pval
+        return pval
+
+
+# Shared by every caller in a process
+binom_test_half = BinomTestCache()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from strlocusiterator import STRLocusIterator
+
+    parser = ArgumentParser()
+    STRLocusIterator.add_parser_args(parser)
+    args = parser.parse_args()
+
+    # Collect the (k, n) pair tested at each X/Y locus with >1 allele
+    pairs = []
+    with STRLocusIterator(hemizygous_only=True, **vars(args)) as locus_f:
+        for locus in locus_f:
+            counts = {}
+            for obs in locus.obslen.tolist():
+                counts[obs] = counts.get(obs, 0) + 1
+            nreads = sorted(counts.values(), reverse=True)
+            if len(nreads) > 1:
+                pairs.append((nreads[0], nreads[0] + nreads[1]))
+
+    t = time.time()
+    uncached = [ binom_test(k, n=n, p=0.5) for k, n in pairs ]
+    t_uncached = time.time() - t
+
+    cache = BinomTestCache()
+    t = time.time()
+    cached = [ cache(k, n) for k, n in pairs ]
+    t_cached = time.time() - t
+
+    assert cached == uncached
+    print("tests\t%d" % len(pairs))
+    print("distinct (k, n)\t%d" % cache.misses)
+    print("uncached seconds\t%.3f" % t_uncached)
+    print("cached seconds\t%.3f" % t_cached)
+    if t_cached > 0:
+        print("speedup\t%.1fx" % (t_uncached / t_cached))
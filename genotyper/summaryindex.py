@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Sidecar byte offset index for tab-delimited files sorted in reference order
+whose first two columns are chrom and start: msitools STR summaries,
+genotyper calls files and the tables made from them.
+
+The index is written beside the file as <file>.sidx, a name of its own so
+that it never collides with the block indexes of .strz and .callz files
+(<file>.strz.idx, <file>.callz.idx).  After a comment line
+recording the sampling interval and the size of the indexed file, it holds
+one line per chromosome:
+    chrom, chrom name, offset of its first line, offset of its last line
+followed by a sparse table of every K-th line of each chromosome (and
+always its first line):
+    locus, chrom name, start, offset
+Offsets are those of the first byte of the line.  Build an index with:
+    summaryindex.py [--every K] str_summary.txt
+
+STRLocusIterator(region=...) and view_locus.py use the index, when present,
+to seek to a region instead of reading the file from the start.
+"""
+
+import os
+import sys
+from bisect import bisect_left
+from argparse import ArgumentParser
+
+
+def index_filename(filename):
+    return filename + '.sidx'
+
+
+def build_index(filename, every=1000):
+    """Write the index of `filename`, sampling every `every` lines."""
+    size = os.path.getsize(filename)
+    chroms = []
+    loci = []
+    with open(filename, 'r') as f:
+        offset = len(f.readline())
+        n = 0
+        for line in iter(f.readline, ''):
+            chrom, start = line.split('\t', 2)[:2]
+            if not chroms or chroms[-1][0] != chrom:
+                chroms.append([ chrom, offset, offset ])
+                n = 0
+            if n % every == 0:
+                loci.append((chrom, start, offset))
+            chroms[-1][2] = offset
+            offset += len(line)
+            n += 1
+
+    with open(index_filename(filename), 'w') as idx:
+        idx.write('#every=%d\tsize=%d\n' % (every, size))
+        for chrom, first, last in chroms:
+            idx.write('chrom\t%s\t%d\t%d\n' % (chrom, first, last))
+        for chrom, start, offset in loci:
+            idx.write('locus\t%s\t%s\t%d\n' % (chrom, start, offset))
+
+
+class SummaryIndex():
+    """The index of `filename`.  Chromosome names are matched without any
+    'chr' prefix, as STRLocusIterator reports them.  Raises ValueError if
+    the file has changed size since it was indexed."""
+
+    def __init__(self, filename):
+        self.chrom_order = []
+        self.spans = {}
+        self.starts = {}
+        self.offsets = {}
+        with open(index_filename(filename), 'r') as idx:
+            meta = dict(x.split('=') for x in idx.readline()[1:].split())
+            if int(meta['size']) != os.path.getsize(filename):
+                raise ValueError('%s is out of date; rebuild it with '
+                                 'summaryindex.py' % index_filename(filename))
+            for line in idx:
+                kind, chrom, a, b = line.split('\t')
+                key = chrom.replace('chr', '')
+                if kind == 'chrom':
+                    self.chrom_order.append(chrom)
+                    self.spans[key] = (int(a), int(b))
+                    self.starts[key] = []
+                    self.offsets[key] = []
+                else:
+                    self.starts[key].append(int(a))
+                    self.offsets[key].append(int(b))
+
+
+    @staticmethod
+    def exists(filename):
+        return os.path.exists(index_filename(filename))
+
+
+    def chroms(self):
+        """Return a list of (chrom, offset of its first line) in file
+        order."""
+        return [ (c, self.spans[c.replace('chr', '')][0])
+                 for c in self.chrom_order ]
+
+
+    def span(self, chrom):
+        """Return the (first, last) line offsets of `chrom`, or None."""
+        return self.spans.get(chrom.replace('chr', ''))
+
+
+    def seek_offset(self, chrom, start):
+        """Return an offset from which reading forward reaches every line
+        of `chrom` with a start >= `start`: that of the last sampled line
+        starting before `start`.  Returns None if `chrom` is not in the
+        file."""
+        key = chrom.replace('chr', '')
+        if key not in self.spans:
+            return None
+        i = bisect_left(self.starts[key], start)
+        return self.offsets[key][max(i - 1, 0)]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Index a tab-delimited file sorted '
+                                        'by chrom and start.')
+    parser.add_argument('filename', metavar='str_summary',
+        help='STR summary, calls file or table made from them')
+    parser.add_argument('--every', metavar='K', type=int, default=1000,
+        help='Record the offset of every K-th line of each chromosome')
+    args = parser.parse_args()
+
+    build_index(args.filename, every=args.every)
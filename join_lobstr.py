@@ -2,11 +2,22 @@
 """Try to join candidates from Tae-min's pipeline to lobSTR's calls.
 
 I'm not sure yet whether a missing call from lobSTR should lower our
-confidence."""
+confidence.
+
+By default each candidate is looked up in each sample's lobSTR index.  With
+--sweep, each sample is instead joined in one pass: the candidates of a
+chromosome and the sample's calls on it are merged in order of start,
+keeping only the calls that may still overlap a later candidate.  This
+needs the table sorted by start within each chromosome (e.g. sort -k1,1
+-k2,2n) and lets --jobs join several samples at once."""
 
 import sys
-from bx.intervals.intersection import IntervalTree, Interval
+import warnings
+from itertools import groupby
+from multiprocessing import Pool
+from argparse import ArgumentParser
 from collections import defaultdict
+from lobstrindex import open_index
 
 
 def in_tree(tree, start, end):
@@ -16,6 +27,7 @@ def in_tree(tree, start, end):
 
 def build_lobstr_tree(f):
     """f is an open file handle to a lobSTR genotypes.tab file"""
+    from bx.intervals.intersection import IntervalTree
     # Each sample has a dictionary of trees, one per chromosome
     colnames = []
     #chrs = defaultdict(lambda: IntervalTree())
@@ -52,17 +64,75 @@ def in_lobstr(lobstr_trees, sample, chrom, start, end):
         return False
 
 
-# For each sample, read in lobSTR's calls and build an interval tree for
-# quick lookups.
+def lobstr_filename(sample):
+    return 'lobstr/%s.genotypes.tab' % sample
+
+
+# For each sample, open the on-disk index of lobSTR's calls for quick
+# lookups (see lobstrindex.py).  The index is built on first use; it
+# supports the same lookups as the trees from build_lobstr_tree without
+# reading the calls into memory.
 def read_lobstr(samples):
     trees = {}
     for s in samples:
-        with open('lobstr/%s.genotypes.tab' % s, 'r') as f:
-            sys.stderr.write('building tree for ' + s + '\n')
-            trees[s] = build_lobstr_tree(f)
+        trees[s] = open_index(lobstr_filename(s))
 
     return trees
 
+
+def sweep(candidates, calls):
+    """Yield, for each (start, end) in `candidates`, whether it overlaps
+    any (start, end) in `calls`.  Both must be in order of start.  The
+    window holds the calls starting before the current candidate ends that
+    have not ended before it starts; since later candidates start no
+    earlier, calls leaving the window are never needed again."""
+    calls = iter(calls)
+    call = next(calls, None)
+    window = []
+    last_start = None
+    for start, end in candidates:
+        if last_start is not None and start < last_start:
+            raise ValueError('candidates are not sorted by start: %d after %d'
+                             % (start, last_start))
+        last_start = start
+        while call is not None and call[0] < end:
+            window.append(call)
+            call = next(calls, None)
+        window = [ c for c in window if c[1] > start ]
+        yield len(window) > 0 and window[0][0] < end
+
+
+def iter_calls(chrom_index, chunk_size=10000):
+    """Yield the (start, end) of the calls in a lobstrindex.ChromIndex in
+    order of start, reading the memory-mapped rows a chunk at a time."""
+    rows = chrom_index.rows
+    for i in xrange(0, len(rows), chunk_size):
+        for start, end, offset in rows[i:i+chunk_size].tolist():
+            yield (start, end)
+
+
+def sweep_sample(args):
+    """Join the candidates in `table` to the calls of `sample`.  Returns a
+    bytearray with 1 for each candidate overlapping a call, else 0."""
+    table, sample = args
+    index = open_index(lobstr_filename(sample))
+    found = bytearray()
+    with open(table, 'r') as f:
+        colnames = map(str.strip, f.readline().split('\t'))
+        c, s, e = [ colnames.index(x) for x in ('chr', 'start', 'end') ]
+        rows = ( line.split('\t') for line in f )
+        for chrom, group in groupby(rows, key=lambda fields: fields[c].strip()):
+            candidates = ( (int(x[s]), int(x[e])) for x in group )
+            try:
+                calls = iter_calls(index['chr' + chrom])
+            except KeyError:
+                warnings.warn("no tree for sample=%s, chrom=chr%s" %
+                    (sample, chrom), RuntimeWarning)
+                calls = []
+            found.extend(sweep(candidates, calls))
+    index.close()
+    return found
+
     
 # headers should be in the table, but the format should be roughly:
 #   chr start end (zygosity, support)*N
@@ -72,17 +142,36 @@ def read_lobstr(samples):
 # of reads supporting that repeat unit length.
 colnames = []
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('usage: %s tab_separated_table')
-        exit(1)
+    parser = ArgumentParser(description="Join candidates to lobSTR's calls.")
+    parser.add_argument('table', metavar='tab_separated_table',
+        help='Candidate table with chr, start and end columns')
+    parser.add_argument('--sweep', action='store_true', default=False,
+        help='Join each sample in one pass over the table instead of looking '
+             'up each row.  The table must be sorted by start within each '
+             'chromosome.')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+        help='With --sweep, join N samples at once')
+    args = parser.parse_args()
+    if args.jobs > 1 and not args.sweep:
+        parser.error('--jobs requires --sweep')
 
     #sys.setrecursionlimit(10000)  # For IntervalNode
     samples = [ 'heart_bulk', 'neuron_2', 'neuron_3', 'neuron_51', 'neuron_6']
-    trees = read_lobstr(samples)
+    if args.sweep:
+        jobs = [ (args.table, s) for s in samples ]
+        if args.jobs > 1:
+            pool = Pool(args.jobs)
+            joined = pool.map(sweep_sample, jobs)
+            pool.close()
+        else:
+            joined = map(sweep_sample, jobs)
+    else:
+        trees = read_lobstr(samples)
 
     # read in the results from Tae-min's sputnik pipeline
-    tsv_f = open(sys.argv[1].strip(), 'r')
+    tsv_f = open(args.table.strip(), 'r')
     first_line = True
+    row = 0
     for line in tsv_f:
         fields = map(str.strip, line.split('\t'))
     
@@ -94,7 +183,11 @@ if __name__ == '__main__':
             first_line = False
             continue
     
-        d = dict(zip(colnames, fields))
-        found = [ str(in_lobstr(trees, s, 'chr'+d['chr'], d['start'], d['end']))
-                for s in samples ]
+        if args.sweep:
+            found = [ str(bool(x[row])) for x in joined ]
+            row += 1
+        else:
+            d = dict(zip(colnames, fields))
+            found = [ str(in_lobstr(trees, s, 'chr'+d['chr'], d['start'], d['end']))
+                    for s in samples ]
         print('\t'.join(fields + found))
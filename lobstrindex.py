@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+On-disk interval index of a lobSTR genotypes.tab file.
+
+join_lobstr.build_lobstr_tree() reads a whole genotypes.tab into interval
+trees, which takes minutes and GBs per sample.  Index each file once with
+    lobstrindex.py lobstr/heart_bulk.genotypes.tab ...
+which writes two files beside it:
+    <file>.lidx      -- the size of the indexed file, its column names and,
+                        for each chromosome, its first and last+1 rows in
+                        the array below and the length of its longest call
+    <file>.lidx.npy  -- (start, end, offset of the line) of every call,
+                        sorted by chromosome and start
+LobstrIndex memory-maps the array, so opening an index takes constant time
+and memory, and a lookup bisects the starts of the chromosome and reads
+only the matching lines of the table.  lobSTR calls are short, so the
+longest call bounds how far before a query a matching call can start.
+
+index[chrom].find(start, end) returns what IntervalTree.find() returns for
+the tree built by build_lobstr_tree(): a list of zip(colnames, fields), one
+per call overlapping [start, end), in order of start.
+"""
+
+import os
+import sys
+import numpy
+import threading
+from tempfile import mkstemp
+from argparse import ArgumentParser
+
+
+def index_filename(filename):
+    return filename + '.lidx'
+
+
+def array_filename(filename):
+    return filename + '.lidx.npy'
+
+
+def write_atomically(filename, write, mode='w'):
+    """Call write(f) on a new file and move it into place as `filename`, so
+    readers never see a partial file.  Each writer has its own temporary
+    file in the same directory, so processes indexing the same table at
+    once do not clobber each other's output."""
+    fd, tmp = mkstemp(dir=os.path.dirname(filename) or '.',
+                      prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        # mkstemp creates the file readable only by its owner
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def build_index(filename):
+    """Write the index of the lobSTR genotypes.tab `filename`."""
+    size = os.path.getsize(filename)
+    colnames = []
+    chroms = []
+    chrom_ids = {}
+    rows = []
+    with open(filename, 'r') as f:
+        offset = 0
+        for line in iter(f.readline, ''):
+            fields = line.split('\t', 3)
+            if not line.strip() or line.lstrip()[0] == '#':
+                pass
+            elif fields[0].strip() == 'chr':
+                colnames = map(str.strip, line.split('\t'))
+            else:
+                chrom = fields[0].strip()
+                if chrom not in chrom_ids:
+                    chrom_ids[chrom] = len(chroms)
+                    chroms.append(chrom)
+                rows.append((chrom_ids[chrom], int(fields[1]), int(fields[2]),
+                             offset))
+            offset += len(line)
+
+    rows = numpy.array(rows, dtype=numpy.int64).reshape(-1, 4)
+    # Stable, so calls with the same start stay in file order
+    rows = rows[numpy.lexsort((rows[:,1], rows[:,0]))]
+    bounds = numpy.searchsorted(rows[:,0], numpy.arange(len(chroms) + 1))
+
+    def write_index(idx):
+        idx.write('#size=%d\n' % size)
+        idx.write('columns\t%s\n' % '\t'.join(colnames))
+        for i, chrom in enumerate(chroms):
+            a, b = bounds[i], bounds[i+1]
+            idx.write('chrom\t%s\t%d\t%d\t%d\n' %
+                      (chrom, a, b, (rows[a:b,2] - rows[a:b,1]).max()))
+
+    # The index file last, so that a complete one has its array beside it
+    write_atomically(array_filename(filename),
+        lambda f: numpy.save(f, numpy.ascontiguousarray(rows[:,1:])), 'wb')
+    write_atomically(index_filename(filename), write_index)
+
+
+class ChromIndex():
+    """The calls of one chromosome; find() works like IntervalTree.find()."""
+
+    def __init__(self, index, first, last, max_length):
+        self.index = index
+        self.starts = index.rows[first:last,0]
+        self.rows = index.rows[first:last]
+        self.max_length = max_length
+
+
+    def find(self, start, end):
+        a = numpy.searchsorted(self.starts, start - self.max_length, 'right')
+        b = numpy.searchsorted(self.starts, end, 'left')
+        return [ self.index.read_row(offset)
+                 for s, e, offset in self.rows[a:b] if e > start ]
+
+
+class LobstrIndex():
+    """The index of the lobSTR genotypes.tab `filename`.  index[chrom] is a
+    ChromIndex; chromosomes not in the file raise KeyError.  Raises
+    ValueError if the file has changed size since it was indexed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.spans = {}
+        with open(index_filename(filename), 'r') as idx:
+            meta = dict(x.split('=') for x in idx.readline()[1:].split())
+            if int(meta['size']) != os.path.getsize(filename):
+                raise ValueError('%s is out of date; rebuild it with '
+                                 'lobstrindex.py' % index_filename(filename))
+            self.colnames = idx.readline().rstrip('\n').split('\t')[1:]
+            for line in idx:
+                kind, chrom, a, b, max_length = line.split('\t')
+                self.spans[chrom] = (int(a), int(b), int(max_length))
+        self.rows = numpy.load(array_filename(filename), mmap_mode='r')
+        self.f = open(filename, 'r')
+        self.lock = threading.Lock()
+        self.chroms = {}
+
+
+    @staticmethod
+    def exists(filename):
+        return os.path.exists(index_filename(filename)) and \
+               os.path.exists(array_filename(filename))
+
+
+    def __getitem__(self, chrom):
+        if chrom not in self.chroms:
+            self.chroms[chrom] = ChromIndex(self, *self.spans[chrom])
+        return self.chroms[chrom]
+
+
+    def read_row(self, offset):
+        # The file is shared by the threads of webserver.py
+        with self.lock:
+            self.f.seek(offset)
+            line = self.f.readline()
+        fields = map(str.strip, line.split('\t'))
+        return zip(self.colnames, fields)
+
+
+    def close(self):
+        self.f.close()
+
+
+def open_index(filename):
+    """Return the LobstrIndex of `filename`, building it first if it does
+    not exist."""
+    if not LobstrIndex.exists(filename):
+        sys.stderr.write('indexing ' + filename + '\n')
+        build_index(filename)
+    return LobstrIndex(filename)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Index lobSTR genotypes.tab files '
+                                        'for join_lobstr.py and webserver.py.')
+    parser.add_argument('filenames', metavar='genotypes.tab', nargs='+',
+        help='lobSTR genotypes.tab files, with the header from '
+             'lobstr/add_header.py')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        build_index(filename)
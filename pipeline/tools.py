@@ -116,19 +116,31 @@ class combine_summaries(Tool):
 
 
 class genotyper(Tool):
+    """Profile errors once, then genotype each chromosome in parallel."""
     inputs = [ 'str_summary.txt' ]
     outputs = [ 'calls.txt', 'filter_metrics.txt', 'error_profile.txt']
     mem_req = 2048
-    cpu_req = 1
+    cpu_req = 4
     time_req = 60
     name = 'genotyper'
 
     def cmd(self, i, s, p):
         single_cell = '--single-cell' if p['sample'] in s['single_cell'] else ''
-        return """{s[genotyper_script]}
+        # --resume lets a retry of a killed job skip the finished work
+        return """{s[genotyper_script]} profile
                     --error-distn-file $OUT.error_profile.txt
-                    --filter-metrics-file $OUT.filter_metrics.txt
+                    --resume
                     --min-mapq 30
                     --min-depth 10
                     %s
-                    {i[str_summary.txt][0]} > $OUT.calls.txt""" % single_cell
+                    {i[str_summary.txt][0]}
+                  && {s[genotyper_script]} call
+                    --error-profile $OUT.error_profile.txt
+                    --filter-metrics-file $OUT.filter_metrics.txt
+                    --output $OUT.calls.txt
+                    --resume
+                    --jobs %d
+                    --min-mapq 30
+                    --min-depth 10
+                    {i[str_summary.txt][0]}""" % \
+            (single_cell, self.cpu_req)
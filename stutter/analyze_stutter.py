@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import os
 import sys
-from scipy.stats import binom_test
+# The memoized binomial test is shared with the genotyper
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'genotyper'))
+from stuttertest import binom_test_half
 
 if len(sys.argv) != 2:
     print("usage: %s candidates.txt" % sys.argv[0])
@@ -39,7 +43,7 @@ with open(sys.argv[1], 'r') as f:
             #print(best_alleles)
             obs_a, obs_b = [ int(x[1]) for x in best_alleles ]
             #print("a=%d, b=%d" % (obs_a, obs_b))
-            pval = binom_test(obs_a, n=obs_a + obs_b, p=0.5)
+            pval = binom_test_half(obs_a, obs_a + obs_b)
             if pval < binom_threshold:
                 n_probably_stutter += 1
                 # should really be all obs reads != max(obs_a, obs_b)
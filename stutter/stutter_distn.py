@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
+import os
 import sys
 from numpy import array
 from collections import defaultdict
 from operator import itemgetter
-from scipy.stats import binom_test
+# The memoized binomial test is shared with the genotyper
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'genotyper'))
+from stuttertest import binom_test_half
 
 if len(sys.argv) != 2:
     print('usage: %s str_summary_file' % sys.argv[0])
@@ -31,7 +35,7 @@ def get_stats(summaries, use_binom=False, binom_threshold=0.05):
             # Get the "best" two allele lens
             obs1 = sorted_ainfo[0][1]
             obs2 = sorted_ainfo[1][1]
-            if binom_test(obs1, n=obs1 + obs2, p=0.5) <= binom_threshold:
+            if binom_test_half(obs1, obs1 + obs2) <= binom_threshold:
                 # Reject hypothesis that each allele is equally likely: stutter
                 likely_stutter = obs2    # obs1 is never considered stutter
                 #print("stutter: " + summaries)
@@ -54,16 +58,20 @@ def get_stats(summaries, use_binom=False, binom_threshold=0.05):
 #    [ total reads, likely stutter reads, total loci, likely stutter loci ]
 stats = defaultdict(lambda: defaultdict(lambda: array([0, 0, 0, 0])))
 
-# File format:
-#     chr, start, end, ref STR len (bp), unit (mono, di, tri, tetra), region,
-#     #alleles before genotyping, call, genotype, pval, allele summaries
+# File format: a genotyper calls file.  Only the ref_len (ref STR len in bp),
+# unit (mono, di, tri, tetra) and allele_summaries columns are used; they are
+# found by name since the calls format has gained columns over time.
 # The allele summary format: space separated list of:
 #     allele len diff from reference:depth,frac forward,meanmapq
 with open(sys.argv[1], 'r') as f:
-    f.readline()  # skip header
+    header = [ x.strip() for x in f.readline().split('\t') ]
+    columns = itemgetter(*[ header.index(c) for c in
+                            ('ref_len', 'unit', 'allele_summaries') ])
     for line in f:
         fields = [ x.strip() for x in line.split('\t') ]
-        reflen, unit, summaries = itemgetter(3,4,10)(fields)
+        reflen, unit, summaries = columns(fields)
+        if not summaries:
+            continue  # no reads passed the genotyper's filters
         stats[unit][int(reflen)] += get_stats(summaries, use_binom=True)
 
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Keyed offset index of a tab-delimited table with chr and start columns, such
+as the SPUTNIK candidate tables browsed by webserver.py.
+
+The table need not be sorted.  Index it once with
+    tableindex.py candidates.txt
+which writes two files beside it:
+    <file>.kidx      -- the size of the indexed file and the number given
+                        to each chromosome name
+    <file>.kidx.npy  -- two rows: the key (chromosome number << 32 | start)
+                        of every line, sorted, and the offset of each line
+KeyedTable memory-maps the array, so opening a table takes constant time
+and memory, and get(chrom, start) bisects the keys and reads and splits
+only the line asked for.  If a key occurs more than once, the last line
+wins, as it did when webserver.py read the table into a dict.
+"""
+
+import os
+import sys
+import numpy
+import threading
+from tempfile import mkstemp
+from array import array
+from argparse import ArgumentParser
+
+
+def index_filename(filename):
+    return filename + '.kidx'
+
+
+def array_filename(filename):
+    return filename + '.kidx.npy'
+
+
+def make_key(chrom_id, start):
+    return (chrom_id << 32) | start
+
+
+def write_atomically(filename, write, mode='w'):
+    """Call write(f) on a new file and move it into place as `filename`, so
+    readers never see a partial file.  Each writer has its own temporary
+    file in the same directory, so processes indexing the same table at
+    once do not clobber each other's output."""
+    fd, tmp = mkstemp(dir=os.path.dirname(filename) or '.',
+                      prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        # mkstemp creates the file readable only by its owner
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def build_index(filename):
+    """Write the index of the table `filename`."""
+    size = os.path.getsize(filename)
+    chrom_ids = {}
+    keys = array('l')
+    offsets = array('l')
+    with open(filename, 'r') as f:
+        header = f.readline()
+        colnames = map(str.strip, header.split('\t'))
+        c, s = colnames.index('chr'), colnames.index('start')
+        offset = len(header)
+        for line in iter(f.readline, ''):
+            fields = line.split('\t')
+            chrom = fields[c].strip()
+            if chrom not in chrom_ids:
+                chrom_ids[chrom] = len(chrom_ids)
+            keys.append(make_key(chrom_ids[chrom], int(fields[s])))
+            offsets.append(offset)
+            offset += len(line)
+
+    keys = numpy.array(keys, dtype=numpy.int64)
+    offsets = numpy.array(offsets, dtype=numpy.int64)
+    # Stable, so the last of several lines with the same key sorts last
+    order = numpy.argsort(keys, kind='mergesort')
+
+    def write_index(idx):
+        idx.write('#size=%d\n' % size)
+        for chrom, i in sorted(chrom_ids.items(), key=lambda x: x[1]):
+            idx.write('chrom\t%s\t%d\n' % (chrom, i))
+
+    # The index file last, so that a complete one has its array beside it
+    write_atomically(array_filename(filename),
+        lambda f: numpy.save(f, numpy.vstack((keys[order], offsets[order]))),
+        'wb')
+    write_atomically(index_filename(filename), write_index)
+
+
+class KeyedTable():
+    """The table `filename`, looked up through its index.  Raises
+    ValueError if the file has changed size since it was indexed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.chrom_ids = {}
+        with open(index_filename(filename), 'r') as idx:
+            meta = dict(x.split('=') for x in idx.readline()[1:].split())
+            if int(meta['size']) != os.path.getsize(filename):
+                raise ValueError('%s is out of date; rebuild it with '
+                                 'tableindex.py' % index_filename(filename))
+            for line in idx:
+                kind, chrom, i = line.split('\t')
+                self.chrom_ids[chrom] = int(i)
+        index = numpy.load(array_filename(filename), mmap_mode='r')
+        self.keys = index[0]
+        self.offsets = index[1]
+        self.f = open(filename, 'r')
+        self.colnames = map(str.strip, self.f.readline().split('\t'))
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def exists(filename):
+        return os.path.exists(index_filename(filename)) and \
+               os.path.exists(array_filename(filename))
+
+
+    def get(self, chrom, start):
+        """Return the fields of the line at (chrom, start), or None."""
+        try:
+            key = make_key(self.chrom_ids[str(chrom)], int(start))
+        except (KeyError, ValueError):
+            return None
+        i = numpy.searchsorted(self.keys, key, 'right') - 1
+        if i < 0 or self.keys[i] != key:
+            return None
+
+        # The file is shared by the threads of webserver.py
+        with self.lock:
+            self.f.seek(self.offsets[i])
+            line = self.f.readline()
+        return map(str.strip, line.split('\t'))
+
+
+    def close(self):
+        self.f.close()
+
+
+def open_table(filename):
+    """Return the KeyedTable of `filename`, indexing it first if needed."""
+    if not KeyedTable.exists(filename):
+        sys.stderr.write('indexing ' + filename + '\n')
+        build_index(filename)
+    return KeyedTable(filename)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Index a table by its chr and start '
+                                        'columns for webserver.py.')
+    parser.add_argument('filenames', metavar='table', nargs='+',
+        help='Tab-delimited tables with a header naming chr and start columns')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        build_index(filename)
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
+import os
 import sys
+# Tables indexed by genotyper/summaryindex.py can be searched without a scan
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'genotyper'))
+from summaryindex import SummaryIndex
 
 if __name__ == '__main__':
     if len(sys.argv) != 4:
@@ -11,18 +16,29 @@ if __name__ == '__main__':
     locus_start = sys.argv[3]
 
     f = open(sys.argv[1], 'r')
-    first_line = True
+    colnames = map(str.strip, f.readline().split('\t'))
+
+    # With an index, jump to the last indexed line before the locus and
+    # give up once the table is past it.
+    indexed = SummaryIndex.exists(sys.argv[1])
+    if indexed:
+        offset = SummaryIndex(sys.argv[1]).seek_offset(locus_chr,
+                                                       int(locus_start))
+        if offset is None:
+            f.seek(0, 2)  # chromosome not in the table
+        else:
+            f.seek(offset)
+
     for line in f:
         fields = map(str.strip, line.split('\t'))
 
-        if first_line:
-            colnames = fields
-            first_line = False
-            continue
-
         info = dict(zip(colnames, fields))
         if info['chr'] == locus_chr and info['start'] == locus_start:
             for x in zip(colnames, fields):
                 print('%25s   %s' % (x[0],x[1]))
             # Done.
             exit(0)
+
+        if indexed and (int(info['start']) > int(locus_start) or
+                info['chr'].replace('chr', '') != locus_chr.replace('chr', '')):
+            break
@@ -1,8 +1,24 @@
 #!/usr/bin/env python
 
+"""Browse the SPUTNIK and lobSTR data for candidate loci.
+
+    localhost:3790/?chr=1&start=958201           -- HTML page for a locus
+    localhost:3790/locus?chr=1&start=958201      -- the same data as JSON
+    localhost:3790/loci?ids=1:958201,2:10394     -- JSON list for many loci
+
+Requests are served by a thread each, and the most recently viewed loci are
+kept rendered in an LRU cache, so prefetching a candidate list with /loci
+makes paging through it instant."""
+
 import sys
+import json
+import threading
+import SocketServer
 import BaseHTTPServer
+from argparse import ArgumentParser
+from collections import OrderedDict
 from join_lobstr import read_lobstr
+from tableindex import open_table
 from urlparse import urlparse, parse_qs
 
 def tups_to_table(tups, title='', style=''):
@@ -13,39 +29,23 @@ def tups_to_table(tups, title='', style=''):
     #s += '\n'.join([ '<tr><td>%s</td><td>%s</tr>' % (k,v) for k,v in tups ])
     s += '</table>\n'
     return s
-    
-
-def read_sputnik(f):
-    results = {}
-    first_line = True
-    for line in f:
-        fields = map(str.strip, line.split('\t'))
-        if first_line:
-            colnames = fields
-            first_line = False
-            continue
-
-        info = dict(zip(colnames, fields))
-        results[info['chr'] + ':' + info['start']] = fields
-
-    return (colnames, results)
 
 
 def get_sputnik(chrom, start):
-    """returns (HTML table describing the sputnik info, the end coordinate)"""
-    cols, data = sputnik
-    try:
-        entry = data[str(chrom) + ':' + str(start)]
-    except KeyError:
-        return 'no entry in sputnik table for chr=%s, start=%s' % (chrom, start)
+    """Return the sputnik entry as a list of (key, value) tuples, or None."""
+    entry = sputnik.get(chrom, start)
+    if entry is None:
+        return None
 
-    d = dict(zip(cols, entry))
-    return (tups_to_table(zip(cols, entry), 'SPUTNIK'), d['end'])
+    return zip(sputnik.colnames, entry)
 
 
 def get_lobstr_one(sample, chrom, start, end):
     """Return a list of (key, value) tuples or an empty list."""
-    t = trees[sample]['chr'+chrom]
+    try:
+        t = trees[sample]['chr'+chrom]
+    except KeyError:
+        return []
     hits = t.find(int(start), int(end))
     # Just show the first hit for now
     if hits:
@@ -58,7 +58,10 @@ def get_lobstr_one(sample, chrom, start, end):
 
 def get_lobstr(samples, chrom, start, end):
     lobstrs = [ get_lobstr_one(s, chrom, start, end) for s in samples ]
-    lobstrs = filter(None, lobstrs)
+    return filter(None, lobstrs)
+
+
+def lobstr_table(lobstrs):
     if not lobstrs:
         return 'No lobSTR matches.'
 
@@ -71,54 +74,142 @@ def get_lobstr(samples, chrom, start, end):
     # Zip across the headers and data in each row
     table = zip(*([ headers ] + data))
     return tups_to_table(table, 'lobSTR')
- 
+
+
+def render_locus(chrom, start):
+    """Return (HTML, dict for JSON) describing the locus at chrom:start."""
+    locus = OrderedDict([ ('chr', chrom), ('start', start),
+                          ('sputnik', None), ('lobstr', []) ])
+    entry = get_sputnik(chrom, start)
+    if entry is None:
+        html = 'no entry in sputnik table for chr=%s, start=%s' % (chrom, start)
+        return (html, locus)
+
+    lobstrs = get_lobstr(samples, chrom, start, dict(entry)['end'])
+    locus['sputnik'] = OrderedDict(entry)
+    locus['lobstr'] = [ OrderedDict(match) for match in lobstrs ]
+    html = tups_to_table(entry, 'SPUTNIK')
+    html += '<br/><hr/><br/>\n'
+    html += lobstr_table(lobstrs)
+    return (html, locus)
+
+
+class LRUCache():
+    """At most `size` values, dropping the least recently used.  Shared by
+    the request threads."""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key, compute):
+        """Return the value for `key`, calling compute() to make it if it
+        is not cached."""
+        with self.lock:
+            if key in self.data:
+                value = self.data.pop(key)
+                self.data[key] = value
+                return value
+
+        # Computed outside the lock so that other loci are not held up
+        value = compute()
+        with self.lock:
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+        return value
+
+
+def get_locus(chrom, start):
+    """Return the cached (HTML, dict) for chrom:start."""
+    return cache.get((chrom, start), lambda: render_locus(chrom, start))
+
 
 class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_GET(self):
-        print('__________GOT REQUEST___________')
-        params = parse_qs(urlparse(self.path).query)
-        print(params)
-        chrom, start = (-1, -1)
-        html = 'unspecified error'
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/locus':
+            self.do_locus(params)
+        elif url.path == '/loci':
+            self.do_loci(params)
+        else:
+            self.do_page(params)
+
+
+    def do_page(self, params):
         try:
             chrom, start = (params['chr'][0], params['start'][0])
-            html, end = get_sputnik(chrom, start)
-            html += '<br/><hr/><br/>\n'
-            html += get_lobstr(samples, chrom, start, end)
+            html = get_locus(chrom, start)[0]
         except KeyError:
             html = 'ERROR: must pass chr and start arguments in the URL.<br/>'
             html += 'E.g., localhost:port/?chr=1&start=958201'
 
-        self.__writeout(html)
-        
+        self.__writeout("<html><body>%s</body></html>" % html, "text/html")
+
 
-    def __writeout(self, html_string):
-        resp = "<html><body>%s</body></html>" % html_string
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
+    def do_locus(self, params):
+        try:
+            chrom, start = (params['chr'][0], params['start'][0])
+        except KeyError:
+            self.__writeout(json.dumps({ 'error': 'must pass chr and start' }),
+                            "application/json", 400)
+            return
+
+        self.__writeout(json.dumps(get_locus(chrom, start)[1]),
+                        "application/json")
+
+
+    def do_loci(self, params):
+        # ids=chr:start,chr:start,... and/or ids= given more than once
+        ids = [ x for v in params.get('ids', []) for x in v.split(',') if x ]
+        try:
+            loci = [ x.split(':') for x in ids ]
+            data = [ get_locus(chrom, start)[1] for chrom, start in loci ]
+        except ValueError:
+            self.__writeout(json.dumps({ 'error': 'ids must be chr:start,...' }),
+                            "application/json", 400)
+            return
+
+        self.__writeout(json.dumps(data), "application/json")
+
+
+    def __writeout(self, resp, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
         self.send_header("Content-length", len(resp))
         self.end_headers()
         self.wfile.write(resp)
-        self.wfile.close()
 
-if len(sys.argv) != 2:
-    print('usage: %s candidate_table' % sys.argv[0])
-    exit(1)
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
 
 
-samples = [ 'heart_bulk', 'cortex_bulk', 'neuron_2', 'neuron_3', 'neuron_51', 'neuron_6', 'neurons_100batch' ]
-# for testing
-#samples = [ 'heart_bulk' ] #, 'neuron_2' ]
-print('loading SPUTNIK results..')
-f = open(sys.argv[1], 'r')
-sputnik = read_sputnik(f)
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Browse the SPUTNIK and lobSTR data '
+                                        'for candidate loci.')
+    parser.add_argument('candidate_table',
+        help='SPUTNIK candidate table')
+    parser.add_argument('--port', metavar='N', type=int, default=3790,
+        help='Port on 127.0.0.1 to listen on')
+    parser.add_argument('--cache-size', metavar='N', type=int, default=10000,
+        help='Number of rendered loci to keep')
+    args = parser.parse_args()
 
-print('building lobSTR indexes for samples: ' + str(samples))
-trees = read_lobstr(samples)
+    samples = [ 'heart_bulk', 'cortex_bulk', 'neuron_2', 'neuron_3', 'neuron_51', 'neuron_6', 'neurons_100batch' ]
+    # for testing
+    #samples = [ 'heart_bulk' ] #, 'neuron_2' ]
+    print('opening SPUTNIK results..')
+    sputnik = open_table(args.candidate_table)
 
+    print('opening lobSTR indexes for samples: ' + str(samples))
+    trees = read_lobstr(samples)
+    cache = LRUCache(args.cache_size)
 
-address = ('127.0.0.1', 3790)
-print('starting webserver on ' + str(address))
-httpd = BaseHTTPServer.HTTPServer(address, Handler)
-while True:
-    httpd.handle_request()
+    address = ('127.0.0.1', args.port)
+    print('starting webserver on ' + str(address))
+    httpd = ThreadedHTTPServer(address, Handler)
+    httpd.serve_forever()